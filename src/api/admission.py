@@ -0,0 +1,384 @@
+"""
+Admission control for the paid upstream providers (Mistral OCR, Gemini, Cohere).
+
+Every provider gets an `AdmissionController`: a token bucket caps the request
+rate, a semaphore caps the calls in flight, and at most `max_queue` callers may
+wait for either. A caller that would wait longer than its endpoint allows is
+rejected right away with `AdmissionRejected` (429 when the rate limit is the
+cause, 503 when the provider is saturated) carrying a Retry-After hint, instead
+of piling up until it times out. Upstream 429 and 5xx errors are retried with
+full-jitter exponential backoff, outside the in-flight slot.
+
+How long a caller may wait depends on the endpoint it serves, which is set per
+request in `CURRENT_ENDPOINT`; background jobs run under the "job" endpoint.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from langchain_core.embeddings import Embeddings
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAI
+from pydantic import PrivateAttr
+
+from telemetry import UPSTREAM_SECONDS, record_span, record_tokens, span
+
+logger = logging.getLogger(__name__)
+
+CURRENT_ENDPOINT: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("admission_endpoint", default=None)
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 3
+    backoff: float = 1.0
+    max_backoff: float = 30.0
+
+    def delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (1-based)"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+@dataclass
+class ProviderLimits:
+    rate: float = 0.0  # requests per second; 0 disables the rate limit
+    burst: int = 0  # bucket size; defaults to one second of requests
+    max_in_flight: int = 0  # 0 disables the concurrency cap
+    max_queue: int = 64
+    max_wait: float = 10.0  # default for endpoints without their own wait
+    retry: RetryPolicy = field(default_factory=lambda: RetryPolicy(attempts=3, backoff=0.5))
+
+
+class AdmissionRejected(HTTPException):
+    """A provider call was not admitted; maps to a 429 or 503 response with Retry-After"""
+
+    def __init__(self, provider: str, status_code: int, retry_after: float, reason: str):
+        self.provider = provider
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=status_code,
+            detail=f"{provider} is {reason}; retry in {self.retry_after}s",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+def find_rejection(error: BaseException) -> Optional[AdmissionRejected]:
+    """The AdmissionRejected an error was raised from, if any"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, AdmissionRejected):
+            return error
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def upstream_status(error: BaseException) -> Optional[int]:
+    """HTTP status of a provider SDK error, looked up through the exception chain"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        for candidate in (
+            getattr(error, "status_code", None),
+            getattr(error, "code", None),
+            getattr(getattr(error, "response", None), "status_code", None),
+        ):
+            if isinstance(candidate, int) and 100 <= candidate < 600:
+                return candidate
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, AdmissionRejected):
+        return False
+    status = upstream_status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+class TokenBucket:
+    """Token bucket where callers reserve a token and learn how long to wait for it"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst or math.ceil(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def cancel(self) -> None:
+        self.tokens += 1
+
+
+class AdmissionController:
+    def __init__(self, provider: str, limits: ProviderLimits, endpoint_waits: Optional[Dict[str, float]] = None):
+        self.provider = provider
+        self.limits = limits
+        self.endpoint_waits = endpoint_waits or {}
+        self.bucket = TokenBucket(limits.rate, limits.burst) if limits.rate > 0 else None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_busy = 0
+        self.retries = 0
+        self.upstream_errors = 0
+        self.wait_seconds = 0.0
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Event loop that owns the controller; calls from worker threads are admitted through it"""
+        self._loop = loop
+
+    def max_wait(self) -> float:
+        return self.endpoint_waits.get(CURRENT_ENDPOINT.get(), self.limits.max_wait)
+
+    def _retry_after_busy(self) -> float:
+        # Rough time for the queue ahead to drain, assuming about a second per call
+        slots = self.limits.max_in_flight or 1
+        return max(1.0, self.waiting / slots)
+
+    async def acquire(self, max_wait: Optional[float] = None) -> None:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        max_wait = self.max_wait() if max_wait is None else max_wait
+        if self.waiting >= self.limits.max_queue:
+            self.rejected_busy += 1
+            raise AdmissionRejected(self.provider, 503, self._retry_after_busy(), "overloaded")
+
+        start = time.monotonic()
+        delay = 0.0
+        if self.bucket is not None:
+            delay = self.bucket.reserve()
+            if delay > max_wait:
+                self.bucket.cancel()
+                self.rejected_rate += 1
+                raise AdmissionRejected(self.provider, 429, delay, "rate limited")
+
+        self.waiting += 1
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            if self.limits.max_in_flight:
+                if self._semaphore is None:
+                    self._semaphore = asyncio.Semaphore(self.limits.max_in_flight)
+                remaining = max(0.0, max_wait - (time.monotonic() - start))
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    self.rejected_busy += 1
+                    raise AdmissionRejected(self.provider, 503, self._retry_after_busy(), "at capacity")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.admitted += 1
+        waited = time.monotonic() - start
+        self.wait_seconds += waited
+        if waited >= 0.001:
+            record_span("admission_wait", waited, provider=self.provider)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self, max_wait: Optional[float] = None):
+        """Hold an admitted slot for the duration of the block; no retries"""
+        await self.acquire(max_wait)
+        try:
+            with self._timed():
+                yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def _timed(self):
+        """Span and latency histogram of one upstream call"""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with span(self.provider):
+                yield
+            outcome = "ok"
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, provider=self.provider, outcome=outcome)
+
+    async def call(self, fn: Callable, *args, **kwargs):
+        """Await `fn(*args, **kwargs)` in an admitted slot, retrying upstream 429 and 5xx errors"""
+        retry = self.limits.retry
+        for attempt in range(1, retry.attempts + 1):
+            async with self.slot():
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    self.upstream_errors += 1
+                    if attempt >= retry.attempts:
+                        raise
+                    error = e
+            self.retries += 1
+            delay = retry.delay(attempt)
+            logger.warning(f"{self.provider} call failed (attempt {attempt}/{retry.attempts}), retrying in {delay:.1f}s: {error}")
+            await asyncio.sleep(delay)
+
+    @contextmanager
+    def blocking_slot(self, max_wait: float):
+        """`slot` for code running in a worker thread; admission happens on the bound event loop"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or _running_in(loop):
+            # Not served by an event loop (e.g. a script): run without admission control
+            with self._timed():
+                yield
+            return
+        # Whichever side learns last that the thread gave up on a completed acquire releases the slot
+        handoff = threading.Lock()
+        state = {"acquired": False, "abandoned": False}
+
+        async def acquire():
+            await self.acquire(max_wait)
+            with handoff:
+                state["acquired"] = True
+                abandoned = state["abandoned"]
+            if abandoned:
+                self.release()
+
+        future = asyncio.run_coroutine_threadsafe(acquire(), loop)
+        try:
+            future.result(timeout=max_wait + 30)
+        except concurrent.futures.TimeoutError:
+            # The event loop did not get to the acquire in time (blocked, or shutting down)
+            with handoff:
+                state["abandoned"] = True
+                acquired = state["acquired"]
+            future.cancel()
+            if acquired:
+                loop.call_soon_threadsafe(self.release)
+            with self._lock:
+                self.rejected_busy += 1
+            raise AdmissionRejected(self.provider, 503, self._retry_after_busy(), "at capacity")
+        try:
+            with self._timed():
+                yield
+        finally:
+            loop.call_soon_threadsafe(self.release)
+
+    def call_blocking(self, fn: Callable, *args, **kwargs):
+        """`call` for blocking functions, from a worker thread"""
+        retry = self.limits.retry
+        max_wait = self.max_wait()
+        for attempt in range(1, retry.attempts + 1):
+            with self.blocking_slot(max_wait):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    with self._lock:
+                        self.upstream_errors += 1
+                    if attempt >= retry.attempts:
+                        raise
+                    error = e
+            with self._lock:
+                self.retries += 1
+            delay = retry.delay(attempt)
+            logger.warning(f"{self.provider} call failed (attempt {attempt}/{retry.attempts}), retrying in {delay:.1f}s: {error}")
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected_rate_limited": self.rejected_rate,
+            "rejected_overloaded": self.rejected_busy,
+            "upstream_errors": self.upstream_errors,
+            "retries": self.retries,
+            "avg_wait_ms": round(1000 * self.wait_seconds / self.admitted, 1) if self.admitted else 0.0,
+        }
+
+
+def _running_in(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+# Provider adapters
+
+
+class AdmittedEmbeddings(Embeddings):
+    """Embeddings whose provider calls go through an admission controller"""
+
+    def __init__(self, underlying: Embeddings, admission: AdmissionController):
+        self.underlying = underlying
+        self.admission = admission
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        record_tokens(self.admission.provider, "input", "".join(texts))
+        return self.admission.call_blocking(self.underlying.embed_documents, texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        record_tokens(self.admission.provider, "input", text)
+        return self.admission.call_blocking(self.underlying.embed_query, text)
+
+
+class AdmittedModel:
+    """Mixin admitting the async generate and stream calls of a LangChain model; sync calls are not used by the API"""
+
+    async def _agenerate(self, *args, **kwargs):
+        if self._admission is None:
+            return await super()._agenerate(*args, **kwargs)
+        return await self._admission.call(super()._agenerate, *args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        if self._admission is None:
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+            return
+        # A stream holds its slot until it ends; it is not retried once tokens were sent
+        async with self._admission.slot():
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+
+
+class AdmittedGoogleGenerativeAI(AdmittedModel, GoogleGenerativeAI):
+    _admission: Optional[AdmissionController] = PrivateAttr(default=None)
+
+
+class AdmittedChatGoogleGenerativeAI(AdmittedModel, ChatGoogleGenerativeAI):
+    _admission: Optional[AdmissionController] = PrivateAttr(default=None)
+
+
+def admitted(model, admission: AdmissionController):
+    model._admission = admission
+    return model
+
+
+def parse_endpoint_waits(value: str) -> Dict[str, float]:
+    """Parse "path=seconds,path=seconds" into a dict"""
+    waits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        path, _, seconds = item.partition("=")
+        waits[path.strip()] = float(seconds)
+    return waits
@@ -0,0 +1,186 @@
+"""
+Semantic cache of chat answers.
+
+Questions about a paper are often paraphrases of each other. Every answer is
+stored with the unit embedding of its question under a scope: the PDFs it was
+asked about and their index versions (catalog content hashes). A new question
+in the same scope whose embedding reaches the cosine threshold against a stored
+question gets the stored answer, without retrieval or an LLM call. The same
+question asked again (up to case and whitespace) is found by its text, without
+embedding it; answers whose question was never embedded (the BM25 fast path
+skips that call) are only found this way.
+
+Re-indexing a PDF changes its content hash, so old answers stop matching even
+in other processes; `invalidate` also drops them from memory right away.
+Entries are kept in a bounded LRU.
+"""
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Upper edges of the similarity histogram reported in stats
+SIMILARITY_BUCKETS = (0.5, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 1.0)
+
+Scope = Tuple[Tuple[str, str], ...]
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def question_key(question: str) -> str:
+    """Text key of a question: case and whitespace do not matter"""
+    return _WHITESPACE.sub(" ", question).strip().lower()
+
+
+def answer_scope(versions: Dict[str, str]) -> Scope:
+    """Scope of a question: (pdf name, index version) of every PDF it is asked about"""
+    return tuple(sorted(versions.items()))
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: Any
+    vector: Optional[np.ndarray]
+
+
+class SemanticAnswerCache:
+    def __init__(self, max_entries: int = 5000, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Tuple[Scope, CachedAnswer]]" = OrderedDict()
+        # Entry ids of each scope, and the vectors of those that have one stacked for one matrix product per lookup
+        self._scopes: Dict[Scope, List[int]] = {}
+        self._matrices: Dict[Scope, Tuple[List[int], np.ndarray]] = {}
+        self._by_text: Dict[Tuple[Scope, str], int] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._histogram = [0] * len(SIMILARITY_BUCKETS)
+
+    @staticmethod
+    def _unit(vector: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _record_similarity(self, similarity: float) -> None:
+        for bucket, edge in enumerate(SIMILARITY_BUCKETS):
+            if similarity <= edge:
+                self._histogram[bucket] += 1
+                return
+        self._histogram[-1] += 1
+
+    def lookup_text(self, scope: Scope, question: str) -> Optional[CachedAnswer]:
+        """The answer stored for the same question text in the scope; a miss is not counted, `lookup` may follow"""
+        with self._lock:
+            entry_id = self._by_text.get((scope, question_key(question)))
+            if entry_id is None:
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            self.exact_hits += 1
+            return self._entries[entry_id][1]
+
+    def has_vectors(self, scope: Scope) -> bool:
+        """Whether a question embedding could match anything in the scope"""
+        with self._lock:
+            return any(self._entries[entry_id][1].vector is not None for entry_id in self._scopes.get(scope, ()))
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def lookup(self, scope: Scope, vector: Sequence[float]) -> Optional[Tuple[CachedAnswer, float]]:
+        """The stored answer closest to `vector` in the scope, with its similarity, if it reaches the threshold"""
+        query = self._unit(vector)
+        with self._lock:
+            matrix = self._matrices.get(scope)
+            if matrix is None:
+                entry_ids = [entry_id for entry_id in self._scopes.get(scope, ()) if self._entries[entry_id][1].vector is not None]
+                if entry_ids:
+                    matrix = (entry_ids, np.stack([self._entries[entry_id][1].vector for entry_id in entry_ids]))
+                    self._matrices[scope] = matrix
+            if matrix is None:
+                self.misses += 1
+                return None
+            entry_ids, vectors = matrix
+            similarities = vectors @ query
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            self._record_similarity(similarity)
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            entry_id = entry_ids[best]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id][1], similarity
+
+    def put(self, scope: Scope, question: str, vector: Optional[Sequence[float]], answer: Any) -> None:
+        """Store an answer; without a `vector` it is only found again by its question text"""
+        with self._lock:
+            text_key = (scope, question_key(question))
+            previous = self._by_text.pop(text_key, None)
+            if previous is not None:
+                del self._entries[previous]
+                self._remove_from_scope(scope, previous)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, CachedAnswer(question, answer, self._unit(vector) if vector is not None else None))
+            self._scopes.setdefault(scope, []).append(entry_id)
+            self._by_text[text_key] = entry_id
+            self._matrices.pop(scope, None)
+            while len(self._entries) > self.max_entries:
+                old_id, (old_scope, old_entry) = self._entries.popitem(last=False)
+                self._by_text.pop((old_scope, question_key(old_entry.question)), None)
+                self._remove_from_scope(old_scope, old_id)
+                self.evictions += 1
+
+    def _remove_from_scope(self, scope: Scope, entry_id: int) -> None:
+        entry_ids = self._scopes.get(scope)
+        if entry_ids is None:
+            return
+        entry_ids.remove(entry_id)
+        self._matrices.pop(scope, None)
+        if not entry_ids:
+            del self._scopes[scope]
+
+    def invalidate(self, pdf_names: Iterable[str]) -> int:
+        """Drop every answer about any of the PDFs; returns the number dropped"""
+        names = set(pdf_names)
+        dropped = 0
+        with self._lock:
+            for scope in [scope for scope in self._scopes if any(name in names for name, _ in scope)]:
+                for entry_id in self._scopes.pop(scope):
+                    _, entry = self._entries.pop(entry_id)
+                    self._by_text.pop((scope, question_key(entry.question)), None)
+                    dropped += 1
+                self._matrices.pop(scope, None)
+            self.invalidations += dropped
+        return dropped
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "scopes": len(self._scopes),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "exact_hits": self.exact_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                # Best similarity found per lookup in a non-empty scope, by upper bucket edge
+                "similarity_histogram": {
+                    f"<={edge}": count for edge, count in zip(SIMILARITY_BUCKETS, self._histogram)
+                },
+            }
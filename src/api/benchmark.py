@@ -0,0 +1,662 @@
+"""
+Offline benchmark of every API endpoint, with local stand-ins for Mistral OCR,
+Gemini, Cohere and TiDB (see fakes.py), so nothing is spent on live providers.
+
+The app runs in this process with its normal lifespan; requests go through the
+ASGI stack at a fixed concurrency (closed loop), one endpoint after another.
+For each endpoint the report has latency percentiles, RPS, status codes, cache
+and retrieval-mode headers, calls made to each fake provider, event loop lag
+and RSS. Chat endpoints also report recall@k: questions are generated from
+facts planted in the synthetic papers, and a hit is a citation of a chunk that
+contains the fact.
+
+    python benchmark.py --requests 200 --concurrency 16 --output baselines/current.json
+    python benchmark.py --endpoints chat,chat-stream --compare baselines/current.json
+
+With --compare, endpoints slower (or recall lower) than the baseline by more
+than --tolerance are listed and the exit status is 1.
+
+--chunker-pages times only the indexing-time chunker over a synthetic book of
+that many pages (exit status 1 above --chunker-budget-ms), next to the generic
+LangChain markdown splitter for reference:
+
+    python benchmark.py --chunker-pages 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from admission import admitted
+
+STATE_DIR = tempfile.mkdtemp(prefix="pdf-studio-bench-")
+
+# Keep every cache and job database of the benchmarked app out of the working tree; must be set before main is imported
+for name, value in {
+    "JOBS_DB_PATH": f"{STATE_DIR}/jobs.sqlite3",
+    "EMBEDDING_CACHE_PATH": f"{STATE_DIR}/embeddings.sqlite3",
+    "OCR_CACHE_PATH": f"{STATE_DIR}/ocr.sqlite3",
+    "RESULT_CACHE_PATH": f"{STATE_DIR}/results.sqlite3",
+    "LEXICAL_INDEX_PATH": f"{STATE_DIR}/lexical",
+    "VECTOR_REPLICA_PATH": f"{STATE_DIR}/vectors",
+    "GOOGLE_API_KEY": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class Outcome:
+    status: int
+    latency: float = 0.0
+    ttfb: Optional[float] = None  # first answer token, for streams
+    headers: Dict[str, str] = field(default_factory=dict)
+    hit: Optional[bool] = None  # recall: a cited chunk contains the fact asked about
+    context_tokens: Optional[int] = None  # packed prompt context, for answers not served from the cache
+    error: Optional[str] = None
+
+
+@dataclass
+class Scenario:
+    name: str
+    prepare: Callable[["Bench", int], Any]
+    send: Callable[["Bench", Any], Awaitable[Outcome]]
+
+
+class LagSampler:
+    """Samples how late the event loop wakes up from short sleeps while a phase runs"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return summarize(self.lags)
+
+
+def summarize(values: List[float], scale: float = 1000) -> Dict[str, float]:
+    """Percentiles, mean and max of durations in seconds, in milliseconds (or of other values with scale=1)"""
+    if not values:
+        return {}
+    array = np.asarray(values, dtype=float) * scale
+    stats = {f"p{p}": round(float(np.percentile(array, p)), 3) for p in PERCENTILES}
+    stats["mean"] = round(float(array.mean()), 3)
+    stats["max"] = round(float(array.max()), 3)
+    return stats
+
+
+def rss_mb() -> Dict[str, float]:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    peak_mb = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    current_mb = None
+    try:
+        with open("/proc/self/statm") as statm:
+            current_mb = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    return {"peak": round(peak_mb, 1), "current": round(current_mb, 1) if current_mb is not None else None}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def parse_sse(body: str) -> List[tuple]:
+    events = []
+    for block in body.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines.get("data", "null"))))
+    return events
+
+
+class Bench:
+    """The app under test, its fake providers and the synthetic corpus"""
+
+    def __init__(self, args, app_module, fakes_module):
+        self.args = args
+        self.main = app_module
+        self.fakes = fakes_module
+        self.corpus = fakes_module.SyntheticCorpus(seed=args.seed)
+        self.documents: List[str] = []
+        # (pdf name, question, keys of the chunks that contain the answer)
+        self.questions: List[tuple] = []
+        self.client = None
+        self.providers: Dict[str, Any] = {}
+
+    def install_fakes(self, resources) -> None:
+        """Preload the app's resources with the stand-ins; admission control and caches stay in place"""
+        fakes, args = self.fakes, self.args
+        embeddings = fakes.FakeEmbeddings(args.dimensions, fakes.LatencyModel.parse(args.embed_latency, args.seed))
+        llm = admitted(
+            fakes.AdmittedFakeLLM(
+                latency=fakes.LatencyModel.parse(args.llm_latency, args.seed + 1),
+                token_latency=fakes.LatencyModel.parse(args.token_latency, args.seed + 2)
+            ),
+            resources.admission["gemini"]
+        )
+        chat_llm = admitted(
+            fakes.AdmittedFakeChatModel(latency=fakes.LatencyModel.parse(args.llm_latency, args.seed + 3)),
+            resources.admission["gemini"]
+        )
+        ocr = fakes.FakeOCRClient(self.corpus, fakes.LatencyModel.parse(args.ocr_latency, args.seed + 4))
+
+        cached_embeddings = self.main.get_embeddings_model(resources.admission["cohere"], provider=embeddings)
+        database_url = args.database_url or f"sqlite:///{STATE_DIR}/vectors.sqlite3"
+        resources._embeddings = cached_embeddings
+        resources._vector_store = fakes.LocalVectorStore(database_url, cached_embeddings, args.dimensions)
+        resources._llm = llm
+        resources._chat_llm = chat_llm
+
+        async def get_ocr_client():
+            return ocr
+
+        self.main.app.dependency_overrides[self.main.get_ocr_client] = get_ocr_client
+        self.providers = {"cohere": embeddings.counter, "gemini": llm.counter, "gemini_chat": chat_llm.counter, "mistral": ocr.counter}
+
+    def expected_chunks(self, name: str, markdown: str) -> Dict[str, set]:
+        """Keys of the chunks containing each planted fact sentence of a document"""
+        chunks = [chunk.text for chunk in self.main.split_markdown_chunks(markdown)]
+        keys = [self.main.indexing.chunk_key(chunk, self.main.EMBEDDING_MODEL) for chunk in chunks]
+        return {
+            fact["sentence"]: {key for chunk, key in zip(chunks, keys) if fact["sentence"] in chunk}
+            for fact in self.corpus.facts(name, self.args.pages)
+        }
+
+    async def setup(self) -> Dict[str, Any]:
+        """Index the documents that the chat, check-index and collection endpoints work on"""
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def index(number: int):
+            name = f"corpus-{number}.pdf"
+            markdown = self.corpus.markdown(name, self.args.pages)
+            async with semaphore:
+                response = await self.client.post("/index-pdf", json={"pdf_name": name, "content": markdown})
+            response.raise_for_status()
+            expected = self.expected_chunks(name, markdown)
+            facts = self.corpus.facts(name, self.args.pages)
+            return name, [(fact_number, name, fact["question"], expected[fact["sentence"]]) for fact_number, fact in enumerate(facts)]
+
+        indexed = await asyncio.gather(*(index(number) for number in range(self.args.documents)))
+        self.documents = [name for name, _ in indexed]
+        # Interleave documents so consecutive chat requests hit different PDFs
+        facts = sorted((fact for _, document_facts in indexed for fact in document_facts), key=lambda fact: fact[:2])
+        self.questions = [fact[1:] for fact in facts]
+        return {"documents": len(self.documents), "questions": len(self.questions), "seconds": round(time.perf_counter() - started, 3)}
+
+    def reset_counters(self) -> None:
+        for counter in self.providers.values():
+            counter.reset()
+
+    def provider_calls(self) -> Dict[str, Dict[str, int]]:
+        return {name: counter.snapshot() for name, counter in self.providers.items()}
+
+    async def run_phase(self, scenario: Scenario) -> Dict[str, Any]:
+        requests, concurrency = self.args.requests, self.args.concurrency
+        payloads = [scenario.prepare(self, number) for number in range(requests)]
+        pending = iter(range(requests))
+        outcomes: List[Outcome] = []
+
+        async def worker():
+            for number in pending:
+                start = time.perf_counter()
+                try:
+                    outcome = await scenario.send(self, payloads[number])
+                except Exception as e:
+                    outcome = Outcome(status=0, error=f"{type(e).__name__}: {e}")
+                outcome.latency = time.perf_counter() - start
+                if outcome.ttfb is not None:
+                    outcome.ttfb -= start
+                outcomes.append(outcome)
+
+        self.reset_counters()
+        lag = LagSampler()
+        lag.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+        wall = time.perf_counter() - started
+        loop_lag = await lag.stop()
+
+        statuses: Dict[str, int] = {}
+        headers: Dict[str, Dict[str, int]] = {}
+        for outcome in outcomes:
+            statuses[str(outcome.status)] = statuses.get(str(outcome.status), 0) + 1
+            for header, value in outcome.headers.items():
+                counts = headers.setdefault(header, {})
+                counts[value] = counts.get(value, 0) + 1
+        successful = [outcome for outcome in outcomes if 200 <= outcome.status < 300]
+        report = {
+            "requests": requests,
+            "concurrency": concurrency,
+            "seconds": round(wall, 3),
+            "rps": round(len(successful) / wall, 2) if wall else 0.0,
+            "statuses": statuses,
+            "latency_ms": summarize([outcome.latency for outcome in successful]),
+            "headers": headers,
+            "provider_calls": self.provider_calls(),
+            "loop_lag_ms": loop_lag,
+            "rss_mb": rss_mb(),
+        }
+        ttfb = [outcome.ttfb for outcome in successful if outcome.ttfb is not None]
+        if ttfb:
+            report["first_token_ms"] = summarize(ttfb)
+        context_tokens = [outcome.context_tokens for outcome in successful if outcome.context_tokens]
+        if context_tokens:
+            report["context_tokens"] = summarize(context_tokens, scale=1)
+        judged = [outcome.hit for outcome in successful if outcome.hit is not None]
+        if judged:
+            report["recall_at_k"] = round(sum(judged) / len(judged), 4)
+            by_mode: Dict[str, List[bool]] = {}
+            for outcome in successful:
+                if outcome.hit is not None and "x-retrieval-mode" in outcome.headers:
+                    by_mode.setdefault(outcome.headers["x-retrieval-mode"], []).append(outcome.hit)
+            report["recall_by_mode"] = {mode: round(sum(hits) / len(hits), 4) for mode, hits in by_mode.items()}
+        errors = sorted({outcome.error for outcome in outcomes if outcome.error})
+        if errors:
+            report["errors"] = errors[:5]
+        return report
+
+
+def response_outcome(response, headers=("x-cache", "x-retrieval-mode")) -> Outcome:
+    return Outcome(
+        status=response.status_code,
+        headers={name: response.headers[name] for name in headers if name in response.headers}
+    )
+
+
+def cited(citations: List[Dict[str, Any]], expected: set) -> bool:
+    return any(
+        chunk_hash in expected
+        for citation in citations
+        for chunk_hash in citation.get("chunk_hashes") or [citation.get("chunk_hash")]
+    )
+
+
+# Scenarios: prepare(bench, number) builds the request outside the timed section, send(bench, payload) runs it
+
+
+def prepare_question(bench: Bench, number: int, multi: bool = False) -> tuple:
+    name, question, expected = bench.questions[number % len(bench.questions)]
+    body = {"question": question}
+    if multi:
+        body["pdf_names"] = bench.documents
+    else:
+        body["pdf_name"] = name
+    return body, expected
+
+
+async def send_chat(bench: Bench, payload) -> Outcome:
+    body, expected = payload
+    response = await bench.client.post("/chat", json=body)
+    outcome = response_outcome(response)
+    if response.status_code == 200:
+        data = response.json()
+        outcome.hit = cited(data["citations"], expected)
+        outcome.context_tokens = data.get("context_tokens")
+    return outcome
+
+
+async def send_chat_stream(bench: Bench, payload) -> Outcome:
+    body, expected = payload
+    outcome = Outcome(status=0)
+    chunks = []
+    async with bench.client.stream("POST", "/chat/stream", json=body) as response:
+        outcome.status = response.status_code
+        async for chunk in response.aiter_text():
+            if outcome.ttfb is None and "event: token" in chunk:
+                outcome.ttfb = time.perf_counter()
+            chunks.append(chunk)
+    events = parse_sse("".join(chunks))
+    for event, data in events:
+        if event == "sources":
+            outcome.hit = cited(data, expected)
+        elif event == "done":
+            outcome.context_tokens = data.get("context_tokens")
+        elif event == "error":
+            outcome.status, outcome.error = 500, data["detail"]
+    return outcome
+
+
+def prepare_markdown(bench: Bench, number: int) -> str:
+    # Cycles through the corpus, so later requests for a paper hit the result cache
+    name = bench.documents[number % len(bench.documents)]
+    return bench.corpus.markdown(name, bench.args.pages)
+
+
+def prepare_unique_document(bench: Bench, number: int) -> Dict[str, str]:
+    name = f"bench-{bench.args.seed}-{number}.pdf"
+    return {"pdf_name": name, "content": bench.corpus.markdown(name, bench.args.pages)}
+
+
+def prepare_pdf(bench: Bench, number: int, scenario: str) -> tuple:
+    # Unique bytes per request and scenario, so every upload misses the OCR cache
+    name = f"{scenario}-{bench.args.seed}-{number}.pdf"
+    return name, bench.corpus.pdf(bench.args.pages, salt=name)
+
+
+def post_json(path: str, body: Callable[[Bench, Any], Any]):
+    async def send(bench: Bench, payload) -> Outcome:
+        return response_outcome(await bench.client.post(path, json=body(bench, payload)))
+    return send
+
+
+async def send_upload(bench: Bench, payload) -> Outcome:
+    name, pdf = payload
+    response = await bench.client.post("/process-pdf", files={"file": (name, pdf, "application/pdf")})
+    return response_outcome(response)
+
+
+async def submit_job(bench: Bench, payload):
+    name, pdf = payload
+    return await bench.client.post("/jobs/ocr", files={"file": (name, pdf, "application/pdf")})
+
+
+async def send_job_polling(bench: Bench, payload) -> Outcome:
+    """Submit an OCR job and poll it until it finishes; latency is the whole job"""
+    response = await submit_job(bench, payload)
+    if response.status_code != 202:
+        return response_outcome(response)
+    job_id = response.json()["job_id"]
+    while True:
+        job = (await bench.client.get(f"/jobs/{job_id}")).json()
+        if job["status"] in ("succeeded", "failed"):
+            return Outcome(status=200 if job["status"] == "succeeded" else 500, error=job.get("error"))
+        await asyncio.sleep(bench.args.poll_interval)
+
+
+async def send_job_events(bench: Bench, payload) -> Outcome:
+    """Submit an OCR job and follow its event stream to the end"""
+    response = await submit_job(bench, payload)
+    if response.status_code != 202:
+        return response_outcome(response)
+    job_id = response.json()["job_id"]
+    async with bench.client.stream("GET", f"/jobs/{job_id}/events") as stream:
+        body = "".join([chunk async for chunk in stream.aiter_text()])
+    last = parse_sse(body)[-1][0] if body else "failed"
+    return Outcome(status=200 if last == "done" else 500)
+
+
+async def send_collection(bench: Bench, payload) -> Outcome:
+    collection, names = payload
+    response = await bench.client.post("/collections", json={"collection": collection, "pdf_names": names})
+    if response.status_code != 200:
+        return response_outcome(response)
+    return response_outcome(await bench.client.get(f"/collections/{collection}"))
+
+
+async def send_metrics(bench: Bench, payload) -> Outcome:
+    return response_outcome(await bench.client.get("/metrics"))
+
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in (
+        Scenario("index-pdf", prepare_unique_document, post_json("/index-pdf", lambda bench, body: body)),
+        Scenario("chat", prepare_question, send_chat),
+        Scenario("chat-multi", lambda bench, number: prepare_question(bench, number, multi=True), send_chat),
+        Scenario("chat-stream", prepare_question, send_chat_stream),
+        Scenario(
+            "check-index",
+            lambda bench, number: bench.documents[number % len(bench.documents)],
+            post_json("/check-index", lambda bench, name: {"pdf_name": name})
+        ),
+        Scenario(
+            "check-index-batch",
+            lambda bench, number: bench.documents + [f"missing-{number}.pdf"],
+            post_json("/check-index/batch", lambda bench, names: {"pdf_names": names})
+        ),
+        Scenario(
+            "collections",
+            lambda bench, number: (f"collection-{number % 10}", bench.documents[: 1 + number % len(bench.documents)]),
+            send_collection
+        ),
+        Scenario("process-pdf", lambda bench, number: prepare_pdf(bench, number, "process-pdf"), send_upload),
+        Scenario("jobs-ocr", lambda bench, number: prepare_pdf(bench, number, "jobs-ocr"), send_job_polling),
+        Scenario("jobs-ocr-events", lambda bench, number: prepare_pdf(bench, number, "jobs-ocr-events"), send_job_events),
+        Scenario(
+            "structured-summary", prepare_markdown,
+            post_json("/structured-summary", lambda bench, markdown: {"paper_markdown": markdown})
+        ),
+        Scenario(
+            "generate-quiz", prepare_markdown,
+            post_json("/generate-quiz", lambda bench, markdown: {"paper_markdown": markdown})
+        ),
+        Scenario(
+            "generate-faqs", prepare_markdown,
+            post_json("/generate-faqs", lambda bench, markdown: {"paper_markdown": markdown, "num_questions": 5})
+        ),
+        Scenario(
+            "mind-map", prepare_markdown,
+            post_json("/mind-map", lambda bench, markdown: {"paper_markdown": markdown})
+        ),
+        Scenario(
+            "studio-generate", prepare_markdown,
+            post_json("/studio/generate", lambda bench, markdown: {"paper_markdown": markdown})
+        ),
+        Scenario(
+            "cache-invalidate", prepare_markdown,
+            post_json("/cache/invalidate", lambda bench, markdown: {"paper_markdown": markdown, "artifact": "quiz"})
+        ),
+        Scenario("metrics", lambda bench, number: None, send_metrics),
+    )
+}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta_ms: float) -> List[str]:
+    """Print each endpoint against the baseline and return the regressions"""
+    regressions = []
+    print(f"\n{'endpoint':<20}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        checks = [(f"latency {p}", previous["latency_ms"].get(p), current["latency_ms"].get(p), True) for p in ("p50", "p95", "p99")]
+        checks.append(("rps", previous["rps"], current["rps"], False))
+        if "recall_at_k" in previous:
+            checks.append(("recall@k", previous["recall_at_k"], current.get("recall_at_k", 0.0), False))
+        for metric, old, new, lower_is_better in checks:
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            worse = change > tolerance if lower_is_better else change < -tolerance
+            if worse and lower_is_better and new - old < min_delta_ms:
+                worse = False
+            print(f"{name:<20}{metric:<16}{old:>12.2f}{new:>12.2f}{change:>+10.1%}{'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append(f"{name} {metric}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API offline against local provider stand-ins")
+    parser.add_argument("--endpoints", default=",".join(SCENARIOS), help="Comma-separated scenarios to run, in order")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight per endpoint")
+    parser.add_argument("--documents", type=int, default=10, help="Documents indexed before the run")
+    parser.add_argument("--pages", type=int, default=8, help="Pages per synthetic document and uploaded PDF")
+    parser.add_argument("--dimensions", type=int, default=256, help="Dimensions of the fake embeddings")
+    parser.add_argument("--seed", type=int, default=0)
+    # Latency specs are median_ms[:sigma[:per_item_ms[:error_rate]]]
+    parser.add_argument("--ocr-latency", default="300:0.3:50", help="Mistral OCR call, per page")
+    parser.add_argument("--llm-latency", default="800:0.4", help="Gemini call, until the first token")
+    parser.add_argument("--token-latency", default="5:0.2", help="Gemini, between streamed tokens")
+    parser.add_argument("--embed-latency", default="120:0.3:0.5", help="Cohere embed call, per text")
+    parser.add_argument("--database-url", help="SQLAlchemy URL of the vector store (default: SQLite in a temp dir); needs VEC_COSINE_DISTANCE")
+    parser.add_argument(
+        "--provider-limits", action="store_true",
+        help="Keep the configured provider rate and concurrency limits (off by default so they do not cap throughput)"
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between job status polls")
+    parser.add_argument("--output", help="Write the JSON report (a baseline) to this path")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=2.0, help="Ignore latency regressions smaller than this")
+    parser.add_argument("--chunker-pages", type=int, help="Only time the chunker over a synthetic book of this many pages")
+    parser.add_argument("--chunker-runs", type=int, default=5, help="Timed chunker runs; the best one is compared to the budget")
+    parser.add_argument("--chunker-budget-ms", type=float, default=1000.0, help="Slowest acceptable chunker run for --chunker-pages")
+    return parser.parse_args(argv)
+
+
+def bench_chunker(args) -> Dict[str, Any]:
+    """Micro-benchmark of chunking.split_markdown over a synthetic book"""
+    from langchain_text_splitters import MarkdownTextSplitter
+
+    import chunking
+    import fakes
+
+    book = fakes.SyntheticCorpus(args.seed).book("book", args.chunker_pages)
+
+    def timed(split) -> tuple:
+        seconds = []
+        for _ in range(args.chunker_runs):
+            started = time.perf_counter()
+            chunks = split(book)
+            seconds.append(time.perf_counter() - started)
+        return chunks, seconds
+
+    chunks, seconds = timed(chunking.split_markdown)
+    _, generic_seconds = timed(MarkdownTextSplitter(chunk_size=1500, chunk_overlap=200).split_text)
+    best = min(seconds)
+    return {
+        "pages": args.chunker_pages,
+        "megabytes": round(len(book.encode("utf-8")) / 1e6, 2),
+        "chunks": len(chunks),
+        "avg_chunk_tokens": round(sum(chunk.tokens for chunk in chunks) / len(chunks), 1) if chunks else 0.0,
+        "sections": len({chunk.section for chunk in chunks}),
+        "ms": summarize(seconds),
+        "pages_per_second": round(args.chunker_pages / best) if best else 0,
+        "generic_splitter_ms": summarize(generic_seconds),
+        "budget_ms": args.chunker_budget_ms,
+        "within_budget": best * 1000 <= args.chunker_budget_ms,
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    if not args.provider_limits:
+        for provider in ("MISTRAL", "GEMINI", "COHERE"):
+            os.environ.setdefault(f"{provider}_RPS", "0")
+            os.environ.setdefault(f"{provider}_MAX_IN_FLIGHT", "0")
+            os.environ.setdefault(f"{provider}_MAX_QUEUE", "1000000")
+
+    import httpx
+
+    import fakes
+    import main as app_module
+
+    bench = Bench(args, app_module, fakes)
+    app = app_module.app
+    resources = app_module.AppResources()
+    bench.install_fakes(resources)
+    app.state.resources = resources
+
+    report: Dict[str, Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "endpoints": {},
+    }
+    async with app_module.lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            bench.client = client
+            report["setup"] = await bench.setup()
+            print(f"Indexed {report['setup']['documents']} documents in {report['setup']['seconds']}s")
+            for name in filter(None, args.endpoints.split(",")):
+                phase = await bench.run_phase(SCENARIOS[name])
+                report["endpoints"][name] = phase
+                latency = phase["latency_ms"]
+                print(
+                    f"{name:<20} {phase['rps']:>8.1f} rps  p50 {latency.get('p50', 0):>9.1f} ms  "
+                    f"p95 {latency.get('p95', 0):>9.1f} ms  p99 {latency.get('p99', 0):>9.1f} ms  "
+                    f"lag max {phase['loop_lag_ms'].get('max', 0):>7.1f} ms  statuses {phase['statuses']}"
+                    + (f"  recall@k {phase['recall_at_k']}" if "recall_at_k" in phase else "")
+                )
+            metrics = (await client.get("/metrics")).json()
+    app.dependency_overrides.pop(app_module.get_ocr_client, None)
+
+    retrieval = metrics.get("retrieval", {})
+    report["retrieval"] = {
+        "recall_at_k": {name: phase["recall_at_k"] for name, phase in report["endpoints"].items() if "recall_at_k" in phase},
+        "modes": retrieval,
+        "embedding_cache": metrics.get("embedding_cache"),
+        "answer_cache": metrics.get("answer_cache"),
+    }
+    report["metrics"] = metrics
+    report["rss_mb"] = rss_mb()
+    return report
+
+
+def cli(argv=None) -> int:
+    args = parse_args(argv)
+    if args.chunker_pages:
+        report = bench_chunker(args)
+        print(
+            f"chunker: {report['pages']} pages ({report['megabytes']} MB) -> {report['chunks']} chunks in "
+            f"{report['ms']['p50']:.1f} ms p50, {report['ms']['max']:.1f} ms max ({report['pages_per_second']} pages/s); "
+            f"generic splitter {report['generic_splitter_ms']['p50']:.1f} ms p50"
+        )
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(report, output, indent=2)
+        if not report["within_budget"]:
+            print(f"Slower than the {args.chunker_budget_ms:.0f} ms budget", file=sys.stderr)
+            return 1
+        return 0
+    unknown = [name for name in filter(None, args.endpoints.split(",")) if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown endpoints: {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}", file=sys.stderr)
+        return 2
+    report = asyncio.run(run(args))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, default=str)
+        print(f"Report written to {args.output}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.compare} (commit {baseline['meta'].get('commit')}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
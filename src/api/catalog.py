@@ -0,0 +1,165 @@
+"""
+Catalog of indexed PDF documents.
+
+One row per source name in `pdf_documents`, written in the same transaction as
+the document's chunk rows in the vector table. Answering "is this PDF indexed?"
+is then a primary-key lookup instead of an embedding call plus a vector search.
+`document_collections` groups documents into named collections (a library, a
+course, a tag) that chat can search as a whole. `catalog_state` holds markers
+such as the backfill version, so startup skips work that is already done.
+"""
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, select, text
+
+CATALOG_TABLE_NAME = "pdf_documents"
+COLLECTIONS_TABLE_NAME = "document_collections"
+STATE_TABLE_NAME = "catalog_state"
+
+# Bump to register documents from the vector table again on the next startup
+BACKFILL_VERSION = "1"
+
+metadata = MetaData()
+
+pdf_documents = Table(
+    CATALOG_TABLE_NAME,
+    metadata,
+    Column("source_name", String(512), primary_key=True),
+    Column("content_hash", String(64), nullable=True, index=True),  # NULL for backfilled rows
+    Column("chunk_count", Integer, nullable=False),
+    Column("embedding_model", String(128), nullable=False),
+    Column("indexed_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+document_collections = Table(
+    COLLECTIONS_TABLE_NAME,
+    metadata,
+    Column("collection", String(255), primary_key=True),
+    Column("source_name", String(512), primary_key=True),
+    Column("added_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+catalog_state = Table(
+    STATE_TABLE_NAME,
+    metadata,
+    Column("name", String(64), primary_key=True),
+    Column("value", String(255), nullable=False),
+    Column("updated_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+def create_catalog(engine) -> None:
+    """Create the catalog tables if they do not exist"""
+    metadata.create_all(engine, tables=[pdf_documents, document_collections, catalog_state])
+
+
+def backfill_needed(conn) -> bool:
+    """Whether the backfill marker is missing or outdated, or the catalog is empty"""
+    marker = conn.execute(
+        select(catalog_state.c.value).where(catalog_state.c.name == "backfill_version")
+    ).scalar()
+    if marker != BACKFILL_VERSION:
+        return True
+    return conn.execute(select(pdf_documents.c.source_name).limit(1)).first() is None
+
+
+def backfill_catalog(engine, vector_table_name: str, embedding_model: str) -> int:
+    """
+    Register documents that were indexed before the catalog existed.
+    The scan of the vector table runs only while `backfill_needed`; returns the number of rows added.
+    """
+    with engine.connect() as conn:
+        if not backfill_needed(conn):
+            return 0
+    statement = text(
+        f"INSERT INTO {CATALOG_TABLE_NAME} (source_name, content_hash, chunk_count, embedding_model, indexed_at) "
+        f"SELECT JSON_UNQUOTE(JSON_EXTRACT(v.meta, '$.source')), NULL, COUNT(*), :model, MIN(v.create_time) "
+        f"FROM {vector_table_name} v "
+        f"WHERE JSON_EXTRACT(v.meta, '$.source') IS NOT NULL "
+        f"AND JSON_UNQUOTE(JSON_EXTRACT(v.meta, '$.source')) NOT IN (SELECT source_name FROM {CATALOG_TABLE_NAME}) "
+        f"GROUP BY JSON_UNQUOTE(JSON_EXTRACT(v.meta, '$.source'))"
+    )
+    with engine.begin() as conn:
+        added = conn.execute(statement, {"model": embedding_model}).rowcount
+        conn.execute(catalog_state.delete().where(catalog_state.c.name == "backfill_version"))
+        conn.execute(catalog_state.insert().values(name="backfill_version", value=BACKFILL_VERSION, updated_at=func.now()))
+        return added
+
+
+def get_document(conn, source_name: str) -> Optional[Dict[str, Any]]:
+    """Point lookup of a single document"""
+    documents = get_documents(conn, [source_name])
+    return documents.get(source_name)
+
+
+def get_documents(conn, source_names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up many documents in one query, keyed by source name"""
+    names = list(dict.fromkeys(source_names))
+    if not names:
+        return {}
+    query = select(pdf_documents).where(pdf_documents.c.source_name.in_(names))
+    rows = conn.execute(query).mappings().all()
+    return {row["source_name"]: dict(row) for row in rows}
+
+
+def lock_document(conn, source_name: str) -> None:
+    """
+    Lock the catalog row of a document until the transaction ends, so writers of the same
+    document run one after another; TiDB also locks the key of a row that does not exist yet
+    """
+    conn.execute(select(pdf_documents.c.source_name).where(pdf_documents.c.source_name == source_name).with_for_update())
+
+
+def record_document(conn, source_name: str, content_hash: str, chunk_count: int, embedding_model: str) -> None:
+    """Insert or replace the catalog row; call inside the transaction that writes the chunks"""
+    conn.execute(pdf_documents.delete().where(pdf_documents.c.source_name == source_name))
+    conn.execute(
+        pdf_documents.insert().values(
+            source_name=source_name,
+            content_hash=content_hash,
+            chunk_count=chunk_count,
+            embedding_model=embedding_model,
+            indexed_at=func.now(),
+        )
+    )
+
+
+def list_documents(conn) -> Dict[str, Dict[str, Any]]:
+    """Every catalog row, keyed by source name"""
+    rows = conn.execute(select(pdf_documents)).mappings().all()
+    return {row["source_name"]: dict(row) for row in rows}
+
+
+def collection_documents(conn, collection: str) -> List[str]:
+    """Source names of the documents in a collection"""
+    query = (
+        select(document_collections.c.source_name)
+        .where(document_collections.c.collection == collection)
+        .order_by(document_collections.c.source_name)
+    )
+    return [row.source_name for row in conn.execute(query)]
+
+
+def add_to_collection(conn, collection: str, source_names: Iterable[str]) -> None:
+    names = list(dict.fromkeys(source_names))
+    if not names:
+        return
+    # Concurrent requests may add the same document; the existing membership wins
+    conn.execute(
+        document_collections.insert().prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite"),
+        [{"collection": collection, "source_name": name} for name in names],
+    )
+
+
+def remove_from_collection(conn, collection: str, source_names: Iterable[str]) -> int:
+    names = list(dict.fromkeys(source_names))
+    if not names:
+        return 0
+    return conn.execute(
+        document_collections.delete().where(
+            document_collections.c.collection == collection,
+            document_collections.c.source_name.in_(names),
+        )
+    ).rowcount
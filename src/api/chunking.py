@@ -0,0 +1,217 @@
+"""
+Structure-aware chunking of OCR markdown for indexing.
+
+The markdown is read once, line by line, into blocks: headings, paragraphs,
+tables, LaTeX display math (`$$ ... $$`, `\\begin{env} ... \\end{env}`) and
+fenced code. Blocks are packed into chunks of at most `chunk_size` characters
+without overlap:
+
+- a heading starts a new chunk unless the current one is still shorter than
+  `min_chunk_size`, so short sections are not split off on their own
+- tables, formulas and code are never cut, unless a single block is larger than
+  a chunk: tables are then split between rows with the header row repeated,
+  paragraphs between sentences, and math and code between lines
+
+Every chunk records its heading path (`section`), the page it starts on (from
+the `<!-- page N -->` markers that `page_marker` writes between OCR pages), its
+position in the document (`ordinal`) and its estimated token count. Neighbours
+are found by ordinal, so consecutive chunks do not need to repeat each other's
+text.
+"""
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from summarization import estimate_tokens
+
+# Longest heading path stored with a chunk; it is an indexed column of the vector table
+MAX_SECTION_CHARS = 255
+SECTION_SEPARATOR = " > "
+
+_PAGE_MARKER = re.compile(r"<!-- page (\d+) -->")
+_HEADING = re.compile(r"(#{1,6})\s+(.*?)[\s#]*$")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_TABLE_RULE = re.compile(r"\|?\s*:?-{3,}")
+
+
+def page_marker(page: int) -> str:
+    """Marker written before the markdown of page `page` (1-based); invisible when rendered"""
+    return f"<!-- page {page} -->"
+
+
+@dataclass
+class Chunk:
+    text: str
+    ordinal: int
+    section: str
+    page: Optional[int]
+    tokens: int
+
+    def metadata(self) -> Dict[str, Any]:
+        """Chunk metadata stored with its row; unknown values are left out so their columns are NULL"""
+        meta: Dict[str, Any] = {"ordinal": self.ordinal, "tokens": self.tokens}
+        if self.section:
+            meta["section"] = self.section
+        if self.page is not None:
+            meta["page"] = self.page
+        return meta
+
+
+@dataclass
+class _Block:
+    text: str
+    kind: str  # heading, text, table, math or code
+    section: str
+    page: Optional[int]
+
+
+def _blocks(content: str) -> Iterator[_Block]:
+    page: Optional[int] = None
+    headings: List[str] = []
+    levels: List[int] = []
+    section = ""
+    lines: List[str] = []
+    kind = "text"
+    closing: Optional[str] = None  # end of the code fence or math block being read
+
+    for line in content.split("\n"):
+        stripped = line.strip()
+        if closing is not None:
+            lines.append(line)
+            if (stripped.startswith(closing) if kind == "code" else closing in stripped):
+                closing = None
+                yield _Block("\n".join(lines), kind, section, page)
+                lines, kind = [], "text"
+            continue
+
+        if not stripped or stripped.startswith(("<!--", "#", "```", "~~~", "$$", "\\begin{")) or (
+            (kind == "table") != stripped.startswith("|")
+        ):
+            if lines:
+                yield _Block("\n".join(lines).strip(), kind, section, page)
+                lines, kind = [], "text"
+            if not stripped:
+                continue
+            marker = _PAGE_MARKER.fullmatch(stripped)
+            if marker:
+                page = int(marker.group(1))
+                continue
+            heading = _HEADING.fullmatch(stripped) if stripped[0] == "#" else None
+            if heading:
+                level = len(heading.group(1))
+                while levels and levels[-1] >= level:
+                    levels.pop()
+                    headings.pop()
+                levels.append(level)
+                headings.append(heading.group(2))
+                section = SECTION_SEPARATOR.join(headings)[:MAX_SECTION_CHARS]
+                yield _Block(stripped, "heading", section, page)
+                continue
+            if stripped.startswith(("```", "~~~")):
+                kind, closing = "code", stripped[:3]
+            elif stripped.startswith("$$"):
+                kind = "math"
+                if len(stripped) >= 4 and stripped.endswith("$$"):
+                    yield _Block(stripped, kind, section, page)
+                    kind = "text"
+                    continue
+                closing = "$$"
+            elif stripped.startswith("\\begin{"):
+                kind = "math"
+                closing = "\\end{" + stripped[len("\\begin{"):].split("}", 1)[0] + "}"
+                if closing in stripped:
+                    yield _Block(stripped, kind, section, page)
+                    kind, closing = "text", None
+                    continue
+            elif stripped.startswith("|"):
+                kind = "table"
+        lines.append(line)
+
+    if lines:
+        yield _Block("\n".join(lines).strip(), kind, section, page)
+
+
+def _pieces(block: _Block, chunk_size: int) -> List[str]:
+    """Parts of a block larger than a chunk, each at most `chunk_size` characters where possible"""
+    if block.kind == "table":
+        rows = block.text.split("\n")
+        header = rows[:2] if len(rows) > 1 and _TABLE_RULE.match(rows[1].strip()) else rows[:1]
+        units, prefix = rows[len(header):], "\n".join(header) + "\n"
+        separator = "\n"
+    elif block.kind == "text":
+        units, prefix, separator = _SENTENCE_END.split(block.text), "", " "
+    else:
+        units, prefix, separator = block.text.split("\n"), "", "\n"
+
+    pieces: List[str] = []
+    current: List[str] = []
+    size = len(prefix)
+    for unit in units:
+        while len(prefix) + len(unit) > chunk_size:
+            # A single sentence or line longer than a chunk: cut it at a space
+            cut = unit.rfind(" ", 0, chunk_size - len(prefix))
+            cut = cut if cut > 0 else chunk_size - len(prefix)
+            if current:
+                pieces.append(prefix + separator.join(current))
+                current, size = [], len(prefix)
+            pieces.append(prefix + unit[:cut])
+            unit = unit[cut:].lstrip()
+        if current and size + len(separator) + len(unit) > chunk_size:
+            pieces.append(prefix + separator.join(current))
+            current, size = [], len(prefix)
+        current.append(unit)
+        size += len(separator) + len(unit)
+    if current:
+        pieces.append(prefix + separator.join(current))
+    return pieces
+
+
+def split_markdown(content: str, chunk_size: int = 1500, min_chunk_size: Optional[int] = None) -> List[Chunk]:
+    """Split markdown into chunks that follow its headings, tables and formulas"""
+    min_chunk_size = chunk_size // 4 if min_chunk_size is None else min_chunk_size
+    chunks: List[Chunk] = []
+    parts: List[str] = []
+    size = 0
+    section = ""
+    page: Optional[int] = None
+    body = False  # the chunk has more than headings
+
+    def emit():
+        nonlocal parts, size, body
+        if parts:
+            text = "\n\n".join(parts)
+            chunks.append(Chunk(text, len(chunks), section, page, estimate_tokens(text)))
+        parts, size, body = [], 0, False
+
+    for block in _blocks(content):
+        if block.kind == "heading" and size >= min_chunk_size:
+            emit()
+        if parts and size + 2 + len(block.text) > chunk_size:
+            emit()
+        # A chunk belongs to the section and page of its first content; leading headings only introduce it
+        if not body:
+            section, page = block.section, block.page
+            body = block.kind != "heading"
+        if len(block.text) <= chunk_size:
+            parts.append(block.text)
+            size += 2 + len(block.text) if size else len(block.text)
+            continue
+        pieces = _pieces(block, chunk_size)
+        for piece in pieces[:-1]:
+            if parts and size + 2 + len(piece) > chunk_size:
+                emit()
+                page, section, body = block.page, block.section, True
+            parts.append(piece)
+            size += 2 + len(piece) if size else len(piece)
+            emit()
+            page, section, body = block.page, block.section, True
+        parts.append(pieces[-1])
+        size += 2 + len(pieces[-1]) if size else len(pieces[-1])
+    emit()
+    return chunks
+
+
+def in_section(metadata: Dict[str, Any], section: str) -> bool:
+    """Whether a chunk lies under a heading containing `section` (case-insensitive)"""
+    return section.lower() in (metadata.get("section") or "").lower()
+
@@ -0,0 +1,208 @@
+"""
+Token-budgeted context for the chat prompt.
+
+Retrieval returns more candidate chunks than a prompt needs, plus the
+neighbours of the best ones, and the lowest-ranked candidates are often
+unrelated to the question. Chunks indexed before chunking.py repeat the
+splitter overlap (up to 200 characters) of their predecessor. `pack_context`
+walks the candidates best first and keeps each one while the estimated token
+count of the context stays within the budget:
+
+- a chunk already contained in a kept passage costs nothing and is skipped
+- a chunk that directly follows or precedes a kept passage of the same section
+  (by ordinal, or for chunks indexed without one, because its start repeats the
+  end of the other) is merged into it, without the repeated text
+- the first chunk is trimmed at a paragraph or sentence boundary when it alone
+  exceeds the budget, so the prompt always has some context
+
+Passages are returned in the order of their best-ranked chunk, so k adapts to
+the budget: many short or adjacent chunks, or a few long ones.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from langchain.schema import Document
+
+from summarization import CHARS_PER_TOKEN, estimate_tokens
+
+# Shortest shared text taken as splitter overlap rather than coincidence
+MIN_OVERLAP_CHARS = 24
+# Longest overlap looked for; the splitter overlap is 200 characters plus the separator it ends on
+MAX_OVERLAP_CHARS = 400
+# A trimmed passage shorter than this is not worth a place in the prompt
+MIN_TRIMMED_TOKENS = 32
+
+_BOUNDARY = re.compile(r"\n\n|(?<=[.!?])\s")
+
+
+def overlap_length(before: str, after: str, min_chars: int = MIN_OVERLAP_CHARS, max_chars: int = MAX_OVERLAP_CHARS) -> int:
+    """Length of the longest end of `before` that `after` starts with, or 0 below `min_chars`"""
+    if len(before) < min_chars or len(after) < min_chars:
+        return 0
+    head = after[:min_chars]
+    start = before.find(head, max(0, len(before) - max_chars))
+    while start != -1:
+        length = len(before) - start
+        if after.startswith(before[start:]) and length < len(after):
+            return length
+        start = before.find(head, start + 1)
+    return 0
+
+
+def trim_to_tokens(text: str, tokens: int) -> str:
+    """Cut text to about `tokens` tokens, at the last paragraph or sentence end when there is one"""
+    limit = max(tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    ends = [match.end() for match in _BOUNDARY.finditer(cut)]
+    if ends and ends[-1] > limit // 2:
+        cut = cut[:ends[-1]]
+    return cut.rstrip() + " …"
+
+
+@dataclass
+class _Passage:
+    source: Optional[str]
+    text: str
+    rank: int
+    chunk_hashes: List[str] = field(default_factory=list)
+    # Ordinals of the first and last chunk, for chunks indexed with their position
+    first: Optional[int] = None
+    last: Optional[int] = None
+    section: Optional[str] = None
+    page: Optional[int] = None
+
+
+def _overlap(before: _Passage, after: _Passage) -> Optional[int]:
+    """Characters `after` repeats from the end of `before` when it directly follows it, else None"""
+    if before.last is not None and after.first is not None:
+        if after.first == before.last + 1 and after.section == before.section:
+            return 0
+        return None
+    if before.last is None and after.first is None:
+        return overlap_length(before.text, after.text) or None
+    return None
+
+
+def _join(before: _Passage, after: _Passage, overlap: int) -> _Passage:
+    return _Passage(
+        source=before.source,
+        text=before.text + (after.text[overlap:] if overlap else "\n\n" + after.text),
+        rank=min(before.rank, after.rank),
+        chunk_hashes=list(dict.fromkeys(before.chunk_hashes + after.chunk_hashes)),
+        first=before.first,
+        last=after.last,
+        section=before.section,
+        page=before.page if before.page is not None else after.page,
+    )
+
+
+@dataclass
+class PackedContext:
+    passages: List[Document]
+    tokens: int  # estimated tokens of the formatted context
+    candidates: int
+    chunks_used: int
+    overlap_chars_removed: int = 0
+
+
+def pack_context(
+    docs: List[Document],
+    budget_tokens: int,
+    format_passages: Callable[[List[Document]], str],
+) -> PackedContext:
+    """
+    Pack ranked chunks (best first) into passages whose formatted context fits about
+    `budget_tokens` tokens. `format_passages` renders passages the way the prompt does,
+    so numbering and source labels are part of the count.
+    """
+    passages: List[_Passage] = []
+    used = 0
+    overlap_removed = 0
+    # Tokens of a passage's label and separator in the formatted context
+    label_tokens = estimate_tokens(format_passages([Document(page_content="", metadata=docs[0].metadata)])) + 1 if docs else 0
+    spent = 0
+
+    for rank, doc in enumerate(docs):
+        meta = doc.metadata
+        chunk_hash = meta.get("chunk_hash")
+        candidate = _Passage(
+            source=meta.get("source"),
+            text=doc.page_content.strip(),
+            rank=rank,
+            chunk_hashes=[chunk_hash] if chunk_hash else [],
+            first=meta.get("ordinal"),
+            last=meta.get("ordinal"),
+            section=meta.get("section"),
+            page=meta.get("page"),
+        )
+        same_source = [passage for passage in passages if passage.source == candidate.source]
+        if any(
+            (candidate.first is not None and passage.first is not None and passage.first <= candidate.first <= passage.last)
+            or candidate.text in passage.text
+            for passage in same_source
+        ):
+            continue
+
+        contained = [passage for passage in same_source if passage.first is None and passage.text in candidate.text]
+        rest = [passage for passage in same_source if all(passage is not other for other in contained)]
+        previous = next((passage for passage in rest if _overlap(passage, candidate) is not None), None)
+        following = next(
+            (passage for passage in rest if passage is not previous and _overlap(candidate, passage) is not None), None
+        )
+        merged = candidate
+        removed = 0
+        if previous is not None:
+            length = _overlap(previous, merged)
+            merged = _join(previous, merged, length)
+            removed += length
+        if following is not None:
+            length = _overlap(merged, following)
+            merged = _join(merged, following, length)
+            removed += length
+        absorbed = contained + [passage for passage in (previous, following) if passage is not None]
+        for passage in contained:
+            merged.rank = min(merged.rank, passage.rank)
+            merged.chunk_hashes = list(dict.fromkeys(merged.chunk_hashes + passage.chunk_hashes))
+
+        cost = estimate_tokens(merged.text) - sum(estimate_tokens(passage.text) for passage in absorbed)
+        # One label per passage: a chunk joining several passages frees all but one of theirs
+        cost += label_tokens * (1 - len(absorbed))
+        if spent + cost > budget_tokens:
+            if passages:
+                continue
+            # The best chunk alone is over the budget: keep as much of it as fits
+            merged.text = trim_to_tokens(merged.text, budget_tokens - label_tokens)
+            if estimate_tokens(merged.text) < MIN_TRIMMED_TOKENS:
+                break
+            cost = estimate_tokens(merged.text) + label_tokens
+
+        passages = [passage for passage in passages if all(passage is not other for other in absorbed)]
+        passages.append(merged)
+        spent += cost
+        used += 1
+        overlap_removed += removed
+
+    passages.sort(key=lambda passage: passage.rank)
+    documents = []
+    for passage in passages:
+        metadata = {
+            "source": passage.source,
+            # The chunk the passage was ranked by, then every chunk merged into it
+            "chunk_hash": docs[passage.rank].metadata.get("chunk_hash"),
+            "chunk_hashes": passage.chunk_hashes,
+        }
+        if passage.section:
+            metadata["section"] = passage.section
+        if passage.page is not None:
+            metadata["page"] = passage.page
+        documents.append(Document(page_content=passage.text, metadata=metadata))
+    return PackedContext(
+        passages=documents,
+        tokens=estimate_tokens(format_passages(documents)) if documents else 0,
+        candidates=len(docs),
+        chunks_used=used,
+        overlap_chars_removed=overlap_removed,
+    )
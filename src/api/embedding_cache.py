@@ -0,0 +1,282 @@
+"""
+Two-tier cache for embedding vectors.
+
+`CachedEmbeddings` wraps any LangChain `Embeddings` implementation. Lookups go
+to a bounded in-process LRU first, then to an on-disk SQLite store holding
+float32 vectors, and only the remaining misses are sent to the provider. Keys
+are (model, input type, SHA-256 of the text): Cohere embeds documents and
+queries differently, so the same text is cached separately for each.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DOCUMENT_INPUT_TYPE = "search_document"
+QUERY_INPUT_TYPE = "search_query"
+
+
+def cache_key(model: str, input_type: str, text: str) -> str:
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model}:{input_type}:{digest}"
+
+
+class CacheCounters:
+    """Hit/miss/eviction counters shared by the cache tiers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def incr(self, name: str, amount: int = 1):
+        if amount:
+            with self._lock:
+                setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class MemoryTier:
+    """
+    LRU of float32 vectors with a maximum entry age, bounded by entry count rather than bytes:
+    each entry is one vector, 4 KB for Cohere's 1024 dimensions
+    """
+
+    def __init__(self, max_items: int = 10000, max_age: Optional[float] = None):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.counters = CacheCounters()
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters.incr("misses")
+                return None
+            created, vector = entry
+            if self.max_age is not None and time.time() - created > self.max_age:
+                del self._entries[key]
+                self.counters.incr("expirations")
+                self.counters.incr("misses")
+                return None
+            self._entries.move_to_end(key)
+            self.counters.incr("hits")
+            return vector
+
+    def put(self, key: str, vector: np.ndarray, created: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (created or time.time(), vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.counters.incr("evictions")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters.snapshot(), "entries": len(self._entries)}
+
+
+class SQLiteTier:
+    """
+    On-disk store of float32 vectors in a single SQLite file.
+
+    Entries older than `max_age` are treated as misses. They are deleted at startup, by
+    writes at most every `purge_interval` seconds (a tenth of `max_age`, at most an hour),
+    and before anything else once the stored vectors exceed `max_bytes`; only then are the
+    least recently used entries evicted.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, max_age: Optional[float] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.purge_interval = min(max_age / 10, 3600.0) if max_age is not None else None
+        self._last_purge = 0.0
+        self.counters = CacheCounters()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.purge_expired()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[float, np.ndarray]]:
+        """Return {key: (created_at, vector)} for the keys that are stored and fresh"""
+        if not keys:
+            return {}
+        now = time.time()
+        found: Dict[str, Tuple[float, np.ndarray]] = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, created_at FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob, created in rows:
+                    if self.max_age is not None and now - created > self.max_age:
+                        continue
+                    found[key] = (created, np.frombuffer(blob, dtype=np.float32))
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found]
+                )
+        self.counters.incr("hits", len(found))
+        self.counters.incr("misses", len(keys) - len(found))
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, vector.astype(np.float32).tobytes(), now, now) for key, vector in items.items()]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for key, blob, created, accessed in rows:
+                previous = self._conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self._conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", (key, blob, created, accessed))
+                self._total_bytes += len(blob) - (previous[0] if previous else 0)
+            self._conn.execute("COMMIT")
+            over_budget = self._total_bytes > self.max_bytes
+            if self.purge_interval is not None and (over_budget or now - self._last_purge > self.purge_interval):
+                self._purge_expired_locked()
+            if self._total_bytes > self.max_bytes:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        # Evict down to 90% of the budget so that eviction does not run on every insert
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                if self._total_bytes <= target:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self.counters.incr("evictions", len(evicted))
+
+    def purge_expired(self):
+        if self.max_age is None:
+            return
+        with self._lock:
+            self._purge_expired_locked()
+
+    def _purge_expired_locked(self):
+        now = time.time()
+        cutoff = now - self.max_age
+        freed, count = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings WHERE created_at < ?", (cutoff,)
+        ).fetchone()
+        self._conn.execute("DELETE FROM embeddings WHERE created_at < ?", (cutoff,))
+        self._total_bytes -= freed
+        self._last_purge = now
+        self.counters.incr("expirations", count)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters.snapshot(), "bytes": self._total_bytes}
+
+
+class CachedEmbeddings(Embeddings):
+    """LangChain `Embeddings` that serves repeated texts from the memory and disk tiers"""
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model: str,
+        memory: Optional[MemoryTier] = None,
+        disk: Optional[SQLiteTier] = None,
+    ):
+        self.underlying = underlying
+        self.model = model
+        self.memory = memory if memory is not None else MemoryTier()
+        self.disk = disk
+        self._lock = threading.Lock()
+        self.provider_calls = 0
+        self.provider_texts = 0
+
+    def _lookup(self, texts: List[str], input_type: str, embed) -> List[List[float]]:
+        keys = [cache_key(self.model, input_type, text) for text in texts]
+        vectors: Dict[str, np.ndarray] = {}
+
+        for key in keys:
+            if key not in vectors:
+                vector = self.memory.get(key)
+                if vector is not None:
+                    vectors[key] = vector
+
+        if self.disk is not None:
+            pending = [key for key in dict.fromkeys(keys) if key not in vectors]
+            for key, (created, vector) in self.disk.get_many(pending).items():
+                vectors[key] = vector
+                self.memory.put(key, vector, created)
+
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            with self._lock:
+                self.provider_calls += 1
+                self.provider_texts += len(missing)
+            fresh = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(missing, embed(list(missing.values())))
+            }
+            for key, vector in fresh.items():
+                self.memory.put(key, vector)
+            if self.disk is not None:
+                self.disk.put_many(fresh)
+            vectors.update(fresh)
+
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._lookup(list(texts), DOCUMENT_INPUT_TYPE, self.underlying.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._lookup([text], QUERY_INPUT_TYPE, lambda batch: [self.underlying.embed_query(batch[0])])[0]
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+            "provider_calls": self.provider_calls,
+            "provider_texts": self.provider_texts,
+        }
@@ -0,0 +1,425 @@
+"""
+Local stand-ins for the paid providers, used by benchmark.py.
+
+Every fake sleeps for a latency drawn from a `LatencyModel` (log-normal around a
+median, plus a per-item cost) and fails with a retryable 429/503 at its error
+rate, so admission control, retries and timeouts are exercised as in production.
+Embeddings are deterministic feature-hashed bags of words: texts sharing words
+get similar vectors, which makes retrieval quality measurable. The vector store
+runs on SQLite (or any SQLAlchemy URL with VEC_COSINE_DISTANCE, e.g. a local
+TiDB) with the same table layout as TiDBVectorStore.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import typing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.language_models.llms import LLM
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, GenerationChunk
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel, Field, PrivateAttr
+from sqlalchemy import create_engine, event, select
+from tidb_vector.integrations.vector_client import _create_vector_table_model
+
+import catalog
+import indexing
+from admission import AdmittedModel, AdmissionController
+from chunking import page_marker
+from page_ocr import OCRClient, count_pages
+from telemetry import run_blocking
+
+WORD_RE = re.compile(r"\w+")
+
+
+class FakeUpstreamError(Exception):
+    """Retryable provider error, recognised by admission control through `status_code`"""
+
+    def __init__(self, provider: str, status_code: int):
+        super().__init__(f"{provider} returned HTTP {status_code} (injected)")
+        self.status_code = status_code
+
+
+@dataclass
+class LatencyModel:
+    median_ms: float = 0.0
+    sigma: float = 0.3  # spread of the log-normal; 0 gives a constant latency
+    per_item_ms: float = 0.0  # added per text embedded, page OCR'd or token streamed
+    error_rate: float = 0.0
+    seed: int = 0
+    _random: random.Random = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "LatencyModel":
+        """Parse "median_ms[:sigma[:per_item_ms[:error_rate]]]", e.g. "800:0.4:0:0.01" """
+        values = [float(part) for part in spec.split(":")] if spec else []
+        return cls(*values, seed=seed)
+
+    def delay(self, items: int = 1) -> float:
+        base = self.median_ms * math.exp(self._random.gauss(0, self.sigma)) if self.sigma else self.median_ms
+        return (base + self.per_item_ms * items) / 1000
+
+    def check(self, provider: str) -> None:
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeUpstreamError(provider, self._random.choice((429, 503)))
+
+    def sleep(self, provider: str, items: int = 1) -> None:
+        time.sleep(self.delay(items))
+        self.check(provider)
+
+    async def asleep(self, provider: str, items: int = 1) -> None:
+        await asyncio.sleep(self.delay(items))
+        self.check(provider)
+
+
+class CallCounter:
+    """Calls and items sent to a fake provider"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.items = 0
+
+    def record(self, items: int = 1) -> None:
+        with self._lock:
+            self.calls += 1
+            self.items += items
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"calls": self.calls, "items": self.items}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls = self.items = 0
+
+
+def hashed_vector(text: str, dimensions: int) -> List[float]:
+    """Unit bag-of-words vector with each word hashed to a signed dimension"""
+    vector = np.zeros(dimensions, dtype=np.float64)
+    for word in WORD_RE.findall(text.lower()):
+        digest = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+        vector[digest % dimensions] += 1.0 if digest >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    if not norm:
+        vector[0], norm = 1.0, 1.0
+    return [float(value) for value in vector / norm]
+
+
+class FakeEmbeddings(Embeddings):
+    """Stand-in for CohereEmbeddings"""
+
+    def __init__(self, dimensions: int = 256, latency: Optional[LatencyModel] = None):
+        self.dimensions = dimensions
+        self.latency = latency or LatencyModel()
+        self.counter = CallCounter()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.counter.record(len(texts))
+        self.latency.sleep("cohere", len(texts))
+        return [hashed_vector(text, self.dimensions) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def fake_answer(prompt: str) -> str:
+    """A short answer quoting the first numbered context passage of a QA prompt, if any"""
+    match = re.search(r"\[1\] \(source: [^)]*\)\n(.{0,240})", prompt, re.S)
+    quoted = " ".join(match.group(1).split()) if match else "no context"
+    return f"According to the provided context [1], {quoted}"
+
+
+class FakeLLM(LLM):
+    """Stand-in for GoogleGenerativeAI; streams the answer word by word"""
+
+    latency: LatencyModel = Field(default_factory=LatencyModel)
+    token_latency: LatencyModel = Field(default_factory=LatencyModel)
+    counter: CallCounter = Field(default_factory=CallCounter)
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        self.counter.record()
+        self.latency.sleep("gemini")
+        return fake_answer(prompt)
+
+    async def _acall(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        self.counter.record()
+        await self.latency.asleep("gemini")
+        return fake_answer(prompt)
+
+    async def _astream(self, prompt: str, stop=None, run_manager=None, **kwargs) -> AsyncIterator[GenerationChunk]:
+        self.counter.record()
+        await self.latency.asleep("gemini")
+        for word in fake_answer(prompt).split(" "):
+            await asyncio.sleep(self.token_latency.delay())
+            yield GenerationChunk(text=word + " ")
+
+
+def fake_structured(schema: Any, name: str = "value") -> Any:
+    """Placeholder value of a type: strings, numbers, lists of three and nested models"""
+    origin = typing.get_origin(schema)
+    if origin is typing.Union:
+        return fake_structured(next(arg for arg in typing.get_args(schema) if arg is not type(None)), name)
+    if origin in (list, List, Sequence):
+        (item,) = typing.get_args(schema) or (str,)
+        return [fake_structured(item, f"{name} {number}") for number in range(1, 4)]
+    if isinstance(schema, type) and issubclass(schema, BaseModel):
+        return schema.model_validate({
+            field_name: fake_structured(info.annotation, field_name)
+            for field_name, info in schema.model_fields.items()
+        })
+    if schema is bool:
+        return True
+    if schema in (int, float):
+        return schema(1)
+    return f"Synthetic {name.replace('_', ' ')}"
+
+
+class FakeChatModel(BaseChatModel):
+    """Stand-in for ChatGoogleGenerativeAI, including structured output"""
+
+    latency: LatencyModel = Field(default_factory=LatencyModel)
+    counter: CallCounter = Field(default_factory=CallCounter)
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini-chat"
+
+    def _result(self, messages) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=fake_answer(prompt)))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.counter.record()
+        self.latency.sleep("gemini")
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.counter.record()
+        await self.latency.asleep("gemini")
+        return self._result(messages)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        result = await self._agenerate(messages, stop, run_manager, **kwargs)
+        yield ChatGenerationChunk(message=AIMessageChunk(content=result.generations[0].message.content))
+
+    def with_structured_output(self, schema, **kwargs):
+        async def generate(prompt):
+            # Goes through _agenerate, so latency, errors and admission apply as for text
+            await self.ainvoke(prompt)
+            return fake_structured(schema)
+
+        return RunnableLambda(lambda prompt: fake_structured(schema), afunc=generate)
+
+
+class AdmittedFakeLLM(AdmittedModel, FakeLLM):
+    _admission: Optional[AdmissionController] = PrivateAttr(default=None)
+
+
+class AdmittedFakeChatModel(AdmittedModel, FakeChatModel):
+    _admission: Optional[AdmissionController] = PrivateAttr(default=None)
+
+
+class SyntheticCorpus:
+    """
+    Deterministic papers made of filler paragraphs with planted facts. Every fact
+    has a question whose answer is in exactly one sentence, for measuring recall.
+    """
+
+    TOPICS = ("attention", "retrieval", "optimizer", "tokenizer", "benchmark", "dataset", "decoder", "sampling")
+    PROPERTIES = ("learning rate", "batch size", "dropout", "warmup", "context length", "beam width")
+
+    def __init__(self, seed: int = 0, vocabulary: int = 2000):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.words = [
+            "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+            for _ in range(vocabulary)
+        ]
+
+    def _rng(self, *key) -> random.Random:
+        return random.Random(hashlib.sha256(repr((self.seed, *key)).encode("utf-8")).digest())
+
+    def _paragraph(self, rng: random.Random, sentences: int = 5) -> str:
+        return " ".join(
+            " ".join(rng.choice(self.words) for _ in range(rng.randint(8, 16))).capitalize() + "."
+            for _ in range(sentences)
+        )
+
+    def fact(self, name: str, number: int) -> Dict[str, str]:
+        rng = self._rng(name, "fact", number)
+        subject = f"{rng.choice(self.TOPICS)} {rng.choice(self.words)} {rng.choice(self.words)}"
+        prop = rng.choice(self.PROPERTIES)
+        value = f"{rng.randint(2, 999)}.{rng.randint(0, 99)}"
+        return {
+            "sentence": f"The {prop} of the {subject} model was set to {value}.",
+            "question": f"What was the {prop} of the {subject} model?",
+            "answer": value,
+        }
+
+    def page(self, name: str, page: int, facts_per_page: int = 1) -> str:
+        rng = self._rng(name, "page", page)
+        parts = [f"## Section {page + 1}: {rng.choice(self.TOPICS).title()}"]
+        for number in range(facts_per_page):
+            parts.append(self._paragraph(rng))
+            parts.append(self.fact(name, page * facts_per_page + number)["sentence"])
+        parts.append(self._paragraph(rng))
+        return "\n\n".join(parts)
+
+    def markdown(self, name: str, pages: int, facts_per_page: int = 1) -> str:
+        """A paper as combined OCR markdown: page markers before every page"""
+        return f"# {name}\n\n" + "\n\n".join(
+            f"{page_marker(page + 1)}\n\n{self.page(name, page, facts_per_page)}" for page in range(pages)
+        )
+
+    def book(self, name: str, pages: int) -> str:
+        """
+        A long document shaped like OCR output of a textbook, about 3 KB per page: chapters and
+        nested sections, paragraphs, and regularly a table, display math, an aligned equation or code
+        """
+        parts = [f"# {name}"]
+        for page in range(pages):
+            rng = self._rng(name, "book", page)
+            parts.append(page_marker(page + 1))
+            if page % 20 == 0:
+                parts.append(f"## Chapter {page // 20 + 1}: {rng.choice(self.TOPICS).title()}")
+            if page % 4 == 0:
+                parts.append(f"### {page // 20 + 1}.{page % 20 // 4 + 1} {rng.choice(self.PROPERTIES).title()}")
+            for _ in range(rng.randint(4, 6)):
+                parts.append(self._paragraph(rng, sentences=rng.randint(4, 6)))
+            if page % 5 == 0:
+                header = "| " + " | ".join(rng.choice(self.words) for _ in range(4)) + " |"
+                rows = [
+                    "| " + " | ".join(f"{rng.random():.3f}" for _ in range(4)) + " |"
+                    for _ in range(rng.randint(6, 30))
+                ]
+                parts.append("\n".join([header, "|---|---|---|---|"] + rows))
+            if page % 3 == 0:
+                parts.append(f"$$\n\\mathcal{{L}}_{{{page}}} = -\\sum_i y_i \\log \\hat{{y}}_i + \\lambda \\lVert \\theta \\rVert^2\n$$")
+            if page % 11 == 0:
+                parts.append("\\begin{align}\nh_t &= \\sigma(W x_t + U h_{t-1})\\\\\ny_t &= V h_t\n\\end{align}")
+            if page % 7 == 0:
+                parts.append(f"```python\nfor step in range({page}):\n    loss = model(batch)\n\n    loss.backward()\n```")
+        return "\n\n".join(parts)
+
+    def facts(self, name: str, pages: int, facts_per_page: int = 1) -> List[Dict[str, str]]:
+        return [self.fact(name, number) for number in range(pages * facts_per_page)]
+
+    @staticmethod
+    def pdf(pages: int, salt: str = "") -> bytes:
+        """A valid PDF of blank pages; `salt` makes its bytes (and content hash) unique"""
+        from pypdf import PdfWriter
+
+        writer = PdfWriter()
+        for _ in range(pages):
+            writer.add_blank_page(width=612, height=792)
+        writer.add_metadata({"/Title": salt or "benchmark"})
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        return buffer.getvalue()
+
+
+class FakeOCRClient(OCRClient):
+    """Stand-in for the Mistral OCR client, returning synthetic markdown for every page of the file"""
+
+    def __init__(self, corpus: SyntheticCorpus, latency: Optional[LatencyModel] = None):
+        self.corpus = corpus
+        self.latency = latency or LatencyModel()
+        self.counter = CallCounter()
+
+    async def ocr_pdf(self, file_path: Path, file_name: str) -> List[str]:
+        try:
+            pages = await run_blocking(count_pages, file_path)
+        except Exception:
+            pages = 1
+        self.counter.record(pages)
+        await self.latency.asleep("mistral", pages)
+        return [self.corpus.page(file_name, page) for page in range(pages)]
+
+
+def cosine_distance(left: str, right: str) -> Optional[float]:
+    """VEC_COSINE_DISTANCE for SQLite, over the "[x, y, ...]" text form of stored vectors"""
+    if left is None or right is None:
+        return None
+    a = np.asarray(json.loads(left), dtype=np.float64)
+    b = np.asarray(json.loads(right), dtype=np.float64)
+    denominator = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return 1.0 - float(a @ b) / denominator if denominator else 1.0
+
+
+class _VectorClient:
+    def __init__(self, engine, table_model):
+        self._bind = engine
+        self._table_model = table_model
+
+
+class LocalVectorStore:
+    """
+    The parts of TiDBVectorStore the API uses (`embeddings`, `tidb_vector_client._bind`,
+    `tidb_vector_client._table_model`, `asimilarity_search`) over any SQLAlchemy database.
+    """
+
+    def __init__(self, url: str, embeddings: Embeddings, dimensions: int, table_name: str = "pdf_embeddings"):
+        engine_args = {}
+        if url.startswith("sqlite"):
+            engine_args["connect_args"] = {"check_same_thread": False, "timeout": 30}
+        engine = create_engine(url, **engine_args)
+        if engine.dialect.name == "sqlite":
+            @event.listens_for(engine, "connect")
+            def register_functions(connection, _):
+                connection.create_function("VEC_COSINE_DISTANCE", 2, cosine_distance, deterministic=True)
+                connection.execute("PRAGMA journal_mode=WAL")
+
+        _, table_model = _create_vector_table_model(table_name, dimensions, None)
+        if engine.dialect.name == "sqlite":
+            # The model's update_time default uses MySQL's ON UPDATE, which SQLite cannot parse
+            with engine.begin() as conn:
+                conn.exec_driver_sql(
+                    f"CREATE TABLE IF NOT EXISTS {table_name} (id VARCHAR(36) PRIMARY KEY, embedding TEXT NOT NULL, "
+                    "document TEXT, meta JSON, create_time DATETIME DEFAULT CURRENT_TIMESTAMP, update_time DATETIME)"
+                )
+        else:
+            table_model.__table__.create(engine, checkfirst=True)
+        catalog.create_catalog(engine)
+        indexing.create_chunk_store(engine)
+        self.embeddings = embeddings
+        self.tidb_vector_client = _VectorClient(engine, table_model)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        vector = self.embeddings.embed_query(query)
+        table = self.tidb_vector_client._table_model.__table__
+        with self.tidb_vector_client._bind.connect() as conn:
+            if filter and "source" in filter:
+                rows = indexing.search_documents(conn, table, [filter["source"]], vector, per_source=k, limit=k)
+            else:
+                distance = table.c.embedding.cosine_distance(vector)
+                query = select(table.c.id, table.c.document, table.c.meta).order_by(distance).limit(k)
+                rows = [({"document": row.document, "meta": row.meta or {}}, None) for row in conn.execute(query)]
+        return [Document(page_content=row["document"], metadata=row["meta"]) for row, _ in rows]
+
+    async def asimilarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        return await run_blocking(self.similarity_search, query, k, filter)
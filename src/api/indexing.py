@@ -0,0 +1,580 @@
+"""
+Content-addressed chunk indexing.
+
+Every chunk is keyed by the SHA-256 of its normalized text plus the embedding
+model name. Vectors are stored once per key in `chunk_embeddings`, so a chunk
+that already exists anywhere in the corpus (the same paper under another name,
+or the unchanged parts of a re-OCR'd paper) is never sent to the embedding
+provider again. Re-indexing a document only embeds the chunks that are new and
+deletes the rows of chunks that disappeared. New chunks are embedded in
+provider-sized batches, several in flight on a pool shared by all requests,
+and rows are written with multi-row INSERTs in the same single transaction.
+`index_document` is `prepare_document` (compare and embed) followed by
+`write_document` (the transaction), which bulk ingestion runs as separate
+pipeline stages.
+
+Rows carry the chunk's position and structure in `meta` (see chunking.py). On
+TiDB the vector table also gets indexed generated columns for the source name,
+heading path, page, ordinal and token count of each row: a search across many
+documents is one query with an `IN` filter instead of one query per document,
+searches can be narrowed to a section, and the neighbours of a chunk are point
+lookups on (source, ordinal).
+"""
+import contextvars
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, and_, bindparam, func, literal_column, or_, select, text
+from tidb_vector.sqlalchemy import VectorType
+
+import catalog
+
+logger = logging.getLogger(__name__)
+
+CHUNK_EMBEDDINGS_TABLE_NAME = "chunk_embeddings"
+SOURCE_COLUMN = "source_name"
+
+# Generated columns of the vector table: name -> (meta key, column definition)
+CHUNK_COLUMNS = {
+    SOURCE_COLUMN: ("source", "VARCHAR(512) AS (JSON_UNQUOTE(JSON_EXTRACT(meta, '$.source'))) VIRTUAL"),
+    "section_path": ("section", "VARCHAR(255) AS (JSON_UNQUOTE(JSON_EXTRACT(meta, '$.section'))) VIRTUAL"),
+    "page_number": ("page", "INT AS (JSON_EXTRACT(meta, '$.page')) VIRTUAL"),
+    "chunk_ordinal": ("ordinal", "INT AS (JSON_EXTRACT(meta, '$.ordinal')) VIRTUAL"),
+    "token_count": ("tokens", "INT AS (JSON_EXTRACT(meta, '$.tokens')) VIRTUAL"),
+}
+CHUNK_INDEXES = {
+    f"idx_{SOURCE_COLUMN}": (SOURCE_COLUMN,),
+    "idx_source_ordinal": (SOURCE_COLUMN, "chunk_ordinal"),
+    "idx_source_section": (SOURCE_COLUMN, "section_path"),
+    "idx_source_page": (SOURCE_COLUMN, "page_number"),
+}
+
+metadata = MetaData()
+
+chunk_embeddings = Table(
+    CHUNK_EMBEDDINGS_TABLE_NAME,
+    metadata,
+    Column("chunk_hash", String(64), primary_key=True),
+    Column("embedding_model", String(128), nullable=False),
+    Column("embedding", VectorType(), nullable=False),
+    Column("create_time", DateTime, server_default=func.now()),
+)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def create_chunk_store(engine) -> None:
+    """Create the content-addressed embedding table if it does not exist"""
+    metadata.create_all(engine, tables=[chunk_embeddings])
+
+
+def ensure_chunk_columns(engine, vector_table_name: str) -> bool:
+    """
+    Add the generated chunk columns, and their indexes, to the vector table.
+    Only done on MySQL-compatible databases; returns whether the columns are available.
+    """
+    if engine.dialect.name != "mysql":
+        return False
+    with engine.begin() as conn:
+        columns = set(conn.execute(
+            text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = :table"
+            ),
+            {"table": vector_table_name},
+        ).scalars())
+        for column, (_, definition) in CHUNK_COLUMNS.items():
+            if column not in columns:
+                conn.execute(text(f"ALTER TABLE `{vector_table_name}` ADD COLUMN `{column}` {definition}"))
+                logger.info(f"Added generated column {column} to {vector_table_name}")
+        indexes = set(conn.execute(
+            text(
+                "SELECT index_name FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = :table"
+            ),
+            {"table": vector_table_name},
+        ).scalars())
+        for index, index_columns in CHUNK_INDEXES.items():
+            if index not in indexes:
+                column_list = ", ".join(f"`{column}`" for column in index_columns)
+                conn.execute(text(f"ALTER TABLE `{vector_table_name}` ADD INDEX `{index}` ({column_list})"))
+                logger.info(f"Added index {index} on {vector_table_name}")
+    return True
+
+
+def chunk_expression(vector_table, dialect_name: str, column: str, use_chunk_columns: bool = False):
+    """SQL expression for a chunk column (see CHUNK_COLUMNS) of a row of the vector table"""
+    key, definition = CHUNK_COLUMNS[column]
+    column_type = String(512) if definition.startswith("VARCHAR") else Integer()
+    if use_chunk_columns:
+        return literal_column(f"`{vector_table.name}`.`{column}`", column_type)
+    value = func.json_extract(vector_table.c.meta, f"$.{key}")
+    # MySQL returns a JSON string; SQLite already returns the unquoted value
+    return func.json_unquote(value) if dialect_name == "mysql" and isinstance(column_type, String) else value
+
+
+def source_expression(vector_table, dialect_name: str, use_chunk_columns: bool = False):
+    """SQL expression for the source name of a row of the vector table"""
+    return chunk_expression(vector_table, dialect_name, SOURCE_COLUMN, use_chunk_columns)
+
+
+def normalize_chunk(text: str) -> str:
+    """Normalize chunk text so that OCR whitespace and unicode noise do not change its key"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def chunk_key(text: str, embedding_model: str) -> str:
+    """SHA-256 of the normalized chunk text and the embedding model name"""
+    payload = f"{embedding_model}\0{normalize_chunk(text)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+@dataclass
+class IndexPlan:
+    """Difference between the chunks stored for a document and its new chunks"""
+    keep_ids: List[str] = field(default_factory=list)
+    delete_ids: List[str] = field(default_factory=list)
+    # (chunk_hash, text) of chunks that need a new row
+    insert: List[Tuple[str, str]] = field(default_factory=list)
+    # Position among the new chunks of every kept row and every insert
+    keep_positions: List[int] = field(default_factory=list)
+    insert_positions: List[int] = field(default_factory=list)
+
+
+def plan_reindex(existing_rows: Iterable[Tuple[str, str]], chunks: List[str], embedding_model: str) -> IndexPlan:
+    """
+    Compare the stored rows of a document, given as (row id, text), with its new chunks.
+    Repeated chunks are matched by multiplicity so a chunk that appears twice keeps two rows.
+    """
+    stored: Dict[str, List[str]] = {}
+    for row_id, text in existing_rows:
+        stored.setdefault(chunk_key(text, embedding_model), []).append(row_id)
+
+    plan = IndexPlan()
+    for position, text in enumerate(chunks):
+        key = chunk_key(text, embedding_model)
+        row_ids = stored.get(key)
+        if row_ids:
+            plan.keep_ids.append(row_ids.pop())
+            plan.keep_positions.append(position)
+        else:
+            plan.insert.append((key, text))
+            plan.insert_positions.append(position)
+    plan.delete_ids = [row_id for row_ids in stored.values() for row_id in row_ids]
+    return plan
+
+
+def load_document_rows(
+    conn, vector_table, source_name: str, use_chunk_columns: bool = False, for_update: bool = False
+) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """
+    Return (id, text, metadata) of every chunk row stored for a document, in document order when known.
+    `for_update` locks the rows and reads the latest committed version inside a transaction.
+    """
+    dialect = conn.dialect.name
+    query = (
+        select(vector_table.c.id, vector_table.c.document, vector_table.c.meta)
+        .where(source_expression(vector_table, dialect, use_chunk_columns) == source_name)
+        .order_by(chunk_expression(vector_table, dialect, "chunk_ordinal", use_chunk_columns))
+    )
+    if for_update:
+        query = query.with_for_update()
+    return [(row.id, row.document, row.meta or {}) for row in conn.execute(query)]
+
+
+def load_document_vectors(conn, vector_table, source_name: str, use_chunk_columns: bool = False) -> List[Dict[str, Any]]:
+    """Return id, embedding, text and metadata of every chunk row stored for a document"""
+    query = select(
+        vector_table.c.id, vector_table.c.embedding, vector_table.c.document, vector_table.c.meta
+    ).where(source_expression(vector_table, conn.dialect.name, use_chunk_columns) == source_name)
+    return [
+        {"id": row.id, "embedding": row.embedding, "document": row.document, "meta": row.meta}
+        for row in conn.execute(query)
+    ]
+
+
+def search_documents(
+    conn,
+    vector_table,
+    source_names: Sequence[str],
+    query_vector: Sequence[float],
+    per_source: int,
+    limit: int,
+    use_chunk_columns: bool = False,
+    section: Optional[str] = None,
+) -> List[Tuple[Dict[str, Any], float]]:
+    """
+    Nearest chunks of several documents in one query, as (row, cosine distance).
+    At most `per_source` rows are kept per document, so one long paper cannot fill the whole result.
+    With `section`, only chunks under a heading containing it (case-insensitive) are searched.
+    """
+    source = source_expression(vector_table, conn.dialect.name, use_chunk_columns)
+    distance = vector_table.c.embedding.cosine_distance(list(query_vector))
+    condition = source.in_(list(dict.fromkeys(source_names)))
+    if section:
+        section_path = chunk_expression(vector_table, conn.dialect.name, "section_path", use_chunk_columns)
+        condition = and_(condition, func.lower(section_path).contains(section.lower(), autoescape=True))
+    ranked = (
+        select(
+            vector_table.c.id,
+            vector_table.c.document,
+            vector_table.c.meta,
+            distance.label("distance"),
+            func.row_number().over(partition_by=source, order_by=distance).label("source_rank"),
+        )
+        .where(condition)
+        .subquery()
+    )
+    query = (
+        select(ranked.c.id, ranked.c.document, ranked.c.meta, ranked.c.distance)
+        .where(ranked.c.source_rank <= per_source)
+        .order_by(ranked.c.distance)
+        .limit(limit)
+    )
+    return [
+        ({"id": row.id, "document": row.document, "meta": row.meta or {}}, float(row.distance))
+        for row in conn.execute(query)
+    ]
+
+
+def load_neighbors(
+    conn,
+    vector_table,
+    ordinals: Dict[str, Iterable[int]],
+    use_chunk_columns: bool = False,
+) -> List[Dict[str, Any]]:
+    """Rows at the given ordinals of each document, e.g. the chunks around search hits, without a vector query"""
+    source = source_expression(vector_table, conn.dialect.name, use_chunk_columns)
+    ordinal = chunk_expression(vector_table, conn.dialect.name, "chunk_ordinal", use_chunk_columns)
+    conditions = [
+        and_(source == source_name, ordinal.in_(sorted(set(wanted))))
+        for source_name, wanted in ordinals.items()
+        if wanted
+    ]
+    if not conditions:
+        return []
+    query = select(vector_table.c.id, vector_table.c.document, vector_table.c.meta).where(or_(*conditions))
+    return [{"id": row.id, "document": row.document, "meta": row.meta or {}} for row in conn.execute(query)]
+
+
+def load_chunk_embeddings(conn, chunk_hashes: Iterable[str]) -> Dict[str, List[float]]:
+    """Return stored vectors for the given chunk keys"""
+    keys = list(dict.fromkeys(chunk_hashes))
+    if not keys:
+        return {}
+    query = select(chunk_embeddings.c.chunk_hash, chunk_embeddings.c.embedding).where(
+        chunk_embeddings.c.chunk_hash.in_(keys)
+    )
+    return {row.chunk_hash: [float(x) for x in row.embedding] for row in conn.execute(query)}
+
+
+class EmbeddingBatcher:
+    """
+    Embeds texts in batches of at most `batch_size`, with up to `concurrency` batches in flight.
+    The pool is shared by every indexing request, so simultaneous requests queue for the same
+    provider slots instead of multiplying them.
+    """
+
+    def __init__(self, batch_size: int = 96, concurrency: int = 4):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed")
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.texts = 0
+        self.in_flight = 0
+        self.batch_seconds = 0.0
+
+    def _embed_batch(self, embeddings, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            return embeddings.embed_documents(texts)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.batches += 1
+                self.texts += len(texts)
+                self.batch_seconds += time.perf_counter() - start
+
+    def embed(self, embeddings, texts: List[str]) -> List[List[float]]:
+        """Vectors of `texts` in order; fails as a whole if any batch fails"""
+        # Each batch runs in the caller's context, so provider calls are attributed to its request
+        futures = [
+            self._executor.submit(contextvars.copy_context().run, self._embed_batch, embeddings, texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        try:
+            return [vector for future in futures for vector in future.result()]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "batch_size": self.batch_size,
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "batches": self.batches,
+                "texts": self.texts,
+                "avg_batch_ms": round(1000 * self.batch_seconds / self.batches, 1) if self.batches else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def bulk_insert(conn, statement, rows: List[Dict[str, Any]], batch_rows: int = 500) -> int:
+    """Write rows with multi-row INSERT statements of at most `batch_rows` rows; returns the statement count"""
+    statements = 0
+    for start in range(0, len(rows), batch_rows):
+        conn.execute(statement.values(rows[start:start + batch_rows]))
+        statements += 1
+    return statements
+
+
+@dataclass
+class IndexResult:
+    chunks_total: int
+    chunks_created: int
+    chunks_reused: int
+    chunks_embedded: int
+    chunks_removed: int
+    embed_batches: int = 0
+    embed_seconds: float = 0.0
+    insert_seconds: float = 0.0
+    insert_statements: int = 0
+    total_seconds: float = 0.0
+    chunks_updated: int = 0
+    # Written, re-labelled (id and new meta) and deleted rows, for replicas of the vector table
+    inserted_rows: List[Dict[str, Any]] = field(default_factory=list, repr=False)
+    updated_rows: List[Dict[str, Any]] = field(default_factory=list, repr=False)
+    deleted_ids: List[str] = field(default_factory=list, repr=False)
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks_total / self.total_seconds if self.total_seconds > 0 else 0.0
+
+
+@dataclass
+class PreparedDocument:
+    """A document whose new chunks are embedded and whose row changes are computed, ready for `write_document`"""
+    source_name: str
+    content_hash: str
+    embedding_model: str
+    chunks: List[str]
+    # Row metadata of every chunk, by position
+    metas: List[Dict[str, Any]]
+    # Ids of the stored rows the changes were computed against
+    stored_ids: List[str]
+    delete_ids: List[str]
+    # Vectors of every chunk that needs a row, and the ones just embedded among them
+    vectors: Dict[str, List[float]]
+    new_vectors: Dict[str, List[float]]
+    rows: List[Dict[str, Any]]
+    updates: List[Dict[str, Any]]
+    embed_batches: int = 0
+    embed_seconds: float = 0.0
+    started: float = 0.0
+
+
+def _row_changes(
+    plan: IndexPlan,
+    stored_rows: List[Tuple[str, str, Dict[str, Any]]],
+    metas: List[Dict[str, Any]],
+    vectors: Dict[str, List[float]],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Rows to insert and metadata updates of kept rows whose chunk moved"""
+    rows = [
+        {"id": str(uuid.uuid4()), "embedding": vectors[key], "document": text, "meta": metas[position]}
+        for (key, text), position in zip(plan.insert, plan.insert_positions)
+    ]
+    stored_metas = {row_id: meta for row_id, _, meta in stored_rows}
+    updates = []
+    for row_id, position in zip(plan.keep_ids, plan.keep_positions):
+        # A kept row keeps the chunk hash it was stored under
+        meta = {**metas[position], "chunk_hash": stored_metas[row_id].get("chunk_hash") or metas[position]["chunk_hash"]}
+        if meta != stored_metas[row_id]:
+            updates.append({"row_id": row_id, "new_meta": meta})
+    return rows, updates
+
+
+def prepare_document(
+    engine,
+    vector_table,
+    embeddings,
+    embedding_model: str,
+    source_name: str,
+    content_hash: str,
+    chunks: List[str],
+    extra_metadata: Optional[Dict[str, Any]] = None,
+    batcher: Optional[EmbeddingBatcher] = None,
+    chunk_metadata: Optional[List[Dict[str, Any]]] = None,
+    use_chunk_columns: bool = False,
+) -> PreparedDocument:
+    """
+    Compare a document's chunks with its stored rows and embed the chunks that have no
+    stored vector, through `batcher` when given. Nothing is written.
+    """
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        stored_rows = load_document_rows(conn, vector_table, source_name, use_chunk_columns)
+        plan = plan_reindex([(row_id, text) for row_id, text, _ in stored_rows], chunks, embedding_model)
+        known = load_chunk_embeddings(conn, [key for key, _ in plan.insert])
+    metas = [
+        {"source": source_name, "chunk_hash": chunk_key(text, embedding_model), **(extra_metadata or {}),
+         **(chunk_metadata[position] if chunk_metadata is not None else {})}
+        for position, text in enumerate(chunks)
+    ]
+
+    # Embed each missing chunk once, even if it occurs several times in the document
+    missing: Dict[str, str] = {}
+    for key, text in plan.insert:
+        if key not in known:
+            missing.setdefault(key, text)
+    embed_started = time.perf_counter()
+    new_vectors: Dict[str, List[float]] = {}
+    embed_batches = 0
+    if missing:
+        texts = list(missing.values())
+        if batcher is not None:
+            vectors = batcher.embed(embeddings, texts)
+            embed_batches = -(-len(texts) // batcher.batch_size)
+        else:
+            vectors = embeddings.embed_documents(texts)
+            embed_batches = 1
+        new_vectors = dict(zip(missing, vectors))
+    embed_seconds = time.perf_counter() - embed_started
+
+    vectors = {**known, **new_vectors}
+    rows, updates = _row_changes(plan, stored_rows, metas, vectors)
+    return PreparedDocument(
+        source_name=source_name,
+        content_hash=content_hash,
+        embedding_model=embedding_model,
+        chunks=chunks,
+        metas=metas,
+        stored_ids=sorted(row_id for row_id, _, _ in stored_rows),
+        delete_ids=plan.delete_ids,
+        vectors=vectors,
+        new_vectors=new_vectors,
+        rows=rows,
+        updates=updates,
+        embed_batches=embed_batches,
+        embed_seconds=embed_seconds,
+        started=started,
+    )
+
+
+def write_document(
+    engine, vector_table, prepared: PreparedDocument, insert_batch_rows: int = 500, use_chunk_columns: bool = False
+) -> IndexResult:
+    """
+    Write a prepared document: row deletes, updates and inserts, new vectors and the
+    catalog entry in one transaction, so a failure leaves the previous version in place.
+
+    Writers of the same document are serialized on its catalog row. If another one changed
+    the stored rows after this document was prepared, the changes are computed again
+    against what it left, inside the transaction.
+    """
+    insert_started = time.perf_counter()
+    statements = 0
+    delete_ids, rows, updates = prepared.delete_ids, prepared.rows, prepared.updates
+    with engine.begin() as conn:
+        catalog.lock_document(conn, prepared.source_name)
+        catalog.record_document(
+            conn, prepared.source_name, prepared.content_hash, len(prepared.chunks), prepared.embedding_model
+        )
+        stored_rows = load_document_rows(conn, vector_table, prepared.source_name, use_chunk_columns, for_update=True)
+        if sorted(row_id for row_id, _, _ in stored_rows) != prepared.stored_ids:
+            logger.info(f"'{prepared.source_name}' was re-indexed concurrently; recomputing its changes")
+            plan = plan_reindex([(row_id, text) for row_id, text, _ in stored_rows], prepared.chunks, prepared.embedding_model)
+            needed = [key for key, _ in plan.insert if key not in prepared.vectors]
+            vectors = {**prepared.vectors, **load_chunk_embeddings(conn, needed)}
+            if any(key not in vectors for key in needed):
+                raise RuntimeError(f"The chunks of '{prepared.source_name}' changed while it was being indexed; index it again")
+            delete_ids = plan.delete_ids
+            rows, updates = _row_changes(plan, stored_rows, prepared.metas, vectors)
+
+        if delete_ids:
+            conn.execute(vector_table.delete().where(vector_table.c.id.in_(delete_ids)))
+        if prepared.new_vectors:
+            # Another request may have stored the same chunk concurrently; either vector is fine
+            statements += bulk_insert(
+                conn,
+                chunk_embeddings.insert().prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite"),
+                [
+                    {"chunk_hash": key, "embedding_model": prepared.embedding_model, "embedding": vector}
+                    for key, vector in prepared.new_vectors.items()
+                ],
+                insert_batch_rows,
+            )
+        if updates:
+            update = vector_table.update().where(vector_table.c.id == bindparam("row_id")).values(meta=bindparam("new_meta"))
+            for start in range(0, len(updates), insert_batch_rows):
+                conn.execute(update, updates[start:start + insert_batch_rows])
+                statements += 1
+        if rows:
+            statements += bulk_insert(conn, vector_table.insert(), rows, insert_batch_rows)
+    insert_seconds = time.perf_counter() - insert_started
+
+    total = len(prepared.chunks)
+    embedded = len(prepared.new_vectors)
+    return IndexResult(
+        chunks_total=total,
+        chunks_created=len(rows),
+        chunks_reused=total - embedded,
+        chunks_embedded=embedded,
+        chunks_removed=len(delete_ids),
+        embed_batches=prepared.embed_batches,
+        embed_seconds=prepared.embed_seconds,
+        insert_seconds=insert_seconds,
+        insert_statements=statements,
+        total_seconds=time.perf_counter() - prepared.started,
+        chunks_updated=len(updates),
+        inserted_rows=rows,
+        updated_rows=[{"id": update["row_id"], "meta": update["new_meta"]} for update in updates],
+        deleted_ids=delete_ids,
+    )
+
+
+def index_document(
+    engine,
+    vector_table,
+    embeddings,
+    embedding_model: str,
+    source_name: str,
+    content_hash: str,
+    chunks: List[str],
+    extra_metadata: Optional[Dict[str, Any]] = None,
+    batcher: Optional[EmbeddingBatcher] = None,
+    insert_batch_rows: int = 500,
+    chunk_metadata: Optional[List[Dict[str, Any]]] = None,
+    use_chunk_columns: bool = False,
+) -> IndexResult:
+    """
+    Incrementally (re-)index a document.
+
+    Only chunks with no stored vector are embedded, through `batcher` when given.
+    `chunk_metadata` (section, page, ordinal, ...) is stored per chunk; kept rows whose
+    chunk moved get their metadata rewritten. Row deletes, updates and inserts, new
+    vectors and the catalog entry are written in one transaction, so a failure leaves
+    the previous version of the document in place.
+    """
+    prepared = prepare_document(
+        engine, vector_table, embeddings, embedding_model, source_name, content_hash, chunks,
+        extra_metadata=extra_metadata, batcher=batcher, chunk_metadata=chunk_metadata,
+        use_chunk_columns=use_chunk_columns,
+    )
+    return write_document(engine, vector_table, prepared, insert_batch_rows, use_chunk_columns)
@@ -0,0 +1,248 @@
+"""
+Bulk ingestion pipeline.
+
+Pre-indexing a corpus (a course reading list of thousands of PDFs) runs every
+file through the same stages as /process-pdf and /index-pdf (hash, OCR,
+chunking, embedding, insert), but as a pipeline: each stage has its own
+workers and hands items to the next stage through a bounded queue, so OCR of
+one file overlaps embedding and inserts of others, and a slow stage applies
+backpressure instead of filling memory.
+
+Progress is checkpointed per file in a SQLite `Manifest`: an interrupted run
+resumes where it stopped, files already indexed with the same bytes are
+skipped before any provider call, and failed files are retried on the next
+run. `StageStats` keeps per-stage counts, busy time and throughput.
+
+The stage functions themselves live with the app (see `ingest_directory` in
+main.py); this module only knows about items, stages and the manifest.
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEXED = "indexed"
+UNCHANGED = "unchanged"  # already indexed under the same name with the same content
+FAILED = "failed"
+DONE_STATUSES = {INDEXED, UNCHANGED}
+
+_READ_BLOCK = 1 << 20
+_DONE = object()
+
+
+def discover_pdfs(root: Path) -> List[Tuple[Path, str]]:
+    """
+    (path, name) of every PDF under `root`, sorted. The name a PDF is indexed under is its
+    path relative to `root`, so equal file names in different folders do not collide.
+    """
+    if root.is_file():
+        return [(root, root.name)]
+    paths = sorted(path for path in root.rglob("*") if path.is_file() and path.suffix.lower() == ".pdf")
+    return [(path, path.relative_to(root).as_posix()) for path in paths]
+
+
+def file_sha256(path: Path) -> str:
+    """SHA-256 of a file's bytes, the key of its OCR cache entry"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as pdf_file:
+        for block in iter(lambda: pdf_file.read(_READ_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@dataclass
+class IngestItem:
+    """A PDF on its way through the pipeline; each stage fills in its part"""
+    path: Path
+    name: str
+    size: int = 0
+    file_hash: Optional[str] = None
+    markdown: Optional[str] = None
+    content_hash: Optional[str] = None
+    ocr_cached: bool = False
+    chunks: Optional[List[Any]] = None
+    prepared: Optional[Any] = None
+    started: float = field(default_factory=time.perf_counter)
+
+
+class Manifest:
+    """Per-file ingestion state, keyed by the name the PDF is indexed under"""
+
+    _COLUMNS = ("name", "path", "file_hash", "content_hash", "status", "chunks", "embedded", "error", "seconds", "updated_at")
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        if str(path) != ":memory:":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, path TEXT NOT NULL, file_hash TEXT, content_hash TEXT, "
+            "status TEXT NOT NULL, chunks INTEGER, embedded INTEGER, error TEXT, seconds REAL, "
+            "updated_at REAL NOT NULL)"
+        )
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM files WHERE name = ?", (name,)
+            ).fetchone()
+        return dict(zip(self._COLUMNS, row)) if row else None
+
+    def is_done(self, name: str, file_hash: str) -> bool:
+        """Whether this exact file was already indexed under `name`"""
+        entry = self.get(name)
+        return entry is not None and entry["status"] in DONE_STATUSES and entry["file_hash"] == file_hash
+
+    def record(self, item: IngestItem, status: str, chunks: Optional[int] = None, embedded: Optional[int] = None, error: Optional[str] = None) -> None:
+        values = (
+            item.name, str(item.path), item.file_hash, item.content_hash, status, chunks, embedded, error,
+            round(time.perf_counter() - item.started, 3), time.time(),
+        )
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO files ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(values))})",
+                values,
+            )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class Stage:
+    name: str
+    # Processes an item and returns it for the next stage, or None when the item is finished (skipped)
+    func: Callable[[Any], Awaitable[Optional[Any]]]
+    workers: int = 1
+    # Work done on a processed item (stages update items in place), e.g. {"chunks": 40}, reported per second
+    units: Optional[Callable[[Any], Dict[str, float]]] = None
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    processed: int = 0
+    finished: int = 0  # items that left the pipeline at this stage without an error
+    failed: int = 0
+    busy_seconds: float = 0.0
+    max_backlog: int = 0
+    units: Dict[str, float] = field(default_factory=dict)
+    first_started: Optional[float] = None
+    last_finished: Optional[float] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        active = (self.last_finished - self.first_started) if self.first_started and self.last_finished else 0.0
+        stats = {
+            "workers": self.workers,
+            "processed": self.processed,
+            "finished": self.finished,
+            "failed": self.failed,
+            "max_backlog": self.max_backlog,
+            "busy_seconds": round(self.busy_seconds, 2),
+            "avg_ms": round(1000 * self.busy_seconds / (self.processed + self.failed), 1) if self.processed + self.failed else 0.0,
+            # Over the time the stage had work, so an idle wait for upstream stages does not count
+            "items_per_second": round(self.processed / active, 2) if active > 0 else 0.0,
+        }
+        for unit, amount in self.units.items():
+            stats[unit] = round(amount, 3)
+            stats[f"{unit}_per_second"] = round(amount / active, 2) if active > 0 else 0.0
+        return stats
+
+
+class Pipeline:
+    """
+    Runs items through stages connected by bounded queues. A stage error fails only
+    that item: `on_error(stage, item, error)` is awaited and the item is dropped.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 8,
+        on_error: Optional[Callable[[str, Any, BaseException], Awaitable[None]]] = None,
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.stats = {stage.name: StageStats(stage.name, stage.workers) for stage in stages}
+        self.started: Optional[float] = None
+
+    async def _work(self, stage: Stage, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], next_stats: Optional[StageStats]):
+        stats = self.stats[stage.name]
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                return
+            started = time.perf_counter()
+            if stats.first_started is None:
+                stats.first_started = started
+            try:
+                result = await stage.func(item)
+            except Exception as e:
+                stats.failed += 1
+                logger.warning(f"{stage.name} failed for {getattr(item, 'name', item)}: {e}")
+                if self.on_error is not None:
+                    await self.on_error(stage.name, item, e)
+                continue
+            finally:
+                stats.last_finished = time.perf_counter()
+                stats.busy_seconds += stats.last_finished - started
+            stats.processed += 1
+            if stage.units is not None:
+                for unit, amount in stage.units(item).items():
+                    stats.units[unit] = stats.units.get(unit, 0) + amount
+            if result is None or outbox is None:
+                stats.finished += 1
+                continue
+            await outbox.put(result)
+            next_stats.max_backlog = max(next_stats.max_backlog, outbox.qsize())
+
+    async def run(self, items: Iterable[Any]) -> None:
+        self.started = time.perf_counter()
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(_DONE)
+
+        async def run_stage(index: int, stage: Stage):
+            last = index == len(self.stages) - 1
+            outbox = None if last else queues[index + 1]
+            next_stats = None if last else self.stats[self.stages[index + 1].name]
+            await asyncio.gather(*(self._work(stage, queues[index], outbox, next_stats) for _ in range(stage.workers)))
+            if not last:
+                # Every worker of the next stage stops once the items ahead of these markers are done
+                for _ in range(self.stages[index + 1].workers):
+                    await outbox.put(_DONE)
+
+        await asyncio.gather(feed(), *(run_stage(index, stage) for index, stage in enumerate(self.stages)))
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+    def progress(self) -> str:
+        """One line with what every stage has done so far"""
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        parts = [
+            f"{name} {stats.processed}" + (f" ({stats.failed} failed)" if stats.failed else "")
+            for name, stats in self.stats.items()
+        ]
+        return f"[{elapsed:7.1f}s] " + " | ".join(parts)
@@ -0,0 +1,447 @@
+"""
+Background job subsystem.
+
+Long-running work (OCR of large PDFs, indexing after OCR) is submitted as a job and processed by a
+fixed number of worker tasks pulling from a bounded in-process queue. Job state
+lives in a `JobStore` so clients can poll it or follow a progress stream; the
+SQLite store keeps finished jobs for a retention window. When the backlog is
+full, `submit` raises `QueueFullError` so the API can answer 429 immediately.
+
+Several queues (and worker processes) can share a store. Every queue holds a
+lease on the jobs it accepted and renews it while it runs; a job whose lease
+expired belongs to a process that is gone, and is failed by whichever queue
+notices first.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from telemetry import run_blocking
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATUSES = {SUCCEEDED, FAILED}
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the backlog is full"""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str
+    stage: Optional[str] = None
+    progress: float = 0.0
+    payload: Dict[str, Any] = field(default_factory=dict)
+    partial: Optional[Dict[str, Any]] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+    finished_at: Optional[float] = None
+    # Queue that accepted the job, and until when it is known to be alive
+    owner: Optional[str] = None
+    lease_until: Optional[float] = None
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 4),
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "finished_at": self.finished_at,
+        }
+        if include_result:
+            data["partial"] = self.partial
+            data["result"] = self.result
+        return data
+
+
+class JobStore:
+    """Job persistence interface"""
+
+    def create(self, job: Job) -> None:
+        raise NotImplementedError
+
+    def update(self, job_id: str, **fields: Any) -> Optional[Job]:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def renew_leases(self, owner: str, lease_until: float) -> None:
+        """Extend the lease of every unfinished job of `owner`"""
+        raise NotImplementedError
+
+    def fail_expired(self, now: float, error: str) -> List[str]:
+        """Fail unfinished jobs whose lease expired before `now` and return their ids"""
+        raise NotImplementedError
+
+    def find_latest(self, kind: str, field: str, value: Any) -> Optional[Job]:
+        """Most recently created job of `kind` whose payload has `field` equal to `value`"""
+        raise NotImplementedError
+
+    def purge_finished(self, older_than: float) -> List[Job]:
+        """Delete jobs that finished before `older_than` and return them"""
+        raise NotImplementedError
+
+
+class SQLiteJobStore(JobStore):
+    _JSON_FIELDS = ("payload", "partial", "result")
+    _COLUMNS = (
+        "id", "kind", "status", "stage", "progress", "payload", "partial",
+        "result", "error", "created_at", "updated_at", "finished_at", "owner", "lease_until",
+    )
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        if str(path) != ":memory:":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, stage TEXT, "
+            "progress REAL NOT NULL DEFAULT 0, payload TEXT, partial TEXT, result TEXT, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL, owner TEXT, lease_until REAL)"
+        )
+        # Stores created before job leases
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, column_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if name not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+                except sqlite3.OperationalError as e:
+                    # Another process added it first
+                    if "duplicate column" not in str(e):
+                        raise
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _row_to_job(self, row) -> Job:
+        values = dict(zip(self._COLUMNS, row))
+        for name in self._JSON_FIELDS:
+            values[name] = json.loads(values[name]) if values[name] is not None else None
+        values["payload"] = values["payload"] or {}
+        return Job(**values)
+
+    def create(self, job: Job) -> None:
+        values = [getattr(job, name) for name in self._COLUMNS]
+        for index, name in enumerate(self._COLUMNS):
+            if name in self._JSON_FIELDS and values[index] is not None:
+                values[index] = json.dumps(values[index])
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(self._COLUMNS)}) VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                values,
+            )
+
+    def update(self, job_id: str, **fields: Any) -> Optional[Job]:
+        fields["updated_at"] = time.time()
+        assignments = []
+        values = []
+        for name, value in fields.items():
+            if name not in self._COLUMNS or name == "id":
+                raise ValueError(f"Unknown job field: {name}")
+            assignments.append(f"{name} = ?")
+            values.append(json.dumps(value) if name in self._JSON_FIELDS and value is not None else value)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {', '.join(assignments)} WHERE id = ?", (*values, job_id))
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def renew_leases(self, owner: str, lease_until: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)",
+                (lease_until, owner, QUEUED, RUNNING),
+            )
+
+    def fail_expired(self, now: float, error: str) -> List[str]:
+        expired = "status IN (?, ?) AND (lease_until IS NULL OR lease_until < ?)"
+        with self._lock:
+            # One write transaction, so a lease renewed meanwhile by another process is not overruled
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job_ids = [
+                    row[0] for row in self._conn.execute(f"SELECT id FROM jobs WHERE {expired}", (QUEUED, RUNNING, now))
+                ]
+                self._conn.execute(
+                    f"UPDATE jobs SET status = ?, error = ?, updated_at = ?, finished_at = ? WHERE {expired}",
+                    (FAILED, error, now, now, QUEUED, RUNNING, now),
+                )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return job_ids
+
+    def find_latest(self, kind: str, field: str, value: Any) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE kind = ? AND json_extract(payload, ?) = ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (kind, f"$.{field}", value),
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def purge_finished(self, older_than: float) -> List[Job]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (older_than,),
+            ).fetchall()
+            self._conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (older_than,))
+        return [self._row_to_job(row) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobContext:
+    """Handed to job handlers to report progress and partial results"""
+
+    def __init__(self, queue: "JobQueue", job: Job):
+        self._queue = queue
+        self.job = job
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        return self.job.payload
+
+    async def report(self, stage: str, progress: Optional[float] = None, partial: Optional[Dict[str, Any]] = None):
+        fields: Dict[str, Any] = {"stage": stage}
+        if progress is not None:
+            fields["progress"] = max(0.0, min(progress, 1.0))
+        if partial is not None:
+            fields["partial"] = partial
+        await self._queue._update(self.job.id, **fields)
+
+
+JobHandler = Callable[[JobContext], Awaitable[Dict[str, Any]]]
+
+
+class JobQueue:
+    """
+    Bounded queue served by `concurrency` worker tasks.
+
+    Handlers are registered per job kind and return the job result as a JSON-serializable dict.
+    `cleanup` is called with each job once it is purged after the retention window.
+    The queue renews the lease of its jobs every third of `lease` seconds.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        concurrency: int = 2,
+        max_backlog: int = 32,
+        retention: float = 24 * 3600,
+        cleanup: Optional[Callable[[Job], None]] = None,
+        lease: float = 60.0,
+    ):
+        self.store = store
+        self.concurrency = concurrency
+        self.max_backlog = max_backlog
+        self.retention = retention
+        self.cleanup = cleanup
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers: Dict[str, JobHandler] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._janitor: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._changed: Dict[str, asyncio.Event] = {}
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_backlog)
+        await self._fail_expired()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{index}")
+            for index in range(self.concurrency)
+        ]
+        self._janitor = asyncio.create_task(self._purge_loop(), name="job-janitor")
+        self._heartbeat = asyncio.create_task(self._lease_loop(), name="job-leases")
+
+    async def stop(self) -> None:
+        tasks = [*self._workers, *(task for task in (self._janitor, self._heartbeat) if task)]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._janitor = None
+        self._heartbeat = None
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, kind: str, payload: Dict[str, Any]) -> Job:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        if self._queue is None:
+            raise RuntimeError("Job queue is not running")
+        if self._queue.full():
+            self.rejected += 1
+            raise QueueFullError(f"Job backlog is full ({self.max_backlog} queued jobs)")
+        now = time.time()
+        job = Job(
+            id=uuid.uuid4().hex, kind=kind, status=QUEUED, payload=payload, created_at=now, updated_at=now,
+            owner=self.owner, lease_until=now + self.lease,
+        )
+        await run_blocking(self.store.create, job)
+        self._queue.put_nowait(job.id)
+        self.submitted += 1
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        return await run_blocking(self.store.get, job_id)
+
+    async def find_latest(self, kind: str, field: str, value: Any) -> Optional[Job]:
+        return await run_blocking(self.store.find_latest, kind, field, value)
+
+    async def watch(self, job_id: str, heartbeat: float = 15.0) -> AsyncIterator[Job]:
+        """
+        Yield the job whenever it changes, and at least every `heartbeat` seconds,
+        until it reaches a terminal status.
+        """
+        while True:
+            # Subscribe before reading so a change between the read and the wait is not missed
+            changed = self._changed.setdefault(job_id, asyncio.Event())
+            job = await self.get(job_id)
+            if job is None:
+                return
+            yield job
+            if job.status in TERMINAL_STATUSES:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _update(self, job_id: str, **fields: Any) -> None:
+        await run_blocking(self.store.update, job_id, **fields)
+        # Wake up every watcher and give the next change a fresh event
+        changed = self._changed.pop(job_id, None)
+        if changed is not None:
+            changed.set()
+
+    async def _finish(self, job_id: str, status: str, **fields: Any) -> None:
+        await self._update(job_id, status=status, finished_at=time.time(), **fields)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A store error (locked or full disk) must not stop this worker: the queue would stop draining
+                logger.warning(f"Job {job_id} could not be processed: {e}")
+                self.failed += 1
+                try:
+                    await self._finish(job_id, FAILED, error=f"Job bookkeeping failed: {e}")
+                except Exception as finish_error:
+                    logger.warning(f"Could not mark job {job_id} as failed: {finish_error}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        job = await self.get(job_id)
+        # Purged, or failed while its lease had lapsed
+        if job is None or job.status in TERMINAL_STATUSES:
+            return
+        await self._update(job_id, status=RUNNING, stage="started")
+        try:
+            result = await self._handlers[job.kind](JobContext(self, job))
+        except asyncio.CancelledError:
+            try:
+                await self._finish(job_id, FAILED, error="Cancelled during shutdown")
+            except Exception as e:
+                logger.warning(f"Could not mark job {job_id} as cancelled: {e}")
+            raise
+        except Exception as e:
+            logger.warning(f"Job {job_id} ({job.kind}) failed: {e}")
+            await self._finish(job_id, FAILED, error=str(e))
+            self.failed += 1
+            return
+        await self._finish(job_id, SUCCEEDED, stage="done", progress=1.0, result=result)
+        self.completed += 1
+
+    async def _fail_expired(self) -> None:
+        # Jobs of a process that stopped renewing their lease cannot be resumed: their worker state is gone
+        job_ids = await run_blocking(
+            self.store.fail_expired, time.time(), "Interrupted: the server running it stopped"
+        )
+        for job_id in job_ids:
+            changed = self._changed.pop(job_id, None)
+            if changed is not None:
+                changed.set()
+
+    async def _lease_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await run_blocking(self.store.renew_leases, self.owner, time.time() + self.lease)
+                await self._fail_expired()
+            except Exception as e:
+                logger.warning(f"Renewing job leases failed: {e}")
+
+    async def _purge_loop(self) -> None:
+        interval = max(min(self.retention / 4, 3600), 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                purged = await run_blocking(self.store.purge_finished, time.time() - self.retention)
+                for job in purged:
+                    self._changed.pop(job.id, None)
+                    if self.cleanup is not None:
+                        self.cleanup(job)
+            except Exception as e:
+                logger.warning(f"Purging finished jobs failed: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "backlog": self.backlog,
+            "max_backlog": self.max_backlog,
+            "workers": self.concurrency,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,259 @@
+"""
+Per-document BM25 inverted index.
+
+Each indexed PDF gets a small directory of NumPy arrays holding a CSR posting
+list (term -> chunk ids and term frequencies) plus a JSON file with the
+vocabulary, the chunk texts and their metadata (section, page, ordinal). Arrays are opened memory-mapped, so an index
+costs page cache rather than heap and many documents can stay open.
+
+`reciprocal_rank_fusion` merges the BM25 ranking with the vector ranking, and
+`LexicalHits.confidence` with `LexicalHits.evidence` tell whether the lexical
+ranking alone is strong enough to answer without embedding the question: the
+confidence is relative, so a chunk matching the only term of a generic question
+("What are the results?") scores high, while the evidence (summed IDF of the
+query terms the best chunk contains) stays low unless rare terms matched. `rank_texts` scores a handful
+of candidate chunks in memory, for reranking results that span documents.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# Words carrying a single letter or digit are kept: variables, equation numbers and versions matter here
+_TOKEN = re.compile(r"\w+(?:[-.]\w+)*", re.UNICODE)
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from had has have how in into is it its of on or "
+    "that the their there these this those to was were what when where which who why will with "
+    "about paper they we our you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        # Also index the parts of compound terms so "bert-base" matches "bert"
+        if "-" in token or "." in token:
+            tokens.extend(part for part in re.split(r"[-.]", token) if part and part not in STOPWORDS)
+    return tokens
+
+
+@dataclass
+class LexicalHits:
+    chunk_ids: List[int]
+    scores: List[float]
+    # Best score relative to a chunk of average length containing every query term once; 0..1
+    confidence: float
+    # Summed IDF of the distinct query terms the best chunk contains
+    evidence: float = 0.0
+
+
+class BM25Index:
+    """Read-only BM25 index of one document, backed by memory-mapped arrays"""
+
+    def __init__(self, directory: Path, k1: float = 1.2, b: float = 0.75):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        with open(directory / "meta.json", encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+        self.content_hash: str = meta["content_hash"]
+        self.vocabulary: Dict[str, int] = meta["vocabulary"]
+        self.chunks: List[str] = meta["chunks"]
+        self.chunk_hashes: List[Optional[str]] = meta["chunk_hashes"]
+        # Indexes written before chunks had metadata have none
+        self.chunk_metas: List[Dict[str, Any]] = meta.get("chunk_metas") or [{} for _ in self.chunks]
+        self.avg_length: float = meta["avg_length"]
+        self.term_offsets = np.load(directory / "term_offsets.npy", mmap_mode="r")
+        self.postings = np.load(directory / "postings.npy", mmap_mode="r")
+        self.frequencies = np.load(directory / "frequencies.npy", mmap_mode="r")
+        self.lengths = np.load(directory / "lengths.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def idf(self, document_frequency: int) -> float:
+        n = len(self.chunks)
+        return math.log(1 + (n - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def search(self, query: str, k: int = 20) -> LexicalHits:
+        terms = Counter(tokenize(query))
+        if not terms or not self.chunks:
+            return LexicalHits([], [], 0.0)
+
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * np.asarray(self.lengths, dtype=np.float32) / self.avg_length)
+        best_possible = 0.0
+        term_postings = []
+        for term, count in terms.items():
+            term_id = self.vocabulary.get(term)
+            # An unknown term still counts against the confidence of the match
+            if term_id is None:
+                best_possible += count * self.idf(0)
+                continue
+            start, end = int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])
+            chunk_ids = np.asarray(self.postings[start:end])
+            tf = np.asarray(self.frequencies[start:end], dtype=np.float32)
+            idf = self.idf(end - start)
+            scores[chunk_ids] += count * idf * tf * (self.k1 + 1) / (tf + norm[chunk_ids])
+            best_possible += count * idf
+            term_postings.append((chunk_ids, idf))
+
+        matched = np.flatnonzero(scores)
+        if matched.size == 0:
+            return LexicalHits([], [], 0.0)
+        top = matched[np.argsort(-scores[matched], kind="stable")[:k]]
+        # Posting lists are sorted by chunk id
+        evidence = sum(
+            idf for chunk_ids, idf in term_postings
+            if (position := np.searchsorted(chunk_ids, top[0])) < len(chunk_ids) and chunk_ids[position] == top[0]
+        )
+        return LexicalHits(
+            chunk_ids=top.tolist(),
+            scores=scores[top].tolist(),
+            confidence=min(float(scores[top[0]] / best_possible), 1.0) if best_possible else 0.0,
+            evidence=float(evidence),
+        )
+
+
+def write_index(
+    directory: Path,
+    content_hash: str,
+    chunks: Sequence[str],
+    chunk_hashes: Optional[Sequence[str]] = None,
+    chunk_metas: Optional[Sequence[Dict[str, Any]]] = None,
+) -> None:
+    """Build the BM25 arrays for the chunks of a document and write them to `directory`"""
+    vocabulary: Dict[str, int] = {}
+    term_ids: List[int] = []
+    chunk_ids: List[int] = []
+    frequencies: List[int] = []
+    lengths = np.zeros(len(chunks), dtype=np.int32)
+    for chunk_id, text in enumerate(chunks):
+        counts = Counter(tokenize(text))
+        lengths[chunk_id] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            chunk_ids.append(chunk_id)
+            frequencies.append(tf)
+
+    # Group the (term, chunk, tf) triples by term; the stable sort keeps chunk ids ascending in each list
+    order = np.argsort(np.asarray(term_ids, dtype=np.int32), kind="stable")
+    term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(np.asarray(term_ids, dtype=np.int64), minlength=len(vocabulary)), out=term_offsets[1:])
+    postings = np.asarray(chunk_ids, dtype=np.int32)[order]
+    frequencies = np.minimum(np.asarray(frequencies, dtype=np.int64)[order], np.iinfo(np.uint16).max).astype(np.uint16)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    np.save(directory / "term_offsets.npy", term_offsets)
+    np.save(directory / "postings.npy", postings)
+    np.save(directory / "frequencies.npy", frequencies)
+    np.save(directory / "lengths.npy", lengths)
+    with open(directory / "meta.json", "w", encoding="utf-8") as meta_file:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "content_hash": content_hash,
+            "vocabulary": vocabulary,
+            "chunks": list(chunks),
+            "chunk_hashes": list(chunk_hashes) if chunk_hashes is not None else [None] * len(chunks),
+            "chunk_metas": list(chunk_metas) if chunk_metas is not None else [{} for _ in chunks],
+            "avg_length": float(lengths.mean()) if len(chunks) and lengths.mean() > 0 else 1.0,
+        }, meta_file)
+
+
+class LexicalIndexStore:
+    """
+    Directory of per-document BM25 indexes with a bounded set of open indexes.
+    Rebuilding a document swaps its directory in place; readers holding the old one keep working.
+    """
+
+    def __init__(self, root: str, max_open: int = 64):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._open: "OrderedDict[str, BM25Index]" = OrderedDict()
+
+    def _directory(self, source_name: str) -> Path:
+        return self.root / hashlib.sha256(source_name.encode("utf-8")).hexdigest()[:32]
+
+    def build(
+        self,
+        source_name: str,
+        content_hash: str,
+        chunks: Sequence[str],
+        chunk_hashes: Optional[Sequence[str]] = None,
+        chunk_metas: Optional[Sequence[Dict[str, Any]]] = None,
+    ) -> None:
+        target = self._directory(source_name)
+        staging = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+        write_index(staging, content_hash, chunks, chunk_hashes, chunk_metas)
+        retired = target.with_name(f"{target.name}.{uuid.uuid4().hex}.old")
+        with self._lock:
+            if target.exists():
+                os.replace(target, retired)
+            os.replace(staging, target)
+            self._open.pop(source_name, None)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def get(self, source_name: str) -> Optional[BM25Index]:
+        with self._lock:
+            index = self._open.get(source_name)
+            if index is not None:
+                self._open.move_to_end(source_name)
+                return index
+            directory = self._directory(source_name)
+            if not (directory / "meta.json").exists():
+                return None
+            index = BM25Index(directory)
+            self._open[source_name] = index
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+            return index
+
+    def content_hash(self, source_name: str) -> Optional[str]:
+        index = self.get(source_name)
+        return index.content_hash if index is not None else None
+
+
+def rank_texts(query: str, texts: Sequence[str], k1: float = 1.2, b: float = 0.75) -> List[int]:
+    """Positions of the texts that share a term with the query, best BM25 match first"""
+    terms = Counter(tokenize(query))
+    if not terms or not texts:
+        return []
+    counts = [Counter(tokenize(text)) for text in texts]
+    lengths = np.asarray([sum(c.values()) for c in counts], dtype=np.float32)
+    norm = k1 * (1 - b + b * lengths / (lengths.mean() or 1.0))
+    scores = np.zeros(len(texts), dtype=np.float32)
+    for term, count in terms.items():
+        tf = np.asarray([c.get(term, 0) for c in counts], dtype=np.float32)
+        document_frequency = int(np.count_nonzero(tf))
+        if not document_frequency:
+            continue
+        idf = math.log(1 + (len(texts) - document_frequency + 0.5) / (document_frequency + 0.5))
+        scores += count * idf * tf * (k1 + 1) / (tf + norm)
+    matched = np.flatnonzero(scores)
+    return matched[np.argsort(-scores[matched], kind="stable")].tolist()
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[Hashable]], k: int = 60) -> List[Hashable]:
+    """Merge several rankings of the same items; each item scores sum(1 / (k + rank))"""
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item: scores[item], reverse=True)
@@ -0,0 +1,67 @@
+"""
+Event loop lag monitor.
+
+A background task sleeps for a fixed interval and measures how late it wakes
+up. Any delay beyond the interval is time during which the loop could not run
+callbacks, typically because a synchronous call blocked it. Delays above the
+threshold are logged.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.25, threshold: float = 0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self._task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.blocked_count = 0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(), name="loop-lag-monitor")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(time.perf_counter() - start - self.interval)
+
+    def record(self, lag: float):
+        lag = max(lag, 0.0)
+        with self._lock:
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.blocked_count += 1
+        if lag >= self.threshold:
+            logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "samples": self.samples,
+                "blocked_count": self.blocked_count,
+                "max_lag_ms": round(self.max_lag * 1000, 3),
+                "mean_lag_ms": round(self.total_lag / self.samples * 1000, 3) if self.samples else 0.0,
+                "threshold_ms": self.threshold * 1000,
+            }
@@ -1,37 +1,90 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Body, Header
-from fastapi.responses import JSONResponse, HTMLResponse,HTMLResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Body, Header, Request, Response
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from mistralai import Mistral
-from mistralai import DocumentURLChunk, OCRResponse
 from pathlib import Path
 import json
 import os
-from typing import Optional, Dict, Any, List
+import sys
+import argparse
+from typing import Optional, Dict, Any, List, Literal, Callable, Awaitable, Set
 import asyncio
 import tempfile
-import shutil
 import uvicorn
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 import uuid
 from datetime import datetime
 import hashlib
+import logging
+import threading
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.embeddings import Embeddings
 
 
-from langchain_text_splitters import MarkdownTextSplitter
-from langchain_cohere import CohereEmbeddings
+from langchain_cohere import CohereEmbeddings, CohereRerank
 from langchain_community.vectorstores import TiDBVectorStore
 from langchain_google_genai import GoogleGenerativeAI
 from langchain.schema import Document
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+
+import catalog
+import indexing
+import ingest
+from embedding_cache import CachedEmbeddings, MemoryTier, SQLiteTier
+from loop_monitor import LoopLagMonitor
+from result_cache import ResultCache, create_backend, hash_text, make_key
+from ocr_cache import OCRCache
+from lexical_index import LexicalIndexStore, rank_texts, reciprocal_rank_fusion
+from vector_index import LocalVectorBackend, LocalVectorIndex, TiDBVectorBackend, VectorBackend, version_of
+from answer_cache import SemanticAnswerCache, answer_scope
+from chunking import Chunk, in_section, page_marker, split_markdown
+from context_packing import PackedContext, pack_context
+from summarization import StageTimer, estimate_tokens, map_reduce_prompt_version, reduce_sections, summarize_sections
+from page_ocr import AdmittedOCRClient, MistralOCRClient, OCRClient, ocr_document
+from admission import (
+    CURRENT_ENDPOINT,
+    AdmissionController,
+    AdmittedChatGoogleGenerativeAI,
+    AdmittedEmbeddings,
+    AdmittedGoogleGenerativeAI,
+    ProviderLimits,
+    RetryPolicy,
+    admitted,
+    find_rejection,
+    parse_endpoint_waits,
+)
+from telemetry import (
+    CURRENT_TRACE,
+    HTTP_BYTES,
+    HTTP_SECONDS,
+    PAYLOAD_BYTES,
+    REGISTRY,
+    SamplingProfiler,
+    Trace,
+    TraceBuffer,
+    record_span,
+    record_tokens,
+    run_blocking,
+    span,
+    start_trace,
+)
+from jobs import JobContext, JobQueue, QueueFullError, SQLiteJobStore, TERMINAL_STATUSES, FAILED, QUEUED, RUNNING, SUCCEEDED
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 
 # TiDB Connection Parameters
@@ -48,6 +101,12 @@ TIDB_CONNECTION_PARAMS = {
 # Default table name for vector store
 DEFAULT_TABLE_NAME = "pdf_embeddings"
 
+# Embedding model used for every indexed chunk, recorded in the document catalog
+EMBEDDING_MODEL = "embed-english-v3.0"
+
+# Gemini model used by the generation endpoints
+GENERATION_MODEL = "gemini-2.5-flash"
+
 # connection string for TiDB
 def create_connection_string(params):
     """Create a connection string for TiDBVectorStore"""
@@ -65,15 +124,642 @@ def create_connection_string(params):
     
     return base_url
 
+# Connection pool settings for the shared TiDB engine
+TIDB_POOL_SETTINGS = {
+    "pool_size": int(os.getenv("TIDB_POOL_SIZE", 5)),
+    "max_overflow": int(os.getenv("TIDB_POOL_MAX_OVERFLOW", 10)),
+    "pool_timeout": float(os.getenv("TIDB_POOL_TIMEOUT", 30)),  # seconds to wait for a free connection
+    "pool_recycle": int(os.getenv("TIDB_POOL_RECYCLE", 300)),  # TiDB Serverless drops idle connections
+    "pool_pre_ping": True,
+}
+TIDB_CONNECT_TIMEOUT = int(os.getenv("TIDB_CONNECT_TIMEOUT", 10))
+
+# Embedding cache settings; set EMBEDDING_CACHE_PATH to an empty string to disable the disk tier
+EMBEDDING_CACHE_SETTINGS = {
+    "memory_items": int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", 10000)),  # vectors, not bytes
+    "memory_max_age": float(os.getenv("EMBEDDING_CACHE_MEMORY_MAX_AGE", 24 * 3600)),
+    "disk_path": os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3"),
+    "disk_max_bytes": int(os.getenv("EMBEDDING_CACHE_DISK_MAX_MB", 512)) * 1024 * 1024,
+    "disk_max_age": float(os.getenv("EMBEDDING_CACHE_DISK_MAX_AGE", 30 * 24 * 3600)),
+}
+
+# Generation result cache: backend is memory, disk or redis (any Redis-protocol server)
+RESULT_CACHE_SETTINGS = {
+    "backend": os.getenv("RESULT_CACHE_BACKEND", "memory"),
+    "ttl": float(os.getenv("RESULT_CACHE_TTL", 7 * 24 * 3600)),
+    "max_items": int(os.getenv("RESULT_CACHE_MAX_ITEMS", 1000)),
+    "path": os.getenv("RESULT_CACHE_PATH", ".cache/results.sqlite3"),
+    "url": os.getenv("RESULT_CACHE_URL"),
+}
+
+# OCR results keyed by the SHA-256 of the PDF bytes and the OCR model
+OCR_MODEL = "mistral-ocr-latest"
+OCR_CACHE_SETTINGS = {
+    "path": os.getenv("OCR_CACHE_PATH", ".cache/ocr.sqlite3"),
+    "max_bytes": int(os.getenv("OCR_CACHE_MAX_MB", 256)) * 1024 * 1024,
+}
+
+# Large PDFs are split into page ranges that are OCR'd concurrently
+OCR_SETTINGS = {
+    "pages_per_range": int(os.getenv("OCR_PAGES_PER_RANGE", 16)),
+    "concurrency": int(os.getenv("OCR_CONCURRENCY", 4)),
+    "retry": RetryPolicy(
+        attempts=int(os.getenv("OCR_MAX_ATTEMPTS", 3)),
+        backoff=float(os.getenv("OCR_RETRY_BACKOFF", 1.0)),
+    ),
+}
+
+# Papers above `map_reduce_tokens` are summarized section by section, then reduced
+SUMMARY_SETTINGS = {
+    "map_reduce_tokens": int(os.getenv("SUMMARY_MAP_REDUCE_TOKENS", 60000)),
+    "section_tokens": int(os.getenv("SUMMARY_SECTION_TOKENS", 8000)),
+    "concurrency": int(os.getenv("SUMMARY_MAP_CONCURRENCY", 8)),
+}
+
+# Indexing pipeline: chunk size in characters, embedding batches sized to the provider limit
+# (96 texts for Cohere), batches in flight across all /index-pdf requests, and rows per multi-row INSERT
+INDEXING_SETTINGS = {
+    "chunk_size": int(os.getenv("CHUNK_SIZE", 1500)),
+    "embed_batch_size": int(os.getenv("EMBED_BATCH_SIZE", 96)),
+    "embed_concurrency": int(os.getenv("EMBED_CONCURRENCY", 4)),
+    "insert_batch_rows": int(os.getenv("INSERT_BATCH_ROWS", 500)),
+}
+
+# Hybrid BM25 + vector retrieval for chat
+RETRIEVAL_SETTINGS = {
+    "top_k": int(os.getenv("CHAT_TOP_K", 5)),
+    "candidates": int(os.getenv("HYBRID_CANDIDATES", 20)),
+    "rrf_k": int(os.getenv("RRF_K", 60)),
+    # Answer from BM25 alone when its best match reaches this share of the best possible score and the
+    # query terms it contains are rare enough: their IDFs add up to lexical_min_evidence (a term in 1% of
+    # the chunks weighs about 4.2, one in half of them 0.7); 0 disables the fast path
+    "lexical_fast_path": float(os.getenv("LEXICAL_FAST_PATH_SCORE", 0.75)),
+    "lexical_min_evidence": float(os.getenv("LEXICAL_FAST_PATH_MIN_IDF", 6.0)),
+    "index_path": os.getenv("LEXICAL_INDEX_PATH", ".cache/lexical"),
+    "max_open": int(os.getenv("LEXICAL_INDEX_MAX_OPEN", 64)),
+    # Chat across several documents: chunks in the answer, and at most this many from any one document
+    "multi_top_k": int(os.getenv("CHAT_MULTI_TOP_K", 8)),
+    "per_document": int(os.getenv("CHAT_PER_DOCUMENT_CHUNKS", 3)),
+    "max_documents": int(os.getenv("CHAT_MAX_DOCUMENTS", 500)),
+    # Cohere rerank model for multi-document results; empty reranks with BM25 over the candidates
+    "rerank_model": os.getenv("RERANK_MODEL", ""),
+    # Context packing: estimated token budget of the retrieved context in the prompt, for one PDF and for
+    # several, filled from this many candidates with overlap removed and neighbouring chunks merged;
+    # 0 sends the top_k chunks as they are
+    "context_tokens": int(os.getenv("CHAT_CONTEXT_TOKENS", 1500)),
+    "multi_context_tokens": int(os.getenv("CHAT_MULTI_CONTEXT_TOKENS", 2400)),
+    "pack_candidates": int(os.getenv("CHAT_PACK_CANDIDATES", 12)),
+    # Chunks on either side of each of the best `neighbor_hits` hits added to the candidates, by ordinal
+    "neighbor_hits": int(os.getenv("CHAT_NEIGHBOR_HITS", 3)),
+    "neighbor_window": int(os.getenv("CHAT_NEIGHBOR_WINDOW", 1)),
+}
+
+# Semantic cache of chat answers: a paraphrase of an answered question about the same
+# PDFs and index versions is answered from the cache when cosine similarity >= threshold
+ANSWER_CACHE_SETTINGS = {
+    "enabled": os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"),
+    "threshold": float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+    "max_entries": int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 5000)),
+}
+
+# Vector search backend: tidb searches in TiDB; local keeps a per-process replica of the vector table
+# in memory-mapped files under path/pid-<pid> (HNSW above exact_max_rows, if hnswlib is installed)
+VECTOR_SETTINGS = {
+    "backend": os.getenv("VECTOR_BACKEND", "tidb"),
+    "path": os.getenv("VECTOR_REPLICA_PATH", ".cache/vectors"),
+    "refresh_interval": float(os.getenv("VECTOR_REPLICA_REFRESH", 60)),
+    "exact_max_rows": int(os.getenv("VECTOR_EXACT_MAX_ROWS", 20000)),
+    "hnsw_m": int(os.getenv("HNSW_M", 16)),
+    "hnsw_ef_construction": int(os.getenv("HNSW_EF_CONSTRUCTION", 200)),
+    "hnsw_ef_search": int(os.getenv("HNSW_EF_SEARCH", 64)),
+}
+
+# Admission control per upstream provider: <PROVIDER>_RPS and _BURST (token bucket),
+# _MAX_IN_FLIGHT, _MAX_QUEUE (callers waiting) and _MAX_WAIT (seconds before a 429/503)
+def provider_limits(provider: str, rate: float, max_in_flight: int, max_queue: int, max_wait: float) -> ProviderLimits:
+    prefix = provider.upper()
+    return ProviderLimits(
+        rate=float(os.getenv(f"{prefix}_RPS", rate)),
+        burst=int(os.getenv(f"{prefix}_BURST", 0)),
+        max_in_flight=int(os.getenv(f"{prefix}_MAX_IN_FLIGHT", max_in_flight)),
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", max_queue)),
+        max_wait=float(os.getenv(f"{prefix}_MAX_WAIT", max_wait)),
+        retry=RetryPolicy(
+            attempts=int(os.getenv("UPSTREAM_MAX_ATTEMPTS", 3)),
+            backoff=float(os.getenv("UPSTREAM_RETRY_BACKOFF", 0.5))
+        ),
+    )
+
+ADMISSION_SETTINGS = {
+    "providers": {
+        "mistral": provider_limits("mistral", rate=5, max_in_flight=8, max_queue=64, max_wait=30),
+        "gemini": provider_limits("gemini", rate=10, max_in_flight=16, max_queue=128, max_wait=10),
+        "cohere": provider_limits("cohere", rate=20, max_in_flight=8, max_queue=256, max_wait=10),
+    },
+    # Longest admission wait per endpoint path; "job" applies to background jobs
+    "endpoint_waits": parse_endpoint_waits(
+        os.getenv("ADMISSION_ENDPOINT_WAITS", "/chat=3,/chat/stream=3,/check-index=2,job=300")
+    ),
+}
+
+# Background OCR jobs, and indexing jobs started by /process-pdf with their own workers and backlog.
+# A job whose process stopped renewing its lease for lease seconds is failed
+JOB_SETTINGS = {
+    "db_path": os.getenv("JOBS_DB_PATH", ".cache/jobs.sqlite3"),
+    "workers": int(os.getenv("OCR_JOB_WORKERS", 2)),
+    "max_backlog": int(os.getenv("OCR_JOB_MAX_BACKLOG", 32)),
+    "index_workers": int(os.getenv("INDEX_JOB_WORKERS", 2)),
+    "index_max_backlog": int(os.getenv("INDEX_JOB_MAX_BACKLOG", 64)),
+    "retention": float(os.getenv("JOB_RETENTION_SECONDS", 24 * 3600)),
+    "lease": float(os.getenv("JOB_LEASE_SECONDS", 60)),
+}
+
+# Bulk ingestion (python main.py ingest <directory>): workers per stage and queue size between stages
+INGEST_SETTINGS = {
+    "manifest_path": os.getenv("INGEST_MANIFEST_PATH", ".cache/ingest-manifest.sqlite3"),
+    "hash_workers": int(os.getenv("INGEST_HASH_WORKERS", 2)),
+    "ocr_workers": int(os.getenv("INGEST_OCR_WORKERS", 4)),
+    # Chunking takes about 1 ms per 40 pages; 0 runs it in threads instead of processes
+    "chunk_processes": int(os.getenv("INGEST_CHUNK_PROCESSES", 0)),
+    "embed_workers": int(os.getenv("INGEST_EMBED_WORKERS", 4)),
+    "insert_workers": int(os.getenv("INGEST_INSERT_WORKERS", 2)),
+    "queue_size": int(os.getenv("INGEST_QUEUE_SIZE", 8)),
+}
+
+# Bounded thread pool for SDK and database calls that have no async variant
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", 16))
+
+# Log whenever the event loop is blocked for longer than this
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", 100))
+
+# Request tracing; requests sent with `X-Profile: 1` are profiled only when PROFILING_ENABLED is set
+TELEMETRY_SETTINGS = {
+    "slow_request_ms": float(os.getenv("TRACE_SLOW_REQUEST_MS", 1000)),
+    "max_traces": int(os.getenv("TRACE_BUFFER_SIZE", 50)),
+    "profiling": os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "profile_interval_ms": float(os.getenv("PROFILE_INTERVAL_MS", 5)),
+}
+
+TRACES = TraceBuffer(TELEMETRY_SETTINGS["max_traces"], TELEMETRY_SETTINGS["slow_request_ms"] / 1000)
+
 # Create the embeddings model
-def get_embeddings_model():
-    """Initialize and return the Cohere embeddings model"""
-    return CohereEmbeddings(model="embed-english-v3.0")
+def get_embeddings_model(admission: Optional[AdmissionController] = None, provider: Optional[Embeddings] = None):
+    """
+    Initialize and return the Cohere embeddings model behind the two-tier embedding cache.
+    `provider` replaces the Cohere client, e.g. with the stand-in used by benchmark.py.
+    """
+    settings = EMBEDDING_CACHE_SETTINGS
+    disk = None
+    if settings["disk_path"]:
+        disk = SQLiteTier(settings["disk_path"], settings["disk_max_bytes"], settings["disk_max_age"])
+    if provider is not None:
+        embeddings = provider
+    elif admission is not None:
+        # Retries are done by the admission controller, with jitter and outside the in-flight slot
+        embeddings = CohereEmbeddings(model=EMBEDDING_MODEL, max_retries=1)
+    else:
+        embeddings = CohereEmbeddings(model=EMBEDDING_MODEL)
+    if admission is not None:
+        embeddings = AdmittedEmbeddings(embeddings, admission)
+    return CachedEmbeddings(
+        embeddings,
+        EMBEDDING_MODEL,
+        memory=MemoryTier(settings["memory_items"], settings["memory_max_age"]),
+        disk=disk,
+    )
 
 # Create the LLM
-def get_llm():
+def get_llm(admission: Optional[AdmissionController] = None):
     """Initialize and return the Google Generative AI model"""
-    return GoogleGenerativeAI(model="gemini-2.5-flash")
+    if admission is None:
+        return GoogleGenerativeAI(model="gemini-2.5-flash")
+    return admitted(AdmittedGoogleGenerativeAI(model="gemini-2.5-flash", max_retries=1), admission)
+
+# Create the chat LLM used for structured generation
+def get_chat_llm_model(api_key: str, admission: Optional[AdmissionController] = None):
+    """Initialize and return the Gemini chat model used by the generation endpoints"""
+    if admission is None:
+        return ChatGoogleGenerativeAI(model=GENERATION_MODEL, temperature=0, api_key=api_key)
+    return admitted(
+        AdmittedChatGoogleGenerativeAI(model=GENERATION_MODEL, temperature=0, api_key=api_key, max_retries=1),
+        admission
+    )
+
+
+class PoolStats:
+    """Counters for the shared TiDB connection pool, reported by /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+
+    def snapshot(self, pool=None) -> Dict[str, Any]:
+        with self._lock:
+            stats = {
+                "handshakes": self.handshakes,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 6),
+            }
+        if pool is not None:
+            stats.update({
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            })
+        return stats
+
+
+POOL_STATS = PoolStats()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records checkouts which had to wait for a connection to be returned"""
+
+    def _do_get(self):
+        # The limit this pool was built with; -1 means unbounded overflow, which never waits
+        saturated = (
+            self.checkedin() == 0
+            and self._max_overflow != -1
+            and self.overflow() >= self._max_overflow
+        )
+        if not saturated:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_STATS.record_wait(time.perf_counter() - start)
+
+
+def instrument_engine(engine):
+    """Attach pool event listeners that feed POOL_STATS"""
+    event.listen(engine, "connect", lambda *args: POOL_STATS.incr("handshakes"))
+    event.listen(engine, "checkout", lambda *args: POOL_STATS.incr("checkouts"))
+    event.listen(engine, "checkin", lambda *args: POOL_STATS.incr("checkins"))
+    event.listen(engine, "invalidate", lambda *args: POOL_STATS.incr("invalidations"))
+
+
+class AppResources:
+    """
+    Process-wide clients shared by every request: one pooled TiDB engine (owned by
+    the vector store), one embeddings client and one LLM client per flavour.
+
+    Clients are built lazily on first use so that endpoints which never touch TiDB
+    keep working when the database is unreachable. The engine is disposed at shutdown.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._embeddings = None
+        self._llm = None
+        self._chat_llm = None
+        self._vector_store = None
+        self._result_cache = None
+        self._ocr_cache = None
+        self._lexical_index = None
+        self._local_vectors = None
+        self._reranker = None
+        self._embedding_batcher = None
+        self._answer_cache = None
+        self.chunk_columns = False
+        self.admission = {
+            provider: AdmissionController(provider, limits, ADMISSION_SETTINGS["endpoint_waits"])
+            for provider, limits in ADMISSION_SETTINGS["providers"].items()
+        }
+
+    @property
+    def embeddings(self):
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = get_embeddings_model(self.admission["cohere"])
+            return self._embeddings
+
+    @property
+    def llm(self):
+        with self._lock:
+            if self._llm is None:
+                self._llm = get_llm(self.admission["gemini"])
+            return self._llm
+
+    def chat_llm(self, api_key: str):
+        with self._lock:
+            if self._chat_llm is None:
+                self._chat_llm = get_chat_llm_model(api_key, self.admission["gemini"])
+            return self._chat_llm
+
+    @property
+    def vector_store(self) -> TiDBVectorStore:
+        embeddings = self.embeddings
+        with self._lock:
+            if self._vector_store is None:
+                self._vector_store = TiDBVectorStore(
+                    embedding_function=embeddings,
+                    connection_string=create_connection_string(TIDB_CONNECTION_PARAMS),
+                    table_name=DEFAULT_TABLE_NAME,
+                    distance_strategy="cosine",
+                    engine_args={
+                        **TIDB_POOL_SETTINGS,
+                        "poolclass": MeteredQueuePool,
+                        "connect_args": {"connect_timeout": TIDB_CONNECT_TIMEOUT},
+                    },
+                )
+                engine = self._vector_store.tidb_vector_client._bind
+                instrument_engine(engine)
+                catalog.create_catalog(engine)
+                indexing.create_chunk_store(engine)
+                try:
+                    self.chunk_columns = indexing.ensure_chunk_columns(engine, DEFAULT_TABLE_NAME)
+                except Exception as e:
+                    logger.warning(f"Could not add the indexed chunk columns to {DEFAULT_TABLE_NAME}: {e}")
+                try:
+                    added = catalog.backfill_catalog(engine, DEFAULT_TABLE_NAME, EMBEDDING_MODEL)
+                    if added:
+                        logger.info(f"Registered {added} previously indexed PDFs in the document catalog")
+                except Exception as e:
+                    logger.warning(f"Document catalog backfill failed: {e}")
+            return self._vector_store
+
+    @property
+    def engine(self):
+        """The pooled SQLAlchemy engine, shared with the vector store"""
+        return self.vector_store.tidb_vector_client._bind
+
+    def pool_metrics(self) -> Dict[str, Any]:
+        pool = self._vector_store.tidb_vector_client._bind.pool if self._vector_store else None
+        return POOL_STATS.snapshot(pool)
+
+    @property
+    def result_cache(self) -> ResultCache:
+        with self._lock:
+            if self._result_cache is None:
+                settings = RESULT_CACHE_SETTINGS
+                backend = create_backend(
+                    settings["backend"],
+                    max_items=settings["max_items"],
+                    path=settings["path"],
+                    url=settings["url"],
+                )
+                self._result_cache = ResultCache(backend, ttl=settings["ttl"])
+            return self._result_cache
+
+    @property
+    def ocr_cache(self) -> OCRCache:
+        with self._lock:
+            if self._ocr_cache is None:
+                self._ocr_cache = OCRCache(OCR_CACHE_SETTINGS["path"], OCR_CACHE_SETTINGS["max_bytes"])
+            return self._ocr_cache
+
+    @property
+    def lexical_index(self) -> LexicalIndexStore:
+        with self._lock:
+            if self._lexical_index is None:
+                self._lexical_index = LexicalIndexStore(
+                    RETRIEVAL_SETTINGS["index_path"], max_open=RETRIEVAL_SETTINGS["max_open"]
+                )
+            return self._lexical_index
+
+    @property
+    def local_vectors(self) -> Optional[LocalVectorIndex]:
+        """Local replica of the vector table, or None when searching in TiDB"""
+        if VECTOR_SETTINGS["backend"] != "local":
+            return None
+        with self._lock:
+            if self._local_vectors is None:
+                self._local_vectors = LocalVectorIndex(
+                    VECTOR_SETTINGS["path"],
+                    exact_max_rows=VECTOR_SETTINGS["exact_max_rows"],
+                    hnsw_m=VECTOR_SETTINGS["hnsw_m"],
+                    hnsw_ef_construction=VECTOR_SETTINGS["hnsw_ef_construction"],
+                    hnsw_ef_search=VECTOR_SETTINGS["hnsw_ef_search"],
+                )
+            return self._local_vectors
+
+    @property
+    def embedding_batcher(self) -> indexing.EmbeddingBatcher:
+        with self._lock:
+            if self._embedding_batcher is None:
+                self._embedding_batcher = indexing.EmbeddingBatcher(
+                    INDEXING_SETTINGS["embed_batch_size"], INDEXING_SETTINGS["embed_concurrency"]
+                )
+            return self._embedding_batcher
+
+    @property
+    def answer_cache(self) -> Optional[SemanticAnswerCache]:
+        """Semantic chat answer cache, or None when disabled"""
+        if not ANSWER_CACHE_SETTINGS["enabled"]:
+            return None
+        with self._lock:
+            if self._answer_cache is None:
+                self._answer_cache = SemanticAnswerCache(
+                    ANSWER_CACHE_SETTINGS["max_entries"], ANSWER_CACHE_SETTINGS["threshold"]
+                )
+            return self._answer_cache
+
+    @property
+    def reranker(self) -> Optional[CohereRerank]:
+        """Cohere reranker for multi-document results, or None when RERANK_MODEL is not set"""
+        if not RETRIEVAL_SETTINGS["rerank_model"]:
+            return None
+        with self._lock:
+            if self._reranker is None:
+                self._reranker = CohereRerank(
+                    model=RETRIEVAL_SETTINGS["rerank_model"], top_n=chat_candidates(2)
+                )
+            return self._reranker
+
+    def vector_backend(self, db: TiDBVectorStore) -> VectorBackend:
+        backend = TiDBVectorBackend(db, chunk_columns=self.chunk_columns)
+        local_vectors = self.local_vectors
+        if local_vectors is not None:
+            backend = LocalVectorBackend(local_vectors, db.embeddings, fallback=backend)
+        return backend
+
+    def sync_local_vectors(self) -> int:
+        """Load new and changed documents from TiDB into the local replica"""
+        engine = self.engine
+        vector_table = self.vector_store.tidb_vector_client._table_model.__table__
+        
+        def list_documents():
+            with engine.connect() as conn:
+                return catalog.list_documents(conn)
+        
+        def load_rows(source_name: str):
+            with engine.connect() as conn:
+                return indexing.load_document_vectors(conn, vector_table, source_name, self.chunk_columns)
+        
+        return self.local_vectors.sync(list_documents, load_rows)
+
+    def bind_admission(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Let provider calls made from worker threads wait for admission on the event loop"""
+        for controller in self.admission.values():
+            controller.bind(loop)
+
+    def admission_metrics(self) -> Dict[str, Any]:
+        return {provider: controller.stats() for provider, controller in self.admission.items()}
+
+    def ocr_cache_metrics(self) -> Optional[Dict[str, Any]]:
+        return self._ocr_cache.stats() if self._ocr_cache is not None else None
+
+    def embedding_cache_metrics(self) -> Optional[Dict[str, Any]]:
+        return self._embeddings.stats() if self._embeddings is not None else None
+
+    def dispose(self):
+        with self._lock:
+            if self._vector_store is not None:
+                self._vector_store.tidb_vector_client._bind.dispose()
+                self._vector_store = None
+            if self._embeddings is not None and self._embeddings.disk is not None:
+                self._embeddings.disk.close()
+            if self._ocr_cache is not None:
+                self._ocr_cache.close()
+                self._ocr_cache = None
+            if self._embedding_batcher is not None:
+                self._embedding_batcher.shutdown()
+                self._embedding_batcher = None
+
+    async def aclose(self):
+        if self._result_cache is not None:
+            await self._result_cache.close()
+        self.dispose()
+
+
+async def refresh_local_vectors(resources: AppResources):
+    """Rebuild the local vector replica from TiDB, then keep it in line with the catalog"""
+    while True:
+        try:
+            started = time.perf_counter()
+            loaded = await run_blocking(resources.sync_local_vectors)
+            if loaded:
+                logger.info(f"Loaded {loaded} documents into the local vector replica in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            logger.warning(f"Local vector replica refresh failed: {e}")
+        await asyncio.sleep(VECTOR_SETTINGS["refresh_interval"])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the shared resources at startup and release them at shutdown"""
+    # Every run_in_executor(None, ...) call, including LangChain's sync fallbacks, uses this pool
+    executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+    asyncio.get_running_loop().set_default_executor(executor)
+    
+    loop_monitor = LoopLagMonitor(threshold=LOOP_LAG_THRESHOLD_MS / 1000)
+    loop_monitor.start()
+    app.state.loop_monitor = loop_monitor
+    
+    # Resources set up before startup (benchmark.py preloads local stand-ins) are used as they are
+    resources = app.state.resources if hasattr(app.state, "resources") else AppResources()
+    resources.bind_admission(asyncio.get_running_loop())
+    app.state.resources = resources
+    
+    # OCR and indexing jobs share the store but not their workers, so a full OCR backlog
+    # does not hold back the indexing of text that was already extracted
+    job_store = SQLiteJobStore(JOB_SETTINGS["db_path"])
+    job_queue = JobQueue(
+        job_store,
+        concurrency=JOB_SETTINGS["workers"],
+        max_backlog=JOB_SETTINGS["max_backlog"],
+        retention=JOB_SETTINGS["retention"],
+        cleanup=remove_job_upload,
+        lease=JOB_SETTINGS["lease"],
+    )
+    index_job_queue = JobQueue(
+        job_store,
+        concurrency=JOB_SETTINGS["index_workers"],
+        max_backlog=JOB_SETTINGS["index_max_backlog"],
+        retention=JOB_SETTINGS["retention"],
+        cleanup=remove_job_upload,
+        lease=JOB_SETTINGS["lease"],
+    )
+    # Jobs honour an override of the OCR client dependency, like /process-pdf does
+    job_queue.register("ocr", functools.partial(
+        ocr_job_handler,
+        resources=resources,
+        get_client=app.dependency_overrides.get(get_ocr_client, get_ocr_client)
+    ))
+    index_job_queue.register("index", functools.partial(
+        index_job_handler,
+        resources=resources,
+        get_store=app.dependency_overrides.get(get_vector_store)
+    ))
+    await job_queue.start()
+    await index_job_queue.start()
+    app.state.job_queue = job_queue
+    app.state.index_job_queue = index_job_queue
+    
+    try:
+        # Warm the pool so the first chat request does not pay the TLS handshake
+        await run_blocking(lambda: resources.vector_store)
+    except Exception as e:
+        logger.warning(f"TiDB vector store unavailable at startup: {e}")
+    
+    replica_task = None
+    if resources.local_vectors is not None:
+        replica_task = asyncio.create_task(refresh_local_vectors(resources), name="vector-replica-refresh")
+    yield
+    if replica_task is not None:
+        replica_task.cancel()
+        await asyncio.gather(replica_task, return_exceptions=True)
+    await job_queue.stop()
+    await index_job_queue.stop()
+    job_store.close()
+    await loop_monitor.stop()
+    await resources.aclose()
+    del app.state.resources
+    executor.shutdown(wait=False)
+
+
+# Dependencies exposing the shared resources
+def get_resources(request: Request) -> AppResources:
+    return request.app.state.resources
+
+def get_vector_store(resources: AppResources = Depends(get_resources)) -> TiDBVectorStore:
+    try:
+        return resources.vector_store
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Vector store unavailable: {str(e)}")
+
+def get_engine(db: TiDBVectorStore = Depends(get_vector_store)):
+    return db.tidb_vector_client._bind
+
+def get_job_queue(request: Request) -> JobQueue:
+    return request.app.state.job_queue
+
+def get_index_job_queue(request: Request) -> JobQueue:
+    return request.app.state.index_job_queue
+
+def get_result_cache(resources: AppResources = Depends(get_resources)) -> ResultCache:
+    return resources.result_cache
+
+def get_qa_llm(resources: AppResources = Depends(get_resources)):
+    return resources.llm
+
+def get_chat_llm(resources: AppResources = Depends(get_resources)):
+    api_key = os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        raise HTTPException(
+            status_code=500,
+            detail="Google API key not configured. Please set the GOOGLE_API_KEY environment variable."
+        )
+    return resources.chat_llm(api_key)
 
 # Prompt template for Q&A
 QA_PROMPT_TEMPLATE = """
@@ -86,6 +772,7 @@ Your responses must be based **entirely** on the context provided below, as well
 2. If the context lacks sufficient details, reply with:
    > The provided context does not contain enough information to answer this question.
 3. Keep your tone professional and concise.
+4. Cite the context passages you rely on by their number in square brackets, e.g. [1] or [2][3].
 
 ---
 
@@ -109,7 +796,15 @@ class IndexPDFRequest(BaseModel):
 
 class ChatRequest(BaseModel):
     question: str = Field(..., description="User question about the PDF content")
-    pdf_name: str = Field(..., description="Name of the PDF to query against")
+    pdf_name: Optional[str] = Field(None, description="Name of the PDF to query against")
+    pdf_names: Optional[list[str]] = Field(None, description="Names of several PDFs to query across", max_length=500)
+    collection: Optional[str] = Field(None, description="Collection whose PDFs to query across")
+    section: Optional[str] = Field(None, description="Only use chunks under a heading containing this text", max_length=255)
+    use_cache: bool = Field(True, description="Set to false to bypass the semantic answer cache")
+
+class CollectionRequest(BaseModel):
+    collection: str = Field(..., description="Name of the collection", min_length=1, max_length=255)
+    pdf_names: list[str] = Field(..., description="Names of the PDFs", max_length=500)
    
 # Response models
 class IndexPDFResponse(BaseModel):
@@ -118,10 +813,34 @@ class IndexPDFResponse(BaseModel):
     chunks_created: int
     pdf_name: str
     table_name: str
+    chunks_reused: int = Field(0, description="Chunks whose vector was already stored")
+    chunks_embedded: int = Field(0, description="Chunks sent to the embedding model")
+    chunks_removed: int = Field(0, description="Stored chunks that no longer appear in the document")
+    chunks_per_second: float = Field(0.0, description="Chunks indexed per second, end to end")
+    embed_ms: float = Field(0.0, description="Time spent embedding new chunks")
+    insert_ms: float = Field(0.0, description="Time spent in the write transaction")
+    embed_batches: int = Field(0, description="Embedding requests sent to the provider")
+    chunks_updated: int = Field(0, description="Stored chunks whose section, page or position changed")
+
+class Citation(BaseModel):
+    id: int = Field(..., description="Number the answer cites the passage by, as [id]")
+    source: Optional[str] = None
+    chunk_hash: Optional[str] = None
+    chunk_hashes: list[str] = Field([], description="Every chunk merged into the passage, in document order")
+    section: Optional[str] = Field(None, description="Heading path of the passage")
+    page: Optional[int] = Field(None, description="Page the passage starts on")
+    preview: str
 
 class ChatResponse(BaseModel):
     question: str
     answer: str
+    citations: list[Citation] = []
+    context_tokens: int = Field(0, description="Estimated tokens of the retrieved context in the prompt; 0 for cached answers")
+
+class CollectionResponse(BaseModel):
+    collection: str
+    pdf_names: list[str]
+    not_indexed: list[str] = Field([], description="Members that are not indexed yet and are skipped by chat")
 
 class CheckIndexRequest(BaseModel):
     pdf_name: str = Field(..., description="Name of the PDF to check")
@@ -130,6 +849,14 @@ class CheckIndexResponse(BaseModel):
     is_indexed: bool
     pdf_name: str
     message: str
+    status: str = Field("not_indexed", description="ready, pending, indexing, failed or not_indexed")
+    job_id: Optional[str] = Field(None, description="Background indexing job started by /process-pdf")
+
+class CheckIndexBatchRequest(BaseModel):
+    pdf_names: list[str] = Field(..., description="Names of the PDFs to check", max_length=500)
+
+class CheckIndexBatchResponse(BaseModel):
+    results: list[CheckIndexResponse]
   
   
   
@@ -184,25 +911,288 @@ class FAQItem(BaseModel):
 class FAQOutput(BaseModel):
     faqs: list[FAQItem] = Field(..., description="List of frequently asked questions and answers")
 
+class MarkMapResponse(BaseModel):
+    markmap: str
+
+
+# Generation prompts. Every artifact prompt starts with the same paper context message and
+# only the instructions that follow differ, so the provider can reuse a cached prefix
+# when several artifacts are generated for the same paper.
+PAPER_CONTEXT_PROMPT = (
+    "You are an expert assistant for academic research papers. "
+    "Analyze this research paper in Markdown format:\n\n"
+    "{paper_markdown}"
+)
+
+SUMMARY_INSTRUCTIONS = (
+    "You are an expert academic summarizer. Summarize the research paper above.\n\n"
+    "Provide your response as strict JSON, following this schema with each field using Markdown formatting:\n"
+    "- summary\n- background\n- problem\n- methods\n- experiments\n- results\n- limitations\n- implications\n- future_work\n\n"
+    "Each section may include Markdown tables, inline or block LaTeX math ($...$, $$...$$), bullet points, code blocks, etc.\n\n"
+)
+
+QUIZ_INSTRUCTIONS = (
+    "You are an expert education content creator. "
+    "Create a comprehensive quiz to test understanding of the key concepts, methodologies, and findings "
+    "in the paper above. Follow these guidelines:\n\n"
+    "1. Generate exactly 15 multiple-choice questions covering the most important aspects of the paper\n"
+    "2. Each question should have exactly 4 answer choices (A, B, C, D)\n"
+    "3. Provide one correct answer per question\n"
+    "4. Include a brief explanation for why the correct answer is right\n"
+    "5. Ensure questions assess both factual knowledge and conceptual understanding\n"
+    "6. Create a title for the quiz that reflects the paper's content\n\n"
+    "Structure your response as a JSON object with a 'title' field and a 'quiz' array containing question objects. "
+    "Each question object should have 'question', 'choices', 'correct_answer', and 'explanation' fields.\n\n"
+    "Make sure the correct_answer exactly matches one of the provided choices."
+)
+
+FAQ_INSTRUCTIONS = (
+    "You are an expert at creating comprehensive FAQs for academic research papers. "
+    "Generate {num_questions} frequently asked questions with detailed answers that would be most helpful "
+    "for someone trying to understand the paper above. Focus on key concepts, methodologies, findings, and implications. "
+    "The questions should be clear and specific, and the answers should be thorough, accurate, and educational.\n\n"
+    "Format your response as a JSON array of objects, each with 'question' and 'answer' fields."
+)
+
+MIND_MAP_INSTRUCTIONS = (
+    "You are an expert at creating detailed mind maps from academic research papers. "
+    "Create a comprehensive hierarchical mind map in markmap markdown format "
+    "capturing the key concepts, relationships, and findings from the paper above. "
+    "The mind map should be detailed but only include markmap-compatible content."
+)
+
+# Artifact name -> (instructions, structured output schema)
+STUDIO_ARTIFACTS = {
+    "summary": (SUMMARY_INSTRUCTIONS, MarkdownSummary),
+    "quiz": (QUIZ_INSTRUCTIONS, QuizOutput),
+    "faqs": (FAQ_INSTRUCTIONS, FAQOutput),
+    "mind_map": (MIND_MAP_INSTRUCTIONS, MarkMapResponse),
+}
+
+def build_artifact_chain(llm, artifact: str):
+    """Prompt | structured LLM chain for one studio artifact"""
+    instructions, schema = STUDIO_ARTIFACTS[artifact]
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", PAPER_CONTEXT_PROMPT),
+        ("human", instructions),
+    ])
+    return prompt | llm.with_structured_output(schema)
+
+def prompt_version(artifact: str) -> str:
+    """Version of an artifact's prompt; changes whenever the template text changes"""
+    instructions, _ = STUDIO_ARTIFACTS[artifact]
+    return hash_text(PAPER_CONTEXT_PROMPT + "\0" + instructions)[:12]
+
+def use_map_reduce(artifact: str, paper_markdown: str) -> bool:
+    """Summaries of papers above the token threshold are generated section by section"""
+    return artifact == "summary" and estimate_tokens(paper_markdown) > SUMMARY_SETTINGS["map_reduce_tokens"]
+
+async def generate_artifact(
+    llm,
+    cache: ResultCache,
+    artifact: str,
+    paper_markdown: str,
+    num_questions: Optional[int] = None,
+    timer: Optional[StageTimer] = None
+):
+    """
+    Generate one studio artifact through the result cache.
+    Returns (result, cached) where result is an instance of the artifact's schema.
+    Stage durations are recorded in `timer`.
+    """
+    instructions, schema = STUDIO_ARTIFACTS[artifact]
+    timer = timer or StageTimer()
+    inputs = {"paper_markdown": paper_markdown}
+    params = {}
+    if artifact == "faqs":
+        inputs["num_questions"] = params["num_questions"] = num_questions
+    map_reduce = use_map_reduce(artifact, paper_markdown)
+    if map_reduce:
+        params["mode"] = "map_reduce"
+        params["section_tokens"] = SUMMARY_SETTINGS["section_tokens"]
+        params["map_reduce_prompt"] = map_reduce_prompt_version()
+    
+    key = make_key(hash_text(paper_markdown), artifact, prompt_version(artifact), GENERATION_MODEL, params)
+    
+    async def compute():
+        record_tokens("gemini", "input", paper_markdown)
+        if map_reduce:
+            section_summaries = await summarize_sections(
+                llm,
+                cache,
+                paper_markdown,
+                GENERATION_MODEL,
+                section_tokens=SUMMARY_SETTINGS["section_tokens"],
+                concurrency=SUMMARY_SETTINGS["concurrency"],
+                timer=timer
+            )
+            result = await reduce_sections(llm, section_summaries, instructions, schema, timer=timer)
+            logger.info(f"Map-reduce {artifact} over {len(section_summaries)} sections: {timer.server_timing()}")
+        else:
+            with timer.stage("generate"):
+                result = await build_artifact_chain(llm, artifact).ainvoke(inputs)
+        value = jsonable_encoder(result)
+        record_tokens("gemini", "output", json.dumps(value))
+        return value
+    
+    value, cached = await cache.get_or_compute(key, compute)
+    return schema.model_validate(value), cached
+
+
+class CacheInvalidateRequest(BaseModel):
+    paper_markdown: Optional[str] = Field(None, description="Paper whose cached results should be dropped")
+    paper_hash: Optional[str] = Field(None, description="SHA-256 of the paper markdown, instead of the paper itself")
+    artifact: Optional[Literal["summary", "quiz", "faqs", "mind_map"]] = Field(None, description="Only drop this artifact")
+
+
+class StudioGenerateRequest(BaseModel):
+    paper_markdown: str = Field(..., description="Full paper content in Markdown format")
+    artifacts: list[Literal["summary", "quiz", "faqs", "mind_map"]] = Field(
+        default_factory=lambda: list(STUDIO_ARTIFACTS),
+        description="Artifacts to generate",
+        min_length=1
+    )
+    num_questions: int = Field(5, description="Number of FAQs to generate", ge=1, le=10)
+
 
 
 
 # Create FastAPI application
-app = FastAPI(docs_url="/docs", redoc_url=None,title="Research Paper Processing API", description="API to process PDF files and research papers")
+app = FastAPI(docs_url="/docs", redoc_url=None,title="Research Paper Processing API", description="API to process PDF files and research papers", lifespan=lifespan)
 
-# Configure CORS
+# Configuration
+MAX_FILE_SIZE = int(float(os.getenv("MAX_UPLOAD_MB", "100")) * 1024 * 1024)  # 100MB maximum file size by default
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+ALLOWED_EXTENSIONS = {"pdf"}
+UPLOAD_PATHS = {"/process-pdf", "/jobs/ocr"}
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+def format_size(size: int) -> str:
+    """Human-readable size for error messages"""
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):g}MB"
+    return f"{size / 1024:g}KB"
+
+class FileTooLargeError(Exception):
+    """Raised while copying an upload when the file itself exceeds the size limit"""
+
+class UploadSizeLimitMiddleware:
+    """
+    Refuse uploads over the limit while they arrive: a declared Content-Length is checked before
+    the body is read, and the body bytes are counted as the multipart parser receives them, so a
+    chunked upload is cut off at the limit instead of being spooled in full
+    """
+
+    def __init__(self, app, paths: Set[str], max_body: int):
+        self.app = app
+        self.paths = paths
+        self.max_body = max_body
+
+    def _too_large(self) -> str:
+        return f"File size exceeds the maximum limit of {format_size(MAX_FILE_SIZE)}"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body:
+            await JSONResponse(status_code=413, content={"detail": self._too_large()})(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    # Raised inside form parsing; FastAPI re-raises HTTPExceptions from the body reader
+                    raise HTTPException(status_code=413, detail=self._too_large())
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware, paths=UPLOAD_PATHS, max_body=MAX_FILE_SIZE + MULTIPART_OVERHEAD)
+
+def finish_request_trace(trace: Trace, request: Request, status: int, profiler: Optional[SamplingProfiler], response_bytes: Optional[str]):
+    """Record a finished request in the latency histograms and the slow trace buffer"""
+    trace.duration = time.perf_counter() - trace.start
+    trace.status = status
+    route = trace.route_name
+    HTTP_SECONDS.observe(trace.duration, method=request.method, route=route, status=status)
+    if request.headers.get("content-length"):
+        HTTP_BYTES.inc(int(request.headers["content-length"]), route=route, direction="request")
+    if response_bytes:
+        HTTP_BYTES.inc(int(response_bytes), route=route, direction="response")
+    if profiler is not None:
+        trace.profile = profiler.stop()
+    TRACES.finish(trace)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """
+    Trace the request: its stages are reported in Server-Timing and feed the /metrics histograms.
+    Also records the endpoint being served, which decides how long provider calls may wait for admission.
+    """
+    endpoint_token = CURRENT_ENDPOINT.set(request.url.path)
+    trace = Trace(request.url.path, scope=request.scope)
+    trace_token = CURRENT_TRACE.set(trace)
+    profiler = None
+    if TELEMETRY_SETTINGS["profiling"] and request.headers.get("x-profile", "").lower() in ("1", "true", "yes"):
+        profiler = SamplingProfiler(TELEMETRY_SETTINGS["profile_interval_ms"] / 1000).start()
+    try:
+        response = await call_next(request)
+    except Exception:
+        finish_request_trace(trace, request, 500, profiler, None)
+        raise
+    finally:
+        CURRENT_TRACE.reset(trace_token)
+        CURRENT_ENDPOINT.reset(endpoint_token)
+    
+    response.headers["X-Trace-Id"] = trace.id
+    if profiler is not None:
+        response.headers["X-Profile-Id"] = trace.id
+    response_bytes = response.headers.get("content-length")
+    if response_bytes is None:
+        # Streamed body: the request ends with its last chunk
+        body = response.body_iterator
+        
+        async def traced_body():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                finish_request_trace(trace, request, response.status_code, profiler, None)
+        
+        response.body_iterator = traced_body()
+    else:
+        finish_request_trace(trace, request, response.status_code, profiler, response_bytes)
+        if "server-timing" not in response.headers:
+            response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.exception_handler(HTTPException)
+async def shed_rejected_requests(request: Request, exc: HTTPException):
+    """Answer 429/503 with Retry-After when an endpoint's 500 was caused by an admission rejection"""
+    if exc.status_code >= 500:
+        rejection = find_rejection(exc)
+        if rejection is not None:
+            exc = rejection
+    return await http_exception_handler(request, exc)
+
+# Configure CORS; added last so it wraps the size check and 413 responses carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://ai-pdf-studio-tidb.vercel.app"],
     allow_credentials=True,
     allow_methods=["POST", "GET"],
     allow_headers=["*"], 
+    expose_headers=["Retry-After"],
 )
 
-# Configuration
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB maximum file size
-ALLOWED_EXTENSIONS = {"pdf"}
-
 # Dependency to get Mistral API client
 async def get_mistral_client():
     api_key = os.environ.get("MISTRAL_API_KEY")
@@ -217,71 +1207,191 @@ def validate_pdf_file(file: UploadFile) -> None:
     if file_extension not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
-def get_combined_markdown(ocr_response: OCRResponse) -> str:
+class SavedUpload(BaseModel):
+    path: Path
+    size: int
+    content_hash: str
+
+def save_upload_to_temp_file(file: UploadFile, max_size: int = MAX_FILE_SIZE) -> SavedUpload:
     """
-    Combine OCR text from all pages into a single markdown document.
+    Copy the uploaded file, already received and spooled by the multipart parser, to a named
+    temporary file in fixed-size chunks, hashing it on the way. The request body was capped
+    while it arrived (UploadSizeLimitMiddleware); this enforces the exact limit on the file
+    itself, raising FileTooLargeError and removing the partial copy once `max_size` is passed.
     """
-    markdowns: list[str] = []
-    # Extract markdown from each page
-    for page in ocr_response.pages:
-        markdowns.append(page.markdown)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        try:
+            while chunk := file.file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLargeError(f"File size exceeds the maximum limit of {format_size(max_size)}")
+                digest.update(chunk)
+                temp_file.write(chunk)
+        except BaseException:
+            temp_file.close()
+            os.unlink(temp_file.name)
+            raise
+    return SavedUpload(path=Path(temp_file.name), size=size, content_hash=digest.hexdigest())
 
-    return "\n\n".join(markdowns)
+async def receive_pdf_upload(file: UploadFile) -> SavedUpload:
+    """Validate an uploaded PDF and copy it to a named temporary file off the event loop"""
+    validate_pdf_file(file)
+    try:
+        with span("upload"):
+            upload = await run_blocking(save_upload_to_temp_file, file)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    PAYLOAD_BYTES.inc(upload.size, kind="upload")
+    return upload
+
+def get_combined_markdown(pages: List[str]) -> str:
+    """Combine OCR text from all pages, given in page order, into a single markdown document"""
+    return "\n\n".join(pages)
+
+def get_paged_markdown(pages: List[str]) -> str:
+    """
+    The combined markdown with a `<!-- page N -->` comment before each page, so chunks know the
+    page they start on. Only for indexing: API responses and prompts get `get_combined_markdown`.
+    """
+    return "\n\n".join(f"{page_marker(number)}\n\n{page}" for number, page in enumerate(pages, start=1))
+
+def markdown_hash(markdown: str) -> str:
+    """Content hash of a document in the catalog, over the markdown the API returns for it"""
+    return hashlib.sha256(markdown.encode("utf-8")).hexdigest()
+
+async def get_ocr_client() -> OCRClient:
+    """Dependency providing the remote OCR client; override it to use a local stand-in"""
+    return MistralOCRClient(await get_mistral_client(), model=OCR_MODEL)
+
+async def extract_pdf_markdown(
+    cache: OCRCache,
+    file_path: Path,
+    file_name: str,
+    content_hash: str,
+    client: Optional[OCRClient] = None,
+    get_client: Callable[[], Awaitable[OCRClient]] = get_ocr_client,
+    report=None,
+    admission: Optional[AdmissionController] = None
+) -> tuple[List[str], bool]:
+    """
+    Return (markdown of each page, cached). A PDF whose bytes were OCR'd before is served
+    from the OCR cache without any remote call; without a `client`, one is created on a miss.
+    Large PDFs are OCR'd as concurrent page ranges, each admitted by `admission`.
+    """
+    pages = await run_blocking(cache.get, content_hash, OCR_MODEL)
+    if pages is not None:
+        return pages, True
+    
+    if client is None:
+        client = await get_client()
+    if admission is not None:
+        client = AdmittedOCRClient(client, admission)
+    with span("ocr"):
+        pages = await ocr_document(
+            client,
+            file_path,
+            file_name,
+            pages_per_range=OCR_SETTINGS["pages_per_range"],
+            concurrency=OCR_SETTINGS["concurrency"],
+            retry=OCR_SETTINGS["retry"],
+            report=report
+        )
+    PAYLOAD_BYTES.inc(sum(len(page.encode("utf-8")) for page in pages), kind="ocr_markdown")
+    if report is not None:
+        await report("combining", 0.95)
+    try:
+        await run_blocking(cache.put, content_hash, OCR_MODEL, pages)
+    except Exception as e:
+        # A broken cache must not fail the OCR request
+        logger.warning(f"Could not cache OCR result: {e}")
+    return pages, False
+
+def write_markdown_to_temp_file(markdown: str) -> str:
+    """Keep extracted markdown on disk until its indexing job picks it up"""
+    with tempfile.NamedTemporaryFile("w", suffix=".md", delete=False, encoding="utf-8") as temp_file:
+        temp_file.write(markdown)
+        return temp_file.name
+
+async def start_background_indexing(
+    request: Request, job_queue: JobQueue, pdf_name: str, markdown: str, content_hash: str
+) -> Dict[str, Any]:
+    """
+    Queue an indexing job for extracted markdown and describe it for the client.
+    Raises a 503 when the indexing backlog is full; the OCR result is cached, so a retry is cheap.
+    """
+    file_path = await run_blocking(write_markdown_to_temp_file, markdown)
+    try:
+        job = await job_queue.submit("index", {"file_path": file_path, "pdf_name": pdf_name, "content_hash": content_hash})
+    except QueueFullError as e:
+        os.unlink(file_path)
+        raise HTTPException(status_code=503, detail=f"Indexing is busy, retry later: {e}", headers={"Retry-After": "30"})
+    except Exception as e:
+        os.unlink(file_path)
+        logger.warning(f"Could not queue indexing of '{pdf_name}': {e}")
+        return {"document_id": pdf_name, "status": "failed", "error": str(e)}
+    return {
+        "document_id": pdf_name,
+        "status": "pending",
+        "job_id": job.id,
+        "status_url": str(request.url_for("get_job", job_id=job.id))
+    }
 
 @app.post("/process-pdf", response_class=JSONResponse)
 async def process_pdf(
+    request: Request,
+    response: Response,
     file: UploadFile = File(...),
-    client: Mistral = Depends(get_mistral_client)
+    index: bool = Form(False, description="Also index the extracted text for chat, in the background"),
+    pdf_name: Optional[str] = Form(None, description="Name to index the PDF under; defaults to the file name"),
+    client: OCRClient = Depends(get_ocr_client),
+    resources: AppResources = Depends(get_resources),
+    index_job_queue: JobQueue = Depends(get_index_job_queue)
 ):
     """
     Process a PDF file using Mistral API for OCR and text extraction.
     
-    - Accepts PDF files up to 5MB
+    - Accepts PDF files up to MAX_UPLOAD_MB (100MB by default); large PDFs are OCR'd as concurrent page ranges
     - Returns only the extracted text as a single combined markdown string
+    - PDFs with the same bytes are served from the OCR cache (`X-Cache: hit`)
+    - With `index=true`, the text is also indexed in the background, without sending it back to
+      `/index-pdf`; follow `indexing.document_id` with `/check-index` (pending, indexing, ready or failed)
+    - Returns 503 with Retry-After when `index=true` and the indexing backlog is full
     """
-    # Validate PDF file
-    validate_pdf_file(file)
-    
-    # Create temporary file to store the uploaded PDF
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        # Check file size during copy
-        file_size = 0
-        shutil.copyfileobj(file.file, temp_file)
-        file_size = temp_file.tell()
-        
-        if file_size > MAX_FILE_SIZE:
-            os.unlink(temp_file.name)
-            raise HTTPException(status_code=400, detail=f"File size exceeds the maximum limit of 10MB")
-        
-        temp_file_path = Path(temp_file.name)
+    # Validate the PDF and stream it to a temporary file
+    upload = await receive_pdf_upload(file)
+    temp_file_path = upload.path
     
     try:
-        # Upload PDF file to Mistral's OCR service
-        uploaded_file = client.files.upload(
-            file={
-                "file_name": file.filename or "uploaded_pdf",
-                "content": temp_file_path.read_bytes(),
-            },
-            purpose="ocr",
-        )
-
-        # Get URL for the uploaded file
-        signed_url = client.files.get_signed_url(file_id=uploaded_file.id, expiry=1)
-
-        # Process PDF with OCR, without including embedded images
-        pdf_response = client.ocr.process(
-            document=DocumentURLChunk(document_url=signed_url.url),
-            model="mistral-ocr-latest",
-            include_image_base64=False
+        # Run OCR on the uploaded file, unless the same PDF was processed before
+        pages, cached = await extract_pdf_markdown(
+            resources.ocr_cache,
+            temp_file_path,
+            file.filename or "uploaded_pdf",
+            upload.content_hash,
+            client=client,
+            admission=resources.admission["mistral"]
         )
+        response.headers["X-Cache"] = "hit" if cached else "miss"
 
         # Create simplified response with only the markdown content
+        extracted_text = get_combined_markdown(pages)
         simplified_response = {
-            "extracted_text": get_combined_markdown(pdf_response)
+            "extracted_text": extracted_text
         }
+        if index:
+            # Indexed with page markers, under the hash of the text returned here, so sending that
+            # text to /index-pdf later finds it already indexed
+            simplified_response["indexing"] = await start_background_indexing(
+                request, index_job_queue, pdf_name or file.filename or "uploaded_pdf",
+                get_paged_markdown(pages), markdown_hash(extracted_text)
+            )
         
         return simplified_response
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"PDF processing failed: {str(e)}")
     
@@ -291,6 +1401,111 @@ async def process_pdf(
             os.unlink(temp_file_path)
 
 
+def remove_job_upload(job) -> None:
+    """Delete the uploaded PDF, or extracted markdown, of a job if it is still on disk"""
+    file_path = job.payload.get("file_path")
+    if file_path and os.path.exists(file_path):
+        os.unlink(file_path)
+
+async def ocr_job_handler(
+    ctx: JobContext,
+    resources: AppResources,
+    get_client: Callable[[], Awaitable[OCRClient]] = get_ocr_client
+) -> Dict[str, Any]:
+    """Run OCR for a queued upload and return the extracted markdown"""
+    CURRENT_ENDPOINT.set("job")
+    try:
+        with start_trace("job:ocr", TRACES):
+            pages, cached = await extract_pdf_markdown(
+                resources.ocr_cache,
+                Path(ctx.payload["file_path"]),
+                ctx.payload["file_name"],
+                ctx.payload["content_hash"],
+                get_client=get_client,
+                report=ctx.report,
+                admission=resources.admission["mistral"]
+            )
+        return {"extracted_text": get_combined_markdown(pages), "cached": cached}
+    finally:
+        await run_blocking(remove_job_upload, ctx.job)
+
+@app.post("/jobs/ocr", status_code=202)
+async def submit_ocr_job(
+    request: Request,
+    file: UploadFile = File(...),
+    job_queue: JobQueue = Depends(get_job_queue)
+):
+    """
+    Queue a PDF for OCR and return immediately with a job id.
+    
+    - Poll `GET /jobs/{job_id}` for status and the extracted text, or follow `GET /jobs/{job_id}/events`
+    - Returns 429 with Retry-After when the OCR backlog is full
+    """
+    # Keep the upload on disk until a worker picks it up
+    upload = await receive_pdf_upload(file)
+    temp_file_path = upload.path
+    
+    try:
+        job = await job_queue.submit("ocr", {
+            "file_path": str(temp_file_path),
+            "file_name": file.filename or "uploaded_pdf",
+            "file_size": upload.size,
+            "content_hash": upload.content_hash
+        })
+    except QueueFullError as e:
+        os.unlink(temp_file_path)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    except Exception as e:
+        os.unlink(temp_file_path)
+        raise HTTPException(status_code=500, detail=f"Could not queue PDF processing: {str(e)}")
+    
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": str(request.url_for("get_job", job_id=job.id)),
+        "events_url": str(request.url_for("stream_job_events", job_id=job.id))
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, job_queue: JobQueue = Depends(get_job_queue)):
+    """
+    Return the status, progress, partial result and final result of a job.
+    Jobs are kept for the retention window after they finish.
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(request: Request, job_id: str, job_queue: JobQueue = Depends(get_job_queue)):
+    """
+    Stream job progress as Server-Sent Events.
+    
+    - `progress` whenever the status, stage or progress changes
+    - `done` with the result, or `failed` with the error, ends the stream
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    # Changes are announced by the queue running the job
+    if job.kind == "index":
+        job_queue = get_index_job_queue(request)
+    
+    async def event_stream():
+        async for job in job_queue.watch(job_id):
+            if job.status in TERMINAL_STATUSES:
+                yield sse_event("done" if job.status == SUCCEEDED else "failed", job.to_dict())
+            else:
+                yield sse_event("progress", job.to_dict(include_result=False))
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 
 
 
@@ -298,41 +1513,28 @@ async def process_pdf(
 
 
 @app.post("/structured-summary", response_model=MarkdownSummary)
-async def generate_structured_summary(paper: PaperInput = Body(...)):
+async def generate_structured_summary(
+    response: Response,
+    paper: PaperInput = Body(...),
+    llm = Depends(get_chat_llm),
+    cache: ResultCache = Depends(get_result_cache)
+):
     """
     Generate a structured summary of a research paper in Markdown format.
     
     - Accepts a research paper in Markdown format
     - Returns a structured JSON summary with sections for summary, background, problem, methods,
       experiments, results, limitations, implications, and future_work
+    - Papers above SUMMARY_MAP_REDUCE_TOKENS are summarized section by section and then reduced;
+      stage durations are reported in the `Server-Timing` header
     """
     try:
-        # Get API key from environment variable
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="Google API key not configured. Please set the GOOGLE_API_KEY environment variable."
-            )
-        
-        # Initialize the LLM model
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, api_key=api_key)
-        
-        # Create the prompt template
-        prompt = ChatPromptTemplate.from_template(
-            "You are an expert academic summarizer. Analyze this research paper in Markdown:\n\n"
-            "{paper_markdown}\n\n"
-            "Provide your response as strict JSON, following this schema with each field using Markdown formatting:\n"
-            "- summary\n- background\n- problem\n- methods\n- experiments\n- results\n- limitations\n- implications\n- future_work\n\n"
-            "Each section may include Markdown tables, inline or block LaTeX math ($...$, $$...$$), bullet points, code blocks, etc.\n\n"
-        )
-        
-        # Create structured output model
-        structured_llm = llm.with_structured_output(MarkdownSummary)
-        
-        # Create and invoke the chain
-        chain = prompt | structured_llm
-        result = chain.invoke({"paper_markdown": paper.paper_markdown})
+        # Generate the summary, or reuse the cached one for this paper
+        timer = StageTimer()
+        result, cached = await generate_artifact(llm, cache, "summary", paper.paper_markdown, timer=timer)
+        response.headers["X-Cache"] = "hit" if cached else "miss"
+        if timer.durations:
+            response.headers["Server-Timing"] = timer.server_timing()
         
         # Return the structured summary
         return result
@@ -351,7 +1553,12 @@ async def generate_structured_summary(paper: PaperInput = Body(...)):
 # Pydantic models for quiz generator
 
 @app.post("/generate-quiz", response_model=QuizOutput)
-async def generate_quiz(paper: PaperInput = Body(...)):
+async def generate_quiz(
+    response: Response,
+    paper: PaperInput = Body(...),
+    llm = Depends(get_chat_llm),
+    cache: ResultCache = Depends(get_result_cache)
+):
     """
     Generate a quiz based on a research paper.
     
@@ -359,40 +1566,9 @@ async def generate_quiz(paper: PaperInput = Body(...)):
     - Returns a structured quiz with 15 multiple-choice questions, answers, and explanations
     """
     try:
-        # Get API key from environment variable
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="Google API key not configured. Please set the GOOGLE_API_KEY environment variable."
-            )
-        
-        # Initialize the LLM model
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, api_key=api_key)
-        
-        # Create the prompt template for quiz generation
-        prompt = ChatPromptTemplate.from_template(
-            "You are an expert education content creator. Analyze this pdf in Markdown format:\n\n"
-            "{paper_markdown}\n\n"
-            "Create a comprehensive quiz to test understanding of the key concepts, methodologies, and findings "
-            "in this paper. Follow these guidelines:\n\n"
-            "1. Generate exactly 15 multiple-choice questions covering the most important aspects of the paper\n"
-            "2. Each question should have exactly 4 answer choices (A, B, C, D)\n"
-            "3. Provide one correct answer per question\n"
-            "4. Include a brief explanation for why the correct answer is right\n"
-            "5. Ensure questions assess both factual knowledge and conceptual understanding\n"
-            "6. Create a title for the quiz that reflects the paper's content\n\n"
-            "Structure your response as a JSON object with a 'title' field and a 'quiz' array containing question objects. "
-            "Each question object should have 'question', 'choices', 'correct_answer', and 'explanation' fields.\n\n"
-            "Make sure the correct_answer exactly matches one of the provided choices."
-        )
-        
-        # Create structured output model
-        structured_llm = llm.with_structured_output(QuizOutput)
-        
-        # Create and invoke the chain
-        chain = prompt | structured_llm
-        result = chain.invoke({"paper_markdown": paper.paper_markdown})
+        # Generate the quiz, or reuse the cached one for this paper
+        result, cached = await generate_artifact(llm, cache, "quiz", paper.paper_markdown)
+        response.headers["X-Cache"] = "hit" if cached else "miss"
         
         # Return the quiz
         return result
@@ -411,48 +1587,9 @@ async def generate_quiz(paper: PaperInput = Body(...)):
 
 
 
-@app.post("/mind-map", response_class=HTMLResponse)
-async def generate_mind_map(paper: PaperInput = Body(...)):
-    """
-    Generate a mind map of a research paper in markmap format and return a full HTML page.
-    
-    - Accepts a research paper in Markdown format
-    - Returns an HTML page rendering the mind map
-    """
-    try:
-        # Get API key from environment variable
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="Google API key not configured. Please set the GOOGLE_API_KEY environment variable."
-            )
-        
-        # Initialize the LLM model
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, api_key=api_key)
-        
-        # Create the prompt template for mind map generation
-        prompt = ChatPromptTemplate.from_template(
-            "You are an expert at creating detailed mind maps from academic research papers. "
-            "Analyze this research paper in Markdown format:\n\n"
-            "{paper_markdown}\n\n"
-            "Create a comprehensive hierarchical mind map in markmap markdown format "
-            "capturing the key concepts, relationships, and findings from the paper. "
-            "The mind map should be detailed but only include markmap-compatible content."
-        )
-        
-        # Structured output model
-        class MarkMapResponse(BaseModel):
-            markmap: str
-        
-        structured_llm = llm.with_structured_output(MarkMapResponse)
-        
-        # Invoke the chain
-        chain = prompt | structured_llm
-        result = chain.invoke({"paper_markdown": paper.paper_markdown})
-        
-        # Build the HTML page
-        html_content = f"""<!DOCTYPE html>
+def render_mind_map_html(markmap: str) -> str:
+    """Full HTML page rendering a markmap mind map"""
+    return f"""<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -517,7 +1654,7 @@ async def generate_mind_map(paper: PaperInput = Body(...)):
         <!-- Mindmap 2: Software Architecture -->
         <div class="markmap-card">
             <div class="markmap">
-              {result.markmap}
+              {markmap}
             </div>
         </div>
    </div>
@@ -525,225 +1662,898 @@ async def generate_mind_map(paper: PaperInput = Body(...)):
 </body>
 </html>
 """
+
+
+@app.post("/mind-map", response_class=HTMLResponse)
+async def generate_mind_map(
+    paper: PaperInput = Body(...),
+    llm = Depends(get_chat_llm),
+    cache: ResultCache = Depends(get_result_cache)
+):
+    """
+    Generate a mind map of a research paper in markmap format and return a full HTML page.
+    
+    - Accepts a research paper in Markdown format
+    - Returns an HTML page rendering the mind map
+    """
+    try:
+        # Generate the mind map, or reuse the cached one for this paper
+        result, cached = await generate_artifact(llm, cache, "mind_map", paper.paper_markdown)
+        
+        # Build the HTML page
+        html_content = render_mind_map_html(result.markmap)
+        
         # Return HTML response
-        return HTMLResponse(content=html_content)
+        return HTMLResponse(content=html_content, headers={"X-Cache": "hit" if cached else "miss"})
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Mind map generation failed: {str(e)}")    
   
   
 # Helper function to check if PDF exists in vector store
-def check_pdf_exists(pdf_name: str) -> bool:
+def lookup_documents(engine, pdf_names: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Catalog rows for the given PDFs, keyed by name"""
+    with engine.connect() as conn:
+        return catalog.get_documents(conn, pdf_names)
+
+def check_pdf_exists(engine, pdf_name: str) -> bool:
     """
-    Check if a PDF is already indexed in the vector store by performing a test query.
-    Returns True if the PDF exists (has indexed chunks), False otherwise.
+    Check if a PDF is already indexed by looking it up in the document catalog.
+    Returns True if the PDF has been indexed, False otherwise.
     """
-    try:
-        # Get embeddings model
-        embeddings = get_embeddings_model()
-        
-        # Create connection string
-        connection_string = create_connection_string(TIDB_CONNECTION_PARAMS)
-        
-        # Initialize the vector store
-        db = TiDBVectorStore(
-            embedding_function=embeddings,
-            connection_string=connection_string,
-            table_name=DEFAULT_TABLE_NAME,
-            distance_strategy="cosine"
-        )
-        
-        # Create retriever with filter for the specific PDF
-        retriever = db.as_retriever(
-            search_type="similarity", 
-            search_kwargs={
-                "k": 5, 
-                "filter": {"source": pdf_name}
+    with engine.connect() as conn:
+        return catalog.get_document(conn, pdf_name) is not None
+
+# Format documents function; passages are numbered so that the answer can cite them
+def format_docs(docs):
+    return "\n\n".join(
+        f"[{number}] ({describe_location(doc.metadata)})\n{doc.page_content}"
+        for number, doc in enumerate(docs, start=1)
+    )
+
+def describe_location(metadata: Dict[str, Any]) -> str:
+    """Source, section and page of a passage, as labelled in the prompt"""
+    location = f"source: {metadata.get('source', 'unknown')}"
+    if metadata.get("section"):
+        location += f", section: {metadata['section']}"
+    if metadata.get("page") is not None:
+        location += f", page {metadata['page']}"
+    return location
+
+class RetrievalStats:
+    """Counters for the chat retriever, reported by /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lexical = 0
+        self.hybrid = 0
+        self.vector = 0
+        self.multi_document = 0
+        self.documents_searched = 0
+        self.index_builds = 0
+        self.packed_contexts = 0
+        self.context_tokens = 0
+        self.top_k_tokens = 0
+        self.chunks_packed = 0
+        self.overlap_chars_removed = 0
+        self.neighbors = 0
+        self.embeddings_skipped = 0
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            queries = self.lexical + self.hybrid + self.vector
+            return {
+                "lexical_fast_path": self.lexical,
+                "hybrid": self.hybrid,
+                "vector_only": self.vector,
+                "multi_document": self.multi_document,
+                "avg_documents_per_multi_query": (
+                    round(self.documents_searched / self.multi_document, 2) if self.multi_document else 0.0
+                ),
+                # Chat questions answered without ever embedding the question
+                "embedding_calls_saved": self.embeddings_skipped,
+                "lexical_index_builds": self.index_builds,
+                "fast_path_ratio": round(self.lexical / queries, 4) if queries else 0.0,
+                "context_packing": {
+                    "contexts": self.packed_contexts,
+                    "avg_context_tokens": round(self.context_tokens / self.packed_contexts, 1) if self.packed_contexts else 0.0,
+                    "avg_chunks_packed": round(self.chunks_packed / self.packed_contexts, 2) if self.packed_contexts else 0.0,
+                    # Packed context size relative to the top_k chunks joined as they are
+                    "tokens_vs_top_k": round(self.context_tokens / self.top_k_tokens, 4) if self.top_k_tokens else 0.0,
+                    "overlap_chars_removed": self.overlap_chars_removed,
+                    "neighbor_chunks_added": self.neighbors,
+                },
             }
+
+RETRIEVAL_STATS = RetrievalStats()
+
+def build_lexical_index_from_store(
+    engine, vector_table, lexical_index: LexicalIndexStore, pdf_name: str, use_chunk_columns: bool = False
+) -> bool:
+    """
+    Build the BM25 index of a document from the chunks stored for it, so both rankings see the same
+    chunks (e.g. for a document indexed before lexical indexes existed); False if it has no chunks
+    """
+    with engine.connect() as conn:
+        rows = indexing.load_document_rows(conn, vector_table, pdf_name, use_chunk_columns)
+        document = catalog.get_document(conn, pdf_name)
+    if not rows:
+        return False
+    chunks = [text for _, text, _ in rows]
+    chunk_metas = [chunk_structure(meta) for _, _, meta in rows]
+    build_lexical_index(lexical_index, pdf_name, (document or {}).get("content_hash") or "", chunks, chunk_metas)
+    return True
+
+def chunk_identity(doc: Document) -> str:
+    """Key under which the same chunk from the lexical and the vector side is merged"""
+    return doc.metadata.get("chunk_hash") or indexing.chunk_key(doc.page_content, EMBEDDING_MODEL)
+
+class QuestionEmbedding:
+    """The embedding of a chat question, computed on first use and at most once per request"""
+
+    def __init__(self, embeddings: Embeddings, question: str):
+        self.embeddings = embeddings
+        self.question = question
+        self.value: Optional[List[float]] = None
+
+    async def vector(self) -> List[float]:
+        if self.value is None:
+            self.value = await run_blocking(self.embeddings.embed_query, self.question)
+        return self.value
+
+async def retrieve_context(
+    db: TiDBVectorStore,
+    resources: AppResources,
+    pdf_name: str,
+    question: str,
+    top_k: Optional[int] = None,
+    section: Optional[str] = None,
+    question_embedding: Optional[QuestionEmbedding] = None
+) -> tuple[List[Document], str]:
+    """
+    Hybrid retrieval over one PDF, `top_k` (CHAT_TOP_K) documents, from the chunks under a heading
+    containing `section` when given. Returns (documents, mode) where mode is:
+    - lexical: BM25 alone matched strongly enough, no embedding call was made
+    - hybrid: BM25 and vector rankings fused with reciprocal rank fusion
+    - vector: no BM25 index or no lexical match, vector results only
+    """
+    settings = RETRIEVAL_SETTINGS
+    top_k = top_k or settings["top_k"]
+    lexical_index = resources.lexical_index
+    
+    index = await run_blocking(lexical_index.get, pdf_name)
+    if index is None:
+        try:
+            if await run_blocking(
+                build_lexical_index_from_store,
+                db.tidb_vector_client._bind,
+                db.tidb_vector_client._table_model.__table__,
+                lexical_index,
+                pdf_name,
+                resources.chunk_columns
+            ):
+                index = await run_blocking(lexical_index.get, pdf_name)
+        except Exception as e:
+            logger.warning(f"Could not build the BM25 index of '{pdf_name}', using vector search only: {e}")
+    
+    lexical_docs: List[Document] = []
+    if index is not None:
+        with span("lexical_search"):
+            hits = await run_blocking(index.search, question, settings["candidates"])
+        lexical_docs = [
+            Document(
+                page_content=index.chunks[chunk_id],
+                metadata={"source": pdf_name, "chunk_hash": index.chunk_hashes[chunk_id], **index.chunk_metas[chunk_id]}
+            )
+            for chunk_id in hits.chunk_ids
+        ]
+        if section:
+            # The confidence is that of the best match in the whole document, so no fast path
+            lexical_docs = [doc for doc in lexical_docs if in_section(doc.metadata, section)]
+        elif (
+            lexical_docs
+            and settings["lexical_fast_path"] > 0
+            and hits.confidence >= settings["lexical_fast_path"]
+            and hits.evidence >= settings["lexical_min_evidence"]
+        ):
+            RETRIEVAL_STATS.incr("lexical")
+            return lexical_docs[:top_k], "lexical"
+    
+    with span("vector_search"):
+        query_vector = await question_embedding.vector() if question_embedding is not None else None
+        vector_docs = await resources.vector_backend(db).search(
+            [pdf_name], question, settings["candidates"], section=section, query_vector=query_vector
         )
-        
-        # Test question to check if PDF exists
-        test_question = "What are neural networks, and how do they work?"
-        
-        # Try to retrieve documents
-        retrieved_docs = retriever.invoke(test_question)
-        
-        # Return True if we found any documents, False otherwise
-        return len(retrieved_docs) > 0
-        
+    if not lexical_docs:
+        RETRIEVAL_STATS.incr("vector")
+        return vector_docs[:top_k], "vector"
+    
+    by_identity: Dict[str, Document] = {}
+    rankings = []
+    # Vector documents win on merge: they carry the full stored metadata
+    for docs in (lexical_docs, vector_docs):
+        ranking = []
+        for doc in docs:
+            identity = chunk_identity(doc)
+            by_identity[identity] = doc
+            ranking.append(identity)
+        rankings.append(ranking)
+    fused = reciprocal_rank_fusion(rankings, k=settings["rrf_k"])
+    RETRIEVAL_STATS.incr("hybrid")
+    return [by_identity[identity] for identity in fused[:top_k]], "hybrid"
+
+async def rerank_documents(resources: AppResources, question: str, docs: List[Document], top_k: int) -> List[Document]:
+    """
+    Order multi-document candidates by relevance to the question: with the Cohere reranker when
+    RERANK_MODEL is set, otherwise by fusing the vector order with BM25 over the candidates.
+    """
+    reranker = resources.reranker
+    if reranker is not None:
+        try:
+            with span("rerank"):
+                reranked = await resources.admission["cohere"].call(run_blocking, reranker.compress_documents, docs, question)
+            return list(reranked)[:top_k]
+        except Exception as e:
+            logger.warning(f"Reranking failed, keeping the vector order: {e}")
+            return docs[:top_k]
+    lexical_order = await run_blocking(rank_texts, question, [doc.page_content for doc in docs])
+    fused = reciprocal_rank_fusion([range(len(docs)), lexical_order], k=RETRIEVAL_SETTINGS["rrf_k"])
+    return [docs[position] for position in fused[:top_k]]
+
+async def retrieve_across_documents(
+    db: TiDBVectorStore,
+    resources: AppResources,
+    pdf_names: List[str],
+    question: str,
+    top_k: Optional[int] = None,
+    section: Optional[str] = None,
+    question_embedding: Optional[QuestionEmbedding] = None
+) -> tuple[List[Document], str]:
+    """
+    Retrieval over several PDFs: one vector search over all of them (narrowed to `section`),
+    at most `per_document` candidates from each, reranked down to `top_k` (CHAT_MULTI_TOP_K) chunks.
+    """
+    settings = RETRIEVAL_SETTINGS
+    top_k = top_k or settings["multi_top_k"]
+    query_vector = await question_embedding.vector() if question_embedding is not None else None
+    candidates = await resources.vector_backend(db).search(
+        pdf_names, question, max(settings["candidates"], 2 * top_k), settings["per_document"], section, query_vector
+    )
+    RETRIEVAL_STATS.incr("multi_document")
+    RETRIEVAL_STATS.incr("documents_searched", len(pdf_names))
+    return await rerank_documents(resources, question, candidates, top_k), "multi-document"
+
+def resolve_chat_sources(engine, request: ChatRequest) -> List[str]:
+    """
+    The PDFs a chat request asks about: `pdf_name`, `pdf_names` and the members of `collection`.
+    Requests spanning several PDFs are narrowed to the ones that are indexed.
+    """
+    names = ([request.pdf_name] if request.pdf_name else []) + list(request.pdf_names or [])
+    if request.collection:
+        with engine.connect() as conn:
+            members = catalog.collection_documents(conn, request.collection)
+        if not members:
+            raise HTTPException(status_code=404, detail=f"Collection '{request.collection}' is empty or does not exist")
+        names.extend(members)
+    names = list(dict.fromkeys(names))
+    if not names:
+        raise HTTPException(status_code=400, detail="Provide pdf_name, pdf_names or collection")
+    if len(names) > RETRIEVAL_SETTINGS["max_documents"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A question can span at most {RETRIEVAL_SETTINGS['max_documents']} PDFs, got {len(names)}"
+        )
+    if len(names) == 1:
+        return names
+    indexed = lookup_documents(engine, names)
+    names = [name for name in names if name in indexed]
+    if not names:
+        raise HTTPException(status_code=404, detail="None of the requested PDFs are indexed")
+    return names
+
+async def retrieve_for_chat(
+    db: TiDBVectorStore,
+    resources: AppResources,
+    pdf_names: List[str],
+    question: str,
+    section: Optional[str] = None,
+    question_embedding: Optional[QuestionEmbedding] = None
+) -> tuple[List[Document], str]:
+    """
+    Hybrid retrieval for a single PDF, multi-document retrieval otherwise; as many candidates as
+    packing needs, and the neighbours of the best ones when the context is packed.
+    The question is embedded only if a vector search runs, reusing `question_embedding` if given.
+    """
+    question_embedding = question_embedding or QuestionEmbedding(db.embeddings, question)
+    top_k = chat_candidates(len(pdf_names))
+    if len(pdf_names) == 1:
+        docs, mode = await retrieve_context(db, resources, pdf_names[0], question, top_k, section, question_embedding)
+    else:
+        docs, mode = await retrieve_across_documents(db, resources, pdf_names, question, top_k, section, question_embedding)
+    if question_embedding.value is None:
+        RETRIEVAL_STATS.incr("embeddings_skipped")
+    top_k, budget = chat_budget(len(pdf_names))
+    if budget > 0 and RETRIEVAL_SETTINGS["neighbor_window"] > 0:
+        docs = await expand_neighbors(resources.vector_backend(db), docs, top_k, section)
+    return docs, mode
+
+async def expand_neighbors(backend: VectorBackend, docs: List[Document], top_k: int, section: Optional[str]) -> List[Document]:
+    """
+    Add the chunks around the best hits, looked up by ordinal without another vector query.
+    They rank after the top_k hits, ahead of the remaining candidates.
+    """
+    window = RETRIEVAL_SETTINGS["neighbor_window"]
+    present = {(doc.metadata.get("source"), doc.metadata.get("ordinal")) for doc in docs}
+    wanted: Dict[str, set] = {}
+    order: Dict[tuple, tuple] = {}
+    for rank, doc in enumerate(docs[:RETRIEVAL_SETTINGS["neighbor_hits"]]):
+        source, ordinal = doc.metadata.get("source"), doc.metadata.get("ordinal")
+        if ordinal is None:
+            continue
+        for offset in range(-window, window + 1):
+            key = (source, ordinal + offset)
+            if offset and ordinal + offset >= 0 and key not in present:
+                wanted.setdefault(source, set()).add(ordinal + offset)
+                order.setdefault(key, (rank, abs(offset)))
+    if not wanted:
+        return docs
+    try:
+        with span("neighbors"):
+            neighbors = await backend.neighbors(wanted)
     except Exception as e:
-        print(f"Error querying TiDB: {e}")
-        return False
+        logger.warning(f"Could not load neighbouring chunks: {e}")
+        return docs
+    neighbors = [doc for doc in neighbors if not section or in_section(doc.metadata, section)]
+    neighbors.sort(key=lambda doc: order.get((doc.metadata.get("source"), doc.metadata.get("ordinal")), (len(docs), 0)))
+    RETRIEVAL_STATS.incr("neighbors", len(neighbors))
+    return docs[:top_k] + neighbors + docs[top_k:]
+
+def chat_budget(document_count: int) -> tuple[int, int]:
+    """(top_k, context token budget) of a chat question about this many PDFs"""
+    settings = RETRIEVAL_SETTINGS
+    if document_count == 1:
+        return settings["top_k"], settings["context_tokens"]
+    return settings["multi_top_k"], settings["multi_context_tokens"]
+
+def chat_candidates(document_count: int) -> int:
+    """Chunks to retrieve for a chat question: more than top_k when they are packed to a token budget"""
+    top_k, budget = chat_budget(document_count)
+    return max(top_k, RETRIEVAL_SETTINGS["pack_candidates"]) if budget > 0 else top_k
+
+def pack_chat_context(docs: List[Document], document_count: int) -> PackedContext:
+    """
+    The passages of the chat prompt: the retrieved chunks packed into the token budget
+    best first, or the top_k chunks as they are when packing is disabled
+    """
+    top_k, budget = chat_budget(document_count)
+    top_k_tokens = estimate_tokens(format_docs(docs[:top_k]))
+    if budget > 0 and docs:
+        packed = pack_context(docs, budget, format_docs)
+    else:
+        packed = PackedContext(passages=docs[:top_k], tokens=top_k_tokens, candidates=len(docs), chunks_used=len(docs[:top_k]))
+    RETRIEVAL_STATS.incr("packed_contexts")
+    RETRIEVAL_STATS.incr("context_tokens", packed.tokens)
+    RETRIEVAL_STATS.incr("top_k_tokens", top_k_tokens)
+    RETRIEVAL_STATS.incr("chunks_packed", packed.chunks_used)
+    RETRIEVAL_STATS.incr("overlap_chars_removed", packed.overlap_chars_removed)
+    return packed
+
+def answer_cache_scope(engine, pdf_names: List[str]):
+    """Cache scope of a question about the PDFs, or None if one of them is not in the catalog"""
+    documents = lookup_documents(engine, pdf_names)
+    if len(documents) != len(pdf_names):
+        return None
+    return answer_scope({name: version_of(document) for name, document in documents.items()})
+
+def describe_source(doc: Document, number: int) -> Dict[str, Any]:
+    """Short description of a context passage for clients, under the number the answer cites it by"""
+    chunk_hash = doc.metadata.get("chunk_hash")
+    return {
+        "id": number,
+        "source": doc.metadata.get("source"),
+        "chunk_hash": chunk_hash,
+        "chunk_hashes": doc.metadata.get("chunk_hashes") or ([chunk_hash] if chunk_hash else []),
+        "section": doc.metadata.get("section"),
+        "page": doc.metadata.get("page"),
+        "preview": doc.page_content[:200]
+    }
 
 # Endpoints
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(
+    request: ChatRequest,
+    response: Response,
+    db: TiDBVectorStore = Depends(get_vector_store),
+    resources: AppResources = Depends(get_resources),
+    llm = Depends(get_qa_llm)
+):
     """
     Answer questions about PDF content by:
-    1. Retrieving relevant chunks from the vector database
-    2. Using RAG to generate an answer based on the retrieved context
+    1. Retrieving relevant chunks with BM25 and vector search, fused by reciprocal rank
+       (BM25 alone when it matches strongly, skipping the embedding call)
+    2. Adding the chunks around the best hits and packing the candidates into a token
+       budget (CHAT_CONTEXT_TOKENS): consecutive chunks are merged into one passage
+    3. Using RAG to generate an answer based on the packed context
+    
+    Ask about one PDF with `pdf_name`, or across several with `pdf_names` and/or `collection`:
+    those are searched with a single vector query, capped per document and reranked.
+    The answer cites the numbered `citations`; the retrieval mode is reported in the
+    `X-Retrieval-Mode` header and the size of the packed context in `context_tokens`.
+    `section` restricts the search to chunks under a matching heading.
+    
+    Paraphrases of a question already answered for the same PDFs and index versions are
+    served from the semantic answer cache (`X-Cache: hit`) unless `use_cache` is false.
     """
     try:
-        # Get embeddings model
-        embeddings = get_embeddings_model()
-        
-        # Determine table name
-        table_name = DEFAULT_TABLE_NAME
-        
-        # Create connection string
-        connection_string = create_connection_string(TIDB_CONNECTION_PARAMS)
-        
-        # Initialize the vector store
-        db = TiDBVectorStore(
-            embedding_function=embeddings,
-            connection_string=connection_string,
-            table_name=table_name,
-            distance_strategy="cosine"
-        )
-        
-        # Create retriever with filter for the specific PDF
-        retriever = db.as_retriever(
-            search_type="similarity", 
-            search_kwargs={
-                "k": 5, 
-                "filter": {"source": request.pdf_name}
-            }
-        )
-        
-        # Format documents function
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
+        engine = db.tidb_vector_client._bind
+        pdf_names = await run_blocking(resolve_chat_sources, engine, request)
         
-        # Create prompt template
-        prompt = PromptTemplate.from_template(QA_PROMPT_TEMPLATE)
+        # Look for an answer to a similar question first
+        # Answers narrowed to a section are not cached: the cache is scoped to whole PDFs
+        # The question is embedded only if a paraphrase could match or a vector search needs it
+        question_embedding = QuestionEmbedding(db.embeddings, request.question)
+        answer_cache = resources.answer_cache if request.use_cache and not request.section else None
+        scope = None
+        if answer_cache is not None:
+            cached = None
+            with span("answer_cache"):
+                scope = await run_blocking(answer_cache_scope, engine, pdf_names)
+                if scope is not None:
+                    entry = answer_cache.lookup_text(scope, request.question)
+                    if entry is not None:
+                        cached = entry, 1.0
+                    elif answer_cache.has_vectors(scope):
+                        cached = answer_cache.lookup(scope, await question_embedding.vector())
+                    else:
+                        answer_cache.record_miss()
+            if cached is not None:
+                entry, similarity = cached
+                response.headers["X-Cache"] = "hit"
+                response.headers["X-Cache-Similarity"] = f"{similarity:.4f}"
+                return ChatResponse(question=request.question, **entry.answer)
+            response.headers["X-Cache"] = "miss"
         
-        # Get LLM
-        llm = get_llm()
+        # Retrieve the context once and reuse it for the prompt
+        with span("retrieve"):
+            retrieved_docs, mode = await retrieve_for_chat(
+                db, resources, pdf_names, request.question, request.section, question_embedding
+            )
+        response.headers["X-Retrieval-Mode"] = mode
         
-        # Create RAG chain
-        rag_chain = (
-            {
-                "context": retriever | RunnableLambda(format_docs), 
-                "question": RunnablePassthrough()
-            }
-            | prompt
-            | llm
-        )
+        # Pack the context into the token budget, build the prompt and generate the answer
+        with span("prompt_build"):
+            context = pack_chat_context(retrieved_docs, len(pdf_names))
+            prompt_value = await PromptTemplate.from_template(QA_PROMPT_TEMPLATE).ainvoke({
+                "context": format_docs(context.passages),
+                "question": request.question
+            })
+        record_tokens("gemini", "input", prompt_value.to_string())
+        with span("llm"):
+            answer = await llm.ainvoke(prompt_value)
+        record_tokens("gemini", "output", answer)
         
-        # Execute the chain
-        retrieved_docs = retriever.invoke(request.question)
-        answer = rag_chain.invoke(request.question)
+        citations = [describe_source(doc, number) for number, doc in enumerate(context.passages, start=1)]
+        if scope is not None:
+            # Without an embedding (BM25 fast path) the answer is only found again for the same question
+            answer_cache.put(scope, request.question, question_embedding.value, {"answer": answer, "citations": citations})
         
         return ChatResponse(
             question=request.question,
-            answer=answer
+            answer=answer,
+            citations=citations,
+            context_tokens=context.tokens
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
 
+def sse_event(event: str, data: Any) -> str:
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(
+    request: ChatRequest,
+    db: TiDBVectorStore = Depends(get_vector_store),
+    resources: AppResources = Depends(get_resources),
+    llm = Depends(get_qa_llm)
+):
+    """
+    Stream an answer about PDF content as Server-Sent Events.
+    
+    - `sources`: sent first, the passages packed as context, numbered as the answer cites them
+    - `token`: answer text as it is generated
+    - `done` once the answer is complete, with `context_tokens`, or `error` if generation fails
+    
+    Requests for unknown PDFs or collections are rejected with an HTTP error, as by /chat,
+    before the stream starts.
+    """
+    try:
+        pdf_names = await run_blocking(resolve_chat_sources, db.tidb_vector_client._bind, request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
+    
+    async def event_stream():
+        try:
+            with span("retrieve"):
+                retrieved_docs, mode = await retrieve_for_chat(db, resources, pdf_names, request.question, request.section)
+            context = pack_chat_context(retrieved_docs, len(pdf_names))
+            yield sse_event("sources", [describe_source(doc, number) for number, doc in enumerate(context.passages, start=1)])
+            
+            with span("prompt_build"):
+                prompt_value = await PromptTemplate.from_template(QA_PROMPT_TEMPLATE).ainvoke({
+                    "context": format_docs(context.passages),
+                    "question": request.question
+                })
+            record_tokens("gemini", "input", prompt_value.to_string())
+            answer = []
+            started = time.perf_counter()
+            with span("llm"):
+                async for token in llm.astream(prompt_value):
+                    if token:
+                        if not answer:
+                            record_span("first_token", time.perf_counter() - started)
+                        answer.append(token)
+                        yield sse_event("token", {"text": token})
+            record_tokens("gemini", "output", "".join(answer))
+            yield sse_event("done", {"question": request.question, "context_tokens": context.tokens})
+            
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"Error generating answer: {str(e)}"})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Status of the latest background indexing job of a PDF, as reported by /check-index
+INDEX_JOB_STATUSES = {QUEUED: "pending", RUNNING: "indexing", SUCCEEDED: "ready", FAILED: "failed"}
+
+def build_check_index_response(pdf_name: str, is_indexed: bool, job=None) -> CheckIndexResponse:
+    job_status = INDEX_JOB_STATUSES.get(job.status) if job is not None else None
+    if job_status in ("pending", "indexing"):
+        status = job_status
+        message = f"PDF '{pdf_name}' is being indexed in the background ({job_status})"
+    elif is_indexed:
+        status = "ready"
+        message = f"PDF '{pdf_name}' is already indexed and ready for chat"
+    elif job_status == "failed":
+        status = "failed"
+        message = f"Indexing PDF '{pdf_name}' failed: {job.error}"
+    else:
+        status = "not_indexed"
+        message = f"PDF '{pdf_name}' is not indexed yet. Click 'Index PDF' to enable chat"
+    
+    return CheckIndexResponse(
+        is_indexed=is_indexed,
+        pdf_name=pdf_name,
+        message=message,
+        status=status,
+        job_id=job.id if job is not None else None
+    )
+
+def latest_index_jobs(job_queue: JobQueue, pdf_names: List[str]) -> Dict[str, Any]:
+    """Latest background indexing job of each PDF that has one"""
+    jobs = {name: job_queue.store.find_latest("index", "pdf_name", name) for name in pdf_names}
+    return {name: job for name, job in jobs.items() if job is not None}
+
 @app.post("/check-index", response_model=CheckIndexResponse)
-async def check_index(request: CheckIndexRequest):
+async def check_index(
+    request: CheckIndexRequest,
+    engine = Depends(get_engine),
+    job_queue: JobQueue = Depends(get_index_job_queue)
+):
     """
     Check if a PDF is already indexed in the vector store.
-    Returns the indexing status without performing any indexing operations.
+    Returns the indexing status without performing any indexing operations,
+    including the progress of background indexing started by /process-pdf.
     """
     try:
-        is_indexed = check_pdf_exists(request.pdf_name)
+        is_indexed = await run_blocking(check_pdf_exists, engine, request.pdf_name)
+        job = await job_queue.find_latest("index", "pdf_name", request.pdf_name)
+        return build_check_index_response(request.pdf_name, is_indexed, job)
         
-        if is_indexed:
-            message = f"PDF '{request.pdf_name}' is already indexed and ready for chat"
-        else:
-            message = f"PDF '{request.pdf_name}' is not indexed yet. Click 'Index PDF' to enable chat"
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error checking index status: {str(e)}")
+
+@app.post("/check-index/batch", response_model=CheckIndexBatchResponse)
+async def check_index_batch(
+    request: CheckIndexBatchRequest,
+    engine = Depends(get_engine),
+    job_queue: JobQueue = Depends(get_index_job_queue)
+):
+    """
+    Check the indexing status of several PDFs with a single catalog query.
+    """
+    try:
+        indexed = await run_blocking(lookup_documents, engine, request.pdf_names)
+        jobs = await run_blocking(latest_index_jobs, job_queue, request.pdf_names)
         
-        return CheckIndexResponse(
-            is_indexed=is_indexed,
-            pdf_name=request.pdf_name,
-            message=message
+        return CheckIndexBatchResponse(
+            results=[
+                build_check_index_response(pdf_name, pdf_name in indexed, jobs.get(pdf_name))
+                for pdf_name in request.pdf_names
+            ]
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error checking index status: {str(e)}")
 
-@app.post("/index-pdf", response_model=IndexPDFResponse)
-async def index_pdf(request: IndexPDFRequest):
+def read_collection(engine, collection: str) -> CollectionResponse:
+    with engine.connect() as conn:
+        members = catalog.collection_documents(conn, collection)
+        indexed = catalog.get_documents(conn, members)
+    return CollectionResponse(
+        collection=collection,
+        pdf_names=members,
+        not_indexed=[name for name in members if name not in indexed]
+    )
+
+def update_collection(engine, request: CollectionRequest, remove: bool = False) -> CollectionResponse:
+    with engine.begin() as conn:
+        if remove:
+            catalog.remove_from_collection(conn, request.collection, request.pdf_names)
+        else:
+            catalog.add_to_collection(conn, request.collection, request.pdf_names)
+    return read_collection(engine, request.collection)
+
+@app.post("/collections", response_model=CollectionResponse)
+async def add_to_collection(request: CollectionRequest, engine = Depends(get_engine)):
     """
-    Index PDF content by:
-    1. First checking if the PDF is already indexed
-    2. If not indexed, splitting the markdown content into chunks
-    3. Creating embeddings for each chunk
-    4. Storing the embeddings in a vector database
+    Add PDFs to a collection, creating it if needed. `/chat` can then be asked about the
+    whole collection with `collection`. PDFs may be added before they are indexed.
     """
     try:
-        # First check if PDF is already indexed
-        if check_pdf_exists(request.pdf_name):
-            return IndexPDFResponse(
-                success=True,
-                message=f"PDF '{request.pdf_name}' is already indexed",
-                chunks_created=0,
-                pdf_name=request.pdf_name,
-                table_name=DEFAULT_TABLE_NAME
+        return await run_blocking(update_collection, engine, request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating collection: {str(e)}")
+
+@app.post("/collections/remove", response_model=CollectionResponse)
+async def remove_from_collection(request: CollectionRequest, engine = Depends(get_engine)):
+    """Remove PDFs from a collection; the PDFs themselves stay indexed"""
+    try:
+        return await run_blocking(update_collection, engine, request, remove=True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error updating collection: {str(e)}")
+
+@app.get("/collections/{collection}", response_model=CollectionResponse)
+async def get_collection(collection: str, engine = Depends(get_engine)):
+    """List the PDFs of a collection"""
+    try:
+        result = await run_blocking(read_collection, engine, collection)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading collection: {str(e)}")
+    if not result.pdf_names:
+        raise HTTPException(status_code=404, detail=f"Collection '{collection}' not found")
+    return result
+
+def split_markdown_chunks(content: str) -> List[Chunk]:
+    """Split paper markdown into the chunks that are embedded and indexed, along its headings, tables and formulas"""
+    return split_markdown(content, chunk_size=INDEXING_SETTINGS["chunk_size"])
+
+def chunk_structure(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Section, page, ordinal and token count of a stored chunk, for its BM25 entry"""
+    return {key: meta[key] for key in ("section", "page", "ordinal", "tokens") if meta.get(key) is not None}
+
+def build_lexical_index(
+    lexical_index: LexicalIndexStore,
+    pdf_name: str,
+    content_hash: str,
+    chunks: List[str],
+    chunk_metas: Optional[List[Dict[str, Any]]] = None
+) -> None:
+    """Write the BM25 index of a document over the same chunks as its vectors"""
+    chunk_hashes = [indexing.chunk_key(chunk, EMBEDDING_MODEL) for chunk in chunks]
+    lexical_index.build(pdf_name, content_hash, chunks, chunk_hashes, chunk_metas)
+    RETRIEVAL_STATS.incr("index_builds")
+
+def update_local_vectors(local_vectors: LocalVectorIndex, pdf_name: str, content_hash: str, result: indexing.IndexResult) -> None:
+    """Mirror an indexing run into the local vector replica"""
+    if result.chunks_created == result.chunks_total and not result.deleted_ids:
+        # Every row of the document was just written: load it in full
+        local_vectors.replace_document(pdf_name, content_hash, result.inserted_rows)
+    else:
+        local_vectors.apply_changes(pdf_name, content_hash, result.inserted_rows, result.deleted_ids, result.updated_rows)
+
+async def index_markdown(
+    db: TiDBVectorStore, resources: AppResources, pdf_name: str, content: str, content_hash: Optional[str] = None
+) -> IndexPDFResponse:
+    """
+    Index the markdown of a PDF; shared by /index-pdf and the indexing jobs started by /process-pdf.
+    `content_hash` is that of the text returned by /process-pdf when `content` is its paged markdown.
+    """
+    engine = db.tidb_vector_client._bind
+    content_hash = content_hash or markdown_hash(content)
+    lexical_index = resources.lexical_index
+    
+    # First check if this exact content is already indexed
+    indexed = (await run_blocking(lookup_documents, engine, [pdf_name])).get(pdf_name)
+    if indexed and indexed["content_hash"] == content_hash:
+        if await run_blocking(lexical_index.content_hash, pdf_name) != content_hash:
+            # Rebuild from the stored chunks: splitting again may not give the chunks the vectors were made from
+            await run_blocking(
+                build_lexical_index_from_store, engine, db.tidb_vector_client._table_model.__table__,
+                lexical_index, pdf_name, resources.chunk_columns
             )
-        
-        # Initialize the text splitter with default values
-        splitter = MarkdownTextSplitter(
-            chunk_size=1500,  # Default chunk size
-            chunk_overlap=200,  # Default chunk overlap
-            keep_separator=True,
-            is_separator_regex=False
-        )
-        
-        # Split the text into chunks
-        chunks = splitter.split_text(request.content)
-        
-        # Create document objects with metadata
-        documents = [
-            Document(
-                page_content=chunk, 
-                metadata={"source": request.pdf_name}
-            ) 
-            for chunk in chunks
-        ]
-        
-        # Get embeddings model
-        embeddings = get_embeddings_model()
-        
-        # Use default table name
-        table_name = DEFAULT_TABLE_NAME
-        
-        # Create connection string
-        connection_string = create_connection_string(TIDB_CONNECTION_PARAMS)
-        
-        # Store documents in the vector database
-        db = TiDBVectorStore.from_documents(
-            documents=documents,
-            embedding=embeddings,
-            table_name=table_name,
-            connection_string=connection_string,
-            distance_strategy="cosine",
-        )
-        
         return IndexPDFResponse(
             success=True,
-            message=f"Successfully indexed {len(chunks)} chunks from PDF",
-            chunks_created=len(chunks),
-            pdf_name=request.pdf_name,
-            table_name=table_name
+            message=f"PDF '{pdf_name}' is already indexed",
+            chunks_created=0,
+            pdf_name=pdf_name,
+            table_name=DEFAULT_TABLE_NAME,
+            chunks_reused=indexed["chunk_count"]
         )
+    
+    # Split the text into chunks
+    with span("split"):
+        chunks = await run_blocking(split_markdown_chunks, content)
+    
+    # Embed new chunks only and write the changes with the catalog row; both run in worker threads
+    result = await run_blocking(
+        indexing.index_document,
+        engine,
+        db.tidb_vector_client._table_model.__table__,
+        db.embeddings,
+        EMBEDDING_MODEL,
+        pdf_name,
+        content_hash,
+        [chunk.text for chunk in chunks],
+        batcher=resources.embedding_batcher,
+        insert_batch_rows=INDEXING_SETTINGS["insert_batch_rows"],
+        chunk_metadata=[chunk.metadata() for chunk in chunks],
+        use_chunk_columns=resources.chunk_columns
+    )
+    record_span("embed", result.embed_seconds, chunks=result.chunks_embedded, batches=result.embed_batches)
+    record_span("insert", result.insert_seconds, statements=result.insert_statements)
+    with span("lexical_index"):
+        await run_blocking(
+            build_lexical_index, lexical_index, pdf_name, content_hash,
+            [chunk.text for chunk in chunks], [chunk.metadata() for chunk in chunks]
+        )
+    answer_cache = resources.answer_cache
+    if answer_cache is not None:
+        answer_cache.invalidate([pdf_name])
+    local_vectors = resources.local_vectors
+    if local_vectors is not None:
+        await run_blocking(update_local_vectors, local_vectors, pdf_name, content_hash, result)
+    
+    return IndexPDFResponse(
+        success=True,
+        message=(
+            f"Successfully indexed {result.chunks_total} chunks from PDF "
+            f"({result.chunks_embedded} embedded, {result.chunks_reused} reused, {result.chunks_removed} removed)"
+        ),
+        chunks_created=result.chunks_created,
+        pdf_name=pdf_name,
+        table_name=DEFAULT_TABLE_NAME,
+        chunks_reused=result.chunks_reused,
+        chunks_embedded=result.chunks_embedded,
+        chunks_removed=result.chunks_removed,
+        chunks_per_second=round(result.chunks_per_second, 1),
+        embed_ms=round(result.embed_seconds * 1000, 1),
+        insert_ms=round(result.insert_seconds * 1000, 1),
+        embed_batches=result.embed_batches,
+        chunks_updated=result.chunks_updated
+    )
+
+@app.post("/index-pdf", response_model=IndexPDFResponse)
+async def index_pdf(
+    request: IndexPDFRequest,
+    db: TiDBVectorStore = Depends(get_vector_store),
+    resources: AppResources = Depends(get_resources)
+):
+    """
+    Index PDF content by:
+    1. Skipping the request if the same content is already indexed under this name
+    2. Splitting the markdown content into chunks keyed by their content hash
+    3. Creating embeddings only for chunks that have no stored vector, in concurrent provider-sized batches
+    4. Storing new chunks with multi-row INSERTs and deleting chunks that disappeared, in one transaction
+    5. Writing the BM25 index of the chunks used by hybrid chat retrieval
+    """
+    try:
+        return await index_markdown(db, resources, request.pdf_name, request.content)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error indexing PDF: {str(e)}")
 
 
+async def index_job_handler(
+    ctx: JobContext,
+    resources: AppResources,
+    get_store: Optional[Callable[[], TiDBVectorStore]] = None
+) -> Dict[str, Any]:
+    """Index the markdown extracted by /process-pdf"""
+    CURRENT_ENDPOINT.set("job")
+    try:
+        content = await run_blocking(Path(ctx.payload["file_path"]).read_text, encoding="utf-8")
+        await ctx.report("indexing", 0.1)
+        db = get_store() if get_store is not None else await run_blocking(lambda: resources.vector_store)
+        with start_trace("job:index", TRACES):
+            result = await index_markdown(db, resources, ctx.payload["pdf_name"], content, ctx.payload.get("content_hash"))
+        return result.model_dump()
+    finally:
+        await run_blocking(remove_job_upload, ctx.job)
 
 
+def wants_prometheus(request: Request) -> bool:
+    """Prometheus scrapers ask for text/plain or OpenMetrics; everyone else gets JSON"""
+    if request.query_params.get("format") in ("prometheus", "text"):
+        return True
+    accept = request.headers.get("accept", "")
+    return ("text/plain" in accept or "openmetrics" in accept) and "application/json" not in accept
 
+@app.get("/metrics")
+async def metrics(request: Request, resources: AppResources = Depends(get_resources)):
+    """
+    Report runtime counters for the shared resources, as JSON or, for Prometheus
+    (`Accept: text/plain` or `?format=prometheus`), in the text exposition format with
+    latency histograms per route, stage and provider, token and byte counters, and every
+    number below as a gauge.
+    
+    - tidb_pool: connection checkouts, waits for a free connection and TLS handshakes
+    - embedding_cache: hits, misses and evictions per cache tier and provider calls
+    - event_loop: how often and for how long the event loop was blocked
+    - result_cache: generation cache hits, misses and coalesced requests
+    - ocr_cache: OCR cache hits, misses, evictions and size
+    - retrieval: chat queries answered by the BM25 fast path, hybrid fusion or vectors only
+    - vector_replica: documents, rows and searches of the local vector replica (VECTOR_BACKEND=local)
+    - ocr_jobs, index_jobs: job backlog, rejections and outcomes of OCR and background indexing jobs
+    - indexing: embedding batches sent and in flight for /index-pdf
+    - answer_cache: semantic chat cache hit rate and best-match similarity distribution
+    - admission: per provider calls in flight, queue depth, rejections, upstream errors and retries
+    - slow_requests: stage spans of the slowest recent requests and jobs (JSON only)
+    """
+    snapshot = {
+        "event_loop": request.app.state.loop_monitor.stats(),
+        "tidb_pool": resources.pool_metrics(),
+        "embedding_cache": resources.embedding_cache_metrics(),
+        "result_cache": resources.result_cache.stats(),
+        "ocr_cache": resources.ocr_cache_metrics(),
+        "retrieval": RETRIEVAL_STATS.snapshot(),
+        "vector_replica": resources.local_vectors.stats() if resources.local_vectors is not None else None,
+        "ocr_jobs": request.app.state.job_queue.stats(),
+        "index_jobs": request.app.state.index_job_queue.stats(),
+        "indexing": resources.embedding_batcher.stats(),
+        "answer_cache": resources.answer_cache.stats() if resources.answer_cache is not None else None,
+        "admission": resources.admission_metrics(),
+    }
+    if wants_prometheus(request):
+        return PlainTextResponse(REGISTRY.render(snapshot), media_type="text/plain; version=0.0.4; charset=utf-8")
+    snapshot["slow_requests"] = TRACES.recent()
+    return snapshot
+
+@app.get("/metrics/profiles/{trace_id}", response_class=PlainTextResponse)
+async def get_profile(trace_id: str):
+    """
+    Collapsed stacks (flamegraph.pl / speedscope format) sampled during a request sent with
+    `X-Profile: 1`; its trace id is returned in `X-Profile-Id`. Needs PROFILING_ENABLED.
+    """
+    profile = TRACES.profile(trace_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile for trace '{trace_id}'")
+    return profile
 
 
 @app.post("/generate-faqs", response_model=FAQOutput)
-async def generate_faqs(faq_input: FAQInput = Body(...)):
+async def generate_faqs(
+    response: Response,
+    faq_input: FAQInput = Body(...),
+    llm = Depends(get_chat_llm),
+    cache: ResultCache = Depends(get_result_cache)
+):
     """
     Generate frequently asked questions and answers based on a research paper.
     
@@ -752,42 +2562,296 @@ async def generate_faqs(faq_input: FAQInput = Body(...)):
     - The number of questions can be customized (default: 5, max: 10)
     """
     try:
-        # Get API key from environment variable
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        if not api_key:
-            raise HTTPException(
-                status_code=500, 
-                detail="Google API key not configured. Please set the GOOGLE_API_KEY environment variable."
-            )
-        
-        # Initialize the LLM model
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, api_key=api_key)
-        
-        # Create the prompt template for FAQ generation
-        prompt = ChatPromptTemplate.from_template(
-            "You are an expert at creating comprehensive FAQs for academic research papers. "
-            "Analyze this research paper in Markdown format:\n\n"
-            "{paper_markdown}\n\n"
-            "Generate {num_questions} frequently asked questions with detailed answers that would be most helpful "
-            "for someone trying to understand this paper. Focus on key concepts, methodologies, findings, and implications. "
-            "The questions should be clear and specific, and the answers should be thorough, accurate, and educational.\n\n"
-            "Format your response as a JSON array of objects, each with 'question' and 'answer' fields."
+        # Generate the FAQs, or reuse the cached ones for this paper
+        result, cached = await generate_artifact(
+            llm, cache, "faqs", faq_input.paper_markdown, faq_input.num_questions
         )
-        
-        # Create structured output model
-        structured_llm = llm.with_structured_output(FAQOutput)
-        
-        # Create and invoke the chain
-        chain = prompt | structured_llm
-        result = chain.invoke({
-            "paper_markdown": faq_input.paper_markdown,
-            "num_questions": faq_input.num_questions
-        })
+        response.headers["X-Cache"] = "hit" if cached else "miss"
         
         # Return the generated FAQs
         return result
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"FAQ generation failed: {str(e)}")
+
+
+@app.post("/studio/generate")
+async def generate_studio_artifacts(
+    request: StudioGenerateRequest,
+    llm = Depends(get_chat_llm),
+    cache: ResultCache = Depends(get_result_cache)
+):
+    """
+    Generate several studio artifacts for one paper in a single request.
+    
+    - Accepts the paper once plus the artifacts to generate (summary, quiz, faqs, mind_map)
+    - Generates them concurrently with a shared prompt prefix so provider-side context caching applies
+    - Streams each result as a Server-Sent `artifact` event as soon as it completes, using the same
+      schemas as the dedicated endpoints (mind_map returns the markmap markdown)
+    - Results are served from the generation cache when available (`cached` in the event)
+    - A failed artifact is reported as an `error` event without affecting the others; `done` ends the stream
+    """
+    async def generate(artifact: str) -> str:
+        try:
+            result, cached = await generate_artifact(
+                llm, cache, artifact, request.paper_markdown, request.num_questions
+            )
+            return sse_event("artifact", {
+                "artifact": artifact,
+                "cached": cached,
+                "result": jsonable_encoder(result)
+            })
+        except Exception as e:
+            return sse_event("error", {"artifact": artifact, "detail": f"Generation of {artifact} failed: {str(e)}"})
+    
+    async def event_stream():
+        tasks = [asyncio.create_task(generate(artifact)) for artifact in dict.fromkeys(request.artifacts)]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                yield await completed
+            yield sse_event("done", {"artifacts": list(dict.fromkeys(request.artifacts))})
+        finally:
+            # Stop outstanding generations if the client disconnects
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/cache/invalidate")
+async def invalidate_cached_results(
+    request: CacheInvalidateRequest,
+    cache: ResultCache = Depends(get_result_cache)
+):
+    """
+    Drop cached generation results for a paper.
+    
+    - Identify the paper by its Markdown or by the SHA-256 of the Markdown
+    - Optionally restrict invalidation to one artifact
+    """
+    if request.paper_hash:
+        paper_hash = request.paper_hash
+    elif request.paper_markdown is not None:
+        paper_hash = hash_text(request.paper_markdown)
+    else:
+        raise HTTPException(status_code=400, detail="Provide either paper_markdown or paper_hash")
+    
+    try:
+        removed = await cache.invalidate(paper_hash, request.artifact)
+        return {"paper_hash": paper_hash, "removed": removed}
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Cache invalidation failed: {str(e)}")
+
+
+def parse_ingest_args(argv: List[str]) -> argparse.Namespace:
+    settings = INGEST_SETTINGS
+    parser = argparse.ArgumentParser(prog="main.py ingest", description="Index every PDF under a directory")
+    parser.add_argument("directory", type=Path, help="Directory searched recursively for PDFs, or a single PDF")
+    parser.add_argument("--manifest", default=settings["manifest_path"], help="Progress checkpoint; a rerun resumes from it")
+    parser.add_argument("--hash-workers", type=int, default=settings["hash_workers"])
+    parser.add_argument("--ocr-workers", type=int, default=settings["ocr_workers"], help="PDFs OCR'd at the same time")
+    parser.add_argument("--chunk-processes", type=int, default=settings["chunk_processes"], help="0 chunks in threads")
+    parser.add_argument("--embed-workers", type=int, default=settings["embed_workers"], help="PDFs embedded at the same time")
+    parser.add_argument("--insert-workers", type=int, default=settings["insert_workers"], help="PDFs written at the same time")
+    parser.add_argument("--queue-size", type=int, default=settings["queue_size"], help="PDFs waiting between two stages")
+    parser.add_argument("--progress-seconds", type=float, default=10.0, help="Interval of the progress line; 0 disables it")
+    parser.add_argument("--offline", action="store_true", help="Use the stand-ins of fakes.py for OCR, embeddings and the vector store")
+    parser.add_argument("--database-url", default="sqlite:///.cache/ingest-vectors.sqlite3", help="Vector store used with --offline")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    return parser.parse_args(argv)
+
+def install_offline_providers(resources: AppResources, database_url: str, dimensions: int = 256) -> OCRClient:
+    """Preload the resources with the local stand-ins of fakes.py, as benchmark.py does; returns the OCR client"""
+    import fakes
+    
+    embeddings = get_embeddings_model(resources.admission["cohere"], provider=fakes.FakeEmbeddings(dimensions))
+    resources._embeddings = embeddings
+    resources._vector_store = fakes.LocalVectorStore(database_url, embeddings, dimensions)
+    return fakes.FakeOCRClient(fakes.SyntheticCorpus())
+
+async def ingest_directory(
+    args: argparse.Namespace,
+    resources: AppResources,
+    client: OCRClient,
+    manifest: ingest.Manifest,
+    chunk_pool: Optional[ProcessPoolExecutor] = None
+) -> Dict[str, Any]:
+    """
+    Index every PDF under `args.directory` through pipelined stages:
+    hash -> OCR -> chunk -> embed -> insert (vectors, catalog and BM25 index).
+    Files the manifest has as indexed with the same bytes are skipped before OCR, and
+    files whose OCR text is already indexed under their name are skipped before embedding.
+    """
+    # Provider admission waits as long as for background jobs
+    CURRENT_ENDPOINT.set("job")
+    resources.bind_admission(asyncio.get_running_loop())
+    db = await run_blocking(lambda: resources.vector_store)
+    engine = db.tidb_vector_client._bind
+    vector_table = db.tidb_vector_client._table_model.__table__
+    split = functools.partial(split_markdown, chunk_size=INDEXING_SETTINGS["chunk_size"])
+    outcomes = {"skipped": 0, "unchanged": 0, "indexed": 0, "failed": 0}
+    
+    async def hash_file(item: ingest.IngestItem):
+        item.started = time.perf_counter()
+        item.file_hash = await run_blocking(ingest.file_sha256, item.path)
+        if await run_blocking(manifest.is_done, item.name, item.file_hash):
+            outcomes["skipped"] += 1
+            return None
+        return item
+    
+    async def ocr(item: ingest.IngestItem):
+        pages, item.ocr_cached = await extract_pdf_markdown(
+            resources.ocr_cache,
+            item.path,
+            item.path.name,
+            item.file_hash,
+            client=client,
+            admission=resources.admission["mistral"]
+        )
+        # Same hash as /process-pdf followed by /index-pdf would store; chunks get page markers
+        item.markdown = get_paged_markdown(pages)
+        item.content_hash = markdown_hash(get_combined_markdown(pages))
+        indexed = (await run_blocking(lookup_documents, engine, [item.name])).get(item.name)
+        if indexed and indexed["content_hash"] == item.content_hash:
+            await run_blocking(manifest.record, item, ingest.UNCHANGED, chunks=indexed["chunk_count"], embedded=0)
+            outcomes["unchanged"] += 1
+            return None
+        return item
+    
+    async def chunk(item: ingest.IngestItem):
+        if chunk_pool is not None:
+            item.chunks = await asyncio.get_running_loop().run_in_executor(chunk_pool, split, item.markdown)
+        else:
+            item.chunks = await run_blocking(split, item.markdown)
+        item.markdown = None
+        return item
+    
+    async def embed(item: ingest.IngestItem):
+        item.prepared = await run_blocking(
+            indexing.prepare_document,
+            engine,
+            vector_table,
+            db.embeddings,
+            EMBEDDING_MODEL,
+            item.name,
+            item.content_hash,
+            [chunk.text for chunk in item.chunks],
+            batcher=resources.embedding_batcher,
+            chunk_metadata=[chunk.metadata() for chunk in item.chunks],
+            use_chunk_columns=resources.chunk_columns
+        )
+        return item
+    
+    async def insert(item: ingest.IngestItem):
+        result = await run_blocking(
+            indexing.write_document, engine, vector_table, item.prepared, INDEXING_SETTINGS["insert_batch_rows"],
+            resources.chunk_columns
+        )
+        await run_blocking(
+            build_lexical_index, resources.lexical_index, item.name, item.content_hash,
+            [chunk.text for chunk in item.chunks], [chunk.metadata() for chunk in item.chunks]
+        )
+        await run_blocking(manifest.record, item, ingest.INDEXED, chunks=result.chunks_total, embedded=result.chunks_embedded)
+        outcomes["indexed"] += 1
+        return item
+    
+    async def record_failure(stage: str, item: ingest.IngestItem, error: BaseException):
+        outcomes["failed"] += 1
+        await run_blocking(manifest.record, item, ingest.FAILED, error=f"{stage}: {error}")
+    
+    pipeline = ingest.Pipeline(
+        [
+            ingest.Stage("hash", hash_file, args.hash_workers, units=lambda item: {"megabytes": item.size / 1e6}),
+            ingest.Stage("ocr", ocr, args.ocr_workers, units=lambda item: {"ocr_cached": int(item.ocr_cached)}),
+            ingest.Stage("chunk", chunk, max(args.chunk_processes, 1), units=lambda item: {"chunks": len(item.chunks)}),
+            ingest.Stage("embed", embed, args.embed_workers, units=lambda item: {"embedded": len(item.prepared.new_vectors)}),
+            ingest.Stage("insert", insert, args.insert_workers, units=lambda item: {"rows": len(item.prepared.rows)}),
+        ],
+        queue_size=args.queue_size,
+        on_error=record_failure
+    )
+    
+    async def report_progress():
+        while True:
+            await asyncio.sleep(args.progress_seconds)
+            print(pipeline.progress(), flush=True)
+    
+    started = time.perf_counter()
+    files = await run_blocking(ingest.discover_pdfs, args.directory)
+    items = [ingest.IngestItem(path, name, size=path.stat().st_size) for path, name in files]
+    print(f"Ingesting {len(items)} PDFs from {args.directory}", flush=True)
+    reporter = asyncio.create_task(report_progress()) if args.progress_seconds > 0 else None
+    try:
+        await pipeline.run(items)
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+    return {
+        "files": len(items),
+        **outcomes,
+        "seconds": round(time.perf_counter() - started, 2),
+        "stages": pipeline.report(),
+        "embedding_batches": resources.embedding_batcher.stats(),
+        "manifest": await run_blocking(manifest.counts),
+    }
+
+def ingest_cli(argv: List[str]) -> int:
+    """Entry point of `python main.py ingest`; exits with 1 when any PDF failed"""
+    args = parse_ingest_args(argv)
+    if not args.directory.exists():
+        print(f"{args.directory} does not exist", file=sys.stderr)
+        return 2
+    resources = AppResources()
+    client = install_offline_providers(resources, args.database_url) if args.offline else None
+    manifest = ingest.Manifest(args.manifest)
+    chunk_pool = None
+    if args.chunk_processes > 0:
+        # Start the workers now, before the pipeline's threads exist
+        chunk_pool = ProcessPoolExecutor(max_workers=args.chunk_processes)
+        chunk_pool.submit(split_markdown, "").result()
+    
+    async def run():
+        workers = args.hash_workers + args.ocr_workers + args.chunk_processes + args.embed_workers + args.insert_workers
+        executor = ThreadPoolExecutor(max_workers=max(BLOCKING_IO_WORKERS, workers + 4), thread_name_prefix="blocking-io")
+        asyncio.get_running_loop().set_default_executor(executor)
+        try:
+            return await ingest_directory(args, resources, client or await get_ocr_client(), manifest, chunk_pool)
+        finally:
+            await resources.aclose()
+    
+    try:
+        report = asyncio.run(run())
+    finally:
+        manifest.close()
+        if chunk_pool is not None:
+            chunk_pool.shutdown()
+    
+    print(
+        f"{report['files']} PDFs in {report['seconds']}s: {report['indexed']} indexed, {report['unchanged']} already indexed, "
+        f"{report['skipped']} skipped (manifest), {report['failed']} failed"
+    )
+    for name, stats in report["stages"].items():
+        units = "  ".join(
+            f"{unit} {stats[unit]:g} ({stats[f'{unit}_per_second']:g}/s)" for unit in stats if f"{unit}_per_second" in stats
+        )
+        print(
+            f"{name:<7} {stats['processed']:>6} done {stats['failed']:>4} failed  {stats['items_per_second']:>8.2f} PDFs/s  "
+            f"avg {stats['avg_ms']:>9.1f} ms  x{stats['workers']}  max backlog {stats['max_backlog']:>3}  {units}"
+        )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    return 1 if report["failed"] else 0
+
+
 if __name__ == "__main__":
+    # python main.py ingest <directory> pre-indexes a corpus; without arguments the API is served
+    if len(sys.argv) > 1 and sys.argv[1] == "ingest":
+        sys.exit(ingest_cli(sys.argv[2:]))
     uvicorn.run(app, host="0.0.0.0", port=8000) 
@@ -0,0 +1,100 @@
+"""
+Content-addressed cache of OCR output.
+
+The key is the SHA-256 of the uploaded PDF bytes plus the OCR model name, so the
+same paper uploaded twice, by anyone and under any file name, is OCR'd once.
+Values are the per-page markdown of the `OCRResponse`, stored as zlib-compressed
+JSON in a single SQLite file. Once the stored pages exceed `max_bytes`, the least
+recently used documents are evicted.
+"""
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+def ocr_cache_key(content_hash: str, model: str) -> str:
+    return f"{model}:{content_hash}"
+
+
+class OCRCache:
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_pages ("
+            "key TEXT PRIMARY KEY, pages BLOB NOT NULL, page_count INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_pages_last_access ON ocr_pages (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(LENGTH(pages)), 0) FROM ocr_pages").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, content_hash: str, model: str) -> Optional[List[str]]:
+        """Return the cached page markdown of a document, or None"""
+        key = ocr_cache_key(content_hash, model)
+        with self._lock:
+            row = self._conn.execute("SELECT pages FROM ocr_pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE ocr_pages SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, content_hash: str, model: str, pages: List[str]) -> None:
+        key = ocr_cache_key(content_hash, model)
+        blob = zlib.compress(json.dumps(pages).encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            previous = self._conn.execute("SELECT LENGTH(pages) FROM ocr_pages WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_pages VALUES (?, ?, ?, ?, ?)", (key, blob, len(pages), now, now)
+            )
+            self._total_bytes += len(blob) - (previous[0] if previous else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        # Evict down to 90% of the budget so that eviction does not run on every insert
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(pages) FROM ocr_pages ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            evicted = []
+            for key, size in rows:
+                if self._total_bytes <= target:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+            self._conn.executemany("DELETE FROM ocr_pages WHERE key = ?", evicted)
+            self.evictions += len(evicted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ocr_pages").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self._total_bytes,
+        }
@@ -0,0 +1,193 @@
+"""
+Page-parallel OCR.
+
+Large PDFs are split locally into page ranges with pypdf, and each range is sent
+to the OCR service as its own sub-job. Sub-jobs run concurrently up to a limit;
+a failed range is retried on its own with exponential backoff, so one transient
+error does not fail the whole document. The per-page markdown of all ranges is
+returned in page order.
+
+The remote service sits behind the small `OCRClient` interface so it can be
+replaced by a local stand-in; `AdmittedOCRClient` puts every call through the
+provider's admission controller.
+"""
+import asyncio
+import logging
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+from mistralai import DocumentURLChunk, Mistral
+from pypdf import PdfReader, PdfWriter
+
+from admission import AdmissionController, AdmissionRejected, RetryPolicy
+from telemetry import run_blocking
+
+logger = logging.getLogger(__name__)
+
+ProgressCallback = Callable[..., Awaitable[None]]
+
+
+class OCRClient:
+    """Runs OCR on a single PDF file and returns the markdown of each page"""
+
+    async def ocr_pdf(self, file_path: Path, file_name: str) -> List[str]:
+        raise NotImplementedError
+
+
+class MistralOCRClient(OCRClient):
+    """Upload, signed URL and OCR call against the Mistral API"""
+
+    def __init__(self, client: Mistral, model: str = "mistral-ocr-latest"):
+        self.client = client
+        self.model = model
+
+    async def ocr_pdf(self, file_path: Path, file_name: str) -> List[str]:
+        # Upload PDF file to Mistral's OCR service, streaming it from disk
+        with open(file_path, "rb") as pdf_file:
+            uploaded_file = await self.client.files.upload_async(
+                file={
+                    "file_name": file_name,
+                    "content": pdf_file,
+                },
+                purpose="ocr",
+            )
+
+        # Get URL for the uploaded file
+        signed_url = await self.client.files.get_signed_url_async(file_id=uploaded_file.id, expiry=1)
+
+        # Process PDF with OCR, without including embedded images
+        response = await self.client.ocr.process_async(
+            document=DocumentURLChunk(document_url=signed_url.url),
+            model=self.model,
+            include_image_base64=False
+        )
+        return [page.markdown for page in response.pages]
+
+
+class AdmittedOCRClient(OCRClient):
+    """Holds an admission slot of the OCR provider for every call; retries stay with `ocr_with_retry`"""
+
+    def __init__(self, client: OCRClient, admission: AdmissionController):
+        self.client = client
+        self.admission = admission
+
+    async def ocr_pdf(self, file_path: Path, file_name: str) -> List[str]:
+        async with self.admission.slot():
+            return await self.client.ocr_pdf(file_path, file_name)
+
+
+@dataclass
+class PageRange:
+    start: int  # 0-based, inclusive
+    end: int  # exclusive
+    path: Path
+
+    @property
+    def label(self) -> str:
+        return f"pages {self.start + 1}-{self.end}"
+
+
+def count_pages(file_path: Path) -> int:
+    return len(PdfReader(str(file_path)).pages)
+
+
+def split_pdf(file_path: Path, pages_per_range: int, output_dir: Path) -> List[PageRange]:
+    """Write every run of `pages_per_range` pages to its own PDF in `output_dir`"""
+    reader = PdfReader(str(file_path))
+    ranges = []
+    for start in range(0, len(reader.pages), pages_per_range):
+        end = min(start + pages_per_range, len(reader.pages))
+        writer = PdfWriter()
+        for index in range(start, end):
+            writer.add_page(reader.pages[index])
+        path = output_dir / f"pages-{start + 1:05d}-{end:05d}.pdf"
+        with open(path, "wb") as output:
+            writer.write(output)
+        ranges.append(PageRange(start, end, path))
+    return ranges
+
+
+async def ocr_with_retry(client: OCRClient, file_path: Path, file_name: str, retry: RetryPolicy, label: str) -> List[str]:
+    for attempt in range(1, retry.attempts + 1):
+        try:
+            return await client.ocr_pdf(file_path, file_name)
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            if attempt >= retry.attempts:
+                raise RuntimeError(f"OCR of {label} failed after {attempt} attempts: {e}") from e
+            delay = retry.delay(attempt)
+            logger.warning(f"OCR of {label} failed (attempt {attempt}/{retry.attempts}), retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+async def ocr_document(
+    client: OCRClient,
+    file_path: Path,
+    file_name: str,
+    pages_per_range: int = 16,
+    concurrency: int = 4,
+    retry: Optional[RetryPolicy] = None,
+    report: Optional[ProgressCallback] = None,
+) -> List[str]:
+    """
+    OCR a PDF and return the markdown of every page in order.
+
+    Documents of at most `pages_per_range` pages (or that pypdf cannot read) are sent in
+    one call; larger ones are split and their ranges OCR'd concurrently.
+    `report(stage, progress, partial)` is awaited as ranges complete.
+    """
+    retry = retry or RetryPolicy()
+
+    async def progress(value: float, partial=None):
+        if report is not None:
+            await report("ocr", value, partial)
+
+    try:
+        page_count = await run_blocking(count_pages, file_path)
+    except Exception as e:
+        logger.warning(f"Could not read page count of {file_name}, sending it in one piece: {e}")
+        page_count = 0
+
+    if page_count <= pages_per_range:
+        await progress(0.05)
+        return await ocr_with_retry(client, file_path, file_name, retry, file_name)
+
+    work_dir = Path(await run_blocking(tempfile.mkdtemp, prefix="ocr-ranges-"))
+    try:
+        if report is not None:
+            await report("splitting", 0.02)
+        ranges = await run_blocking(split_pdf, file_path, pages_per_range, work_dir)
+        semaphore = asyncio.Semaphore(concurrency)
+        pages_done = 0
+        stem = Path(file_name).stem
+
+        async def run_range(page_range: PageRange) -> List[str]:
+            nonlocal pages_done
+            async with semaphore:
+                pages = await ocr_with_retry(
+                    client,
+                    page_range.path,
+                    f"{stem}-{page_range.start + 1}-{page_range.end}.pdf",
+                    retry,
+                    f"{file_name} {page_range.label}",
+                )
+            pages_done += page_range.end - page_range.start
+            await progress(0.05 + 0.9 * pages_done / page_count, {"pages_done": pages_done, "page_count": page_count})
+            return pages
+
+        await progress(0.05, {"pages_done": 0, "page_count": page_count})
+        tasks = [asyncio.ensure_future(run_range(page_range)) for page_range in ranges]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [page for pages in results for page in pages]
+    finally:
+        await run_blocking(shutil.rmtree, work_dir, True)
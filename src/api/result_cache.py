@@ -0,0 +1,259 @@
+"""
+Response cache for the generation endpoints.
+
+Generation runs at temperature 0, so a result is fully determined by the paper,
+the artifact, the prompt template, the model and the request parameters. The
+cache key covers all of them. Values are JSON documents stored in a pluggable
+backend (in-memory LRU, SQLite file or a Redis-protocol server), and concurrent
+requests for the same key are coalesced so only one LLM call is made.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from telemetry import run_blocking
+
+KEY_PREFIX = "gen"
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_key(paper_hash: str, artifact: str, prompt_version: str, model: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """Cache key; the paper hash comes first so all results of a paper share a prefix"""
+    params_hash = hash_text(json.dumps(params or {}, sort_keys=True))[:16]
+    return f"{KEY_PREFIX}:{paper_hash}:{artifact}:{prompt_version}:{model}:{params_hash}"
+
+
+def paper_prefix(paper_hash: str, artifact: Optional[str] = None) -> str:
+    prefix = f"{KEY_PREFIX}:{paper_hash}:"
+    return f"{prefix}{artifact}:" if artifact else prefix
+
+
+class CacheBackend:
+    """Interface of the storage backends; values are JSON-serializable objects"""
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def delete_prefix(self, prefix: str) -> int:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """Bounded in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_items: int = 1000):
+        self.max_items = max_items
+        self._entries: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and time.time() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (time.time() + ttl if ttl else None, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    async def delete_prefix(self, prefix: str) -> int:
+        keys = [key for key in self._entries if key.startswith(prefix)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+
+class DiskBackend(CacheBackend):
+    """SQLite file with per-entry expiry; the oldest entries are evicted beyond `max_items`"""
+
+    def __init__(self, path: str, max_items: int = 100000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+
+    def _get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and time.time() >= row[1]:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+        return json.loads(row[0])
+
+    def _set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl if ttl else None, now),
+            )
+            self._conn.execute("DELETE FROM results WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_items,),
+            )
+
+    def _delete_prefix(self, prefix: str) -> int:
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM results WHERE key LIKE ? ESCAPE '\\'", (escaped + "%",)
+            ).rowcount
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await run_blocking(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await run_blocking(self._set, key, value, ttl)
+
+    async def delete_prefix(self, prefix: str) -> int:
+        return await run_blocking(self._delete_prefix, prefix)
+
+    async def close(self) -> None:
+        self._conn.close()
+
+
+class RedisBackend(CacheBackend):
+    """Any server speaking the Redis protocol (Redis, Valkey, KeyDB, Dragonfly)"""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise ImportError(
+                "Could not import redis python package. "
+                "Please install it with `pip install redis`."
+            )
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self._client.get(key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self._client.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    async def delete_prefix(self, prefix: str) -> int:
+        deleted = 0
+        async for key in self._client.scan_iter(match=prefix + "*", count=500):
+            deleted += await self._client.delete(key)
+        return deleted
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def create_backend(kind: str, *, max_items: int = 1000, path: Optional[str] = None, url: Optional[str] = None) -> CacheBackend:
+    if kind == "memory":
+        return MemoryBackend(max_items)
+    if kind == "disk":
+        return DiskBackend(path or ".cache/results.sqlite3", max_items)
+    if kind == "redis":
+        if not url:
+            raise ValueError("A Redis URL is required for the redis result cache backend")
+        return RedisBackend(url)
+    raise ValueError(f"Unknown result cache backend: {kind}. Should be one of memory, disk, redis.")
+
+
+class ResultCache:
+    """Read-through cache with single-flight coalescing of concurrent misses"""
+
+    def __init__(self, backend: CacheBackend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Return (value, cached). `compute` must return a JSON-serializable value.
+
+        The lookup runs in its own task shared by every concurrent caller for the key, so a
+        caller that disconnects does not cancel the generation the others are waiting for.
+        A caller that joins a lookup in flight gets the same `cached` flag as the first one:
+        False when the value was generated, True only when it came from the cache.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._load(key, compute))
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller went away
+            task.exception()
+
+    async def _load(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        try:
+            value = await self.backend.get(key)
+        except Exception:
+            # A broken cache must not break generation
+            self.errors += 1
+            value = None
+        if value is not None:
+            self.hits += 1
+            return value, True
+
+        self.misses += 1
+        value = await compute()
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception:
+            self.errors += 1
+        return value, False
+
+    async def invalidate(self, paper_hash: str, artifact: Optional[str] = None) -> int:
+        return await self.backend.delete_prefix(paper_prefix(paper_hash, artifact))
+
+    def stats(self) -> Dict[str, int]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "inflight": len(self._inflight),
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    async def close(self) -> None:
+        await self.backend.close()
@@ -0,0 +1,136 @@
+"""
+Map-reduce summarization for papers too long for one prompt.
+
+The paper is split with `MarkdownTextSplitter`, which prefers heading
+boundaries. Every section is summarized on its own, concurrently, and a final
+reduce call turns the ordered section summaries into the structured summary.
+Section summaries go through the result cache under the paper's hash, so they
+are shared by every endpoint that works from them and dropped together with
+the paper's other cached results.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_text_splitters import MarkdownTextSplitter
+
+from result_cache import ResultCache, hash_text, make_key
+from telemetry import run_blocking, span
+
+# Rough token count for English prose and Markdown; only used to pick the mode and size sections
+CHARS_PER_TOKEN = 4
+
+SECTION_SUMMARY_PROMPT = (
+    "You are an expert academic summarizer. The text below is section {index} of {count} "
+    "of a research paper in Markdown format.\n\n"
+    "Write a dense summary of this section in Markdown. Keep every claim, method detail, dataset, "
+    "number, equation and limitation that a reader of the whole paper would need; drop repetition "
+    "and boilerplate.\n\n"
+    "{section}"
+)
+
+SECTIONS_CONTEXT_PROMPT = (
+    "You are an expert assistant for academic research papers. "
+    "The research paper is too long to show in full; below are summaries of its consecutive sections, in order:\n\n"
+    "{section_summaries}"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def split_sections(paper_markdown: str, section_tokens: int) -> List[str]:
+    """Split a paper into sections of at most about `section_tokens` tokens, along headings where possible"""
+    splitter = MarkdownTextSplitter(chunk_size=section_tokens * CHARS_PER_TOKEN, chunk_overlap=0)
+    return splitter.split_text(paper_markdown)
+
+
+class StageTimer:
+    """Wall-clock duration of each named stage of a request"""
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def server_timing(self) -> str:
+        """Value of a `Server-Timing` header, durations in milliseconds"""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations.items())
+
+
+def section_prompt_version() -> str:
+    return hash_text(SECTION_SUMMARY_PROMPT)[:12]
+
+
+def map_reduce_prompt_version() -> str:
+    """Changes whenever the section or reduce prompt changes"""
+    return hash_text(SECTION_SUMMARY_PROMPT + "\0" + SECTIONS_CONTEXT_PROMPT)[:12]
+
+
+async def summarize_sections(
+    llm,
+    cache: ResultCache,
+    paper_markdown: str,
+    model: str,
+    section_tokens: int = 8000,
+    concurrency: int = 8,
+    timer: Optional[StageTimer] = None,
+) -> List[str]:
+    """
+    Return the summary of every section of the paper, in order.
+    Sections are summarized concurrently, at most `concurrency` at a time, and cached per section.
+    """
+    timer = timer or StageTimer()
+    with timer.stage("split"):
+        sections = await run_blocking(split_sections, paper_markdown, section_tokens)
+
+    chain = ChatPromptTemplate.from_messages([("human", SECTION_SUMMARY_PROMPT)]) | llm | StrOutputParser()
+    paper_hash = hash_text(paper_markdown)
+    version = section_prompt_version()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def summarize(index: int, section: str) -> str:
+        key = make_key(paper_hash, "section_summary", version, model, {
+            "section_hash": hash_text(section),
+            "section_tokens": section_tokens,
+        })
+
+        async def compute():
+            async with semaphore:
+                return await chain.ainvoke({"index": index + 1, "count": len(sections), "section": section})
+
+        value, _ = await cache.get_or_compute(key, compute)
+        return value
+
+    with timer.stage("map"):
+        return await asyncio.gather(*(summarize(index, section) for index, section in enumerate(sections)))
+
+
+def join_section_summaries(section_summaries: List[str]) -> str:
+    return "\n\n".join(
+        f"### Section {index + 1}\n\n{summary}" for index, summary in enumerate(section_summaries)
+    )
+
+
+async def reduce_sections(llm, section_summaries: List[str], instructions: str, schema, timer: Optional[StageTimer] = None):
+    """Fill `schema` from the section summaries with the artifact's usual instructions"""
+    timer = timer or StageTimer()
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", SECTIONS_CONTEXT_PROMPT),
+        ("human", instructions),
+    ])
+    with timer.stage("reduce"):
+        return await (prompt | llm.with_structured_output(schema)).ainvoke(
+            {"section_summaries": join_section_summaries(section_summaries)}
+        )
@@ -0,0 +1,392 @@
+"""
+Request tracing, Prometheus metrics and an on-demand sampling profiler, all in-process.
+
+`span(name)` times one stage of the current request (upload, ocr, split, embed,
+insert, retrieve, prompt_build, llm, ...). The spans of a request are kept in its
+`Trace`, returned in the Server-Timing header and, for slow requests, kept in a
+small buffer that /metrics reports. Every span also feeds a per-route, per-stage
+histogram. When opentelemetry-api is installed spans are mirrored to it, so an
+SDK with an exporter can ship them; without an SDK or collector that is a no-op.
+
+Metrics are plain counters and histograms rendered in the Prometheus text
+format; there is no push and nothing to connect to.
+
+`run_blocking` is how every module moves blocking work to the thread pool, so
+the spans recorded there stay on the request's trace.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import math
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+# Seconds; spans from a few milliseconds (TiDB lookups) to minutes (OCR of long PDFs)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CHARS_PER_TOKEN = 4  # same estimate as summarization.estimate_tokens
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # labels -> (count per bucket, sum, count)
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, edge in enumerate(self.buckets):
+                if value <= edge:
+                    state[0][position] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for edge, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket = _labels(self.labelnames, key, 'le="%s"' % _number(edge))
+                    lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+                bucket = _labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._metrics: "OrderedDict[str, Any]" = OrderedDict()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets))
+
+    def render(self, snapshot: Optional[Dict[str, Any]] = None) -> str:
+        """Prometheus text exposition of every metric, plus the numbers of a JSON snapshot as gauges"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for name, value in flatten_gauges(self.prefix, snapshot or {}):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def flatten_gauges(prefix: str, snapshot: Dict[str, Any]) -> Iterable[Tuple[str, float]]:
+    """Numeric leaves of a nested dict as (metric name, value); strings, lists and None are skipped"""
+    for key, value in snapshot.items():
+        name = f"{prefix}_{''.join(char if char.isalnum() else '_' for char in str(key))}"
+        if isinstance(value, dict):
+            yield from flatten_gauges(name, value)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+REGISTRY = MetricsRegistry("pdf_studio")
+HTTP_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Request latency by route and status", ("method", "route", "status")
+)
+HTTP_BYTES = REGISTRY.counter("http_bytes_total", "Request and response body bytes by route", ("route", "direction"))
+STAGE_SECONDS = REGISTRY.histogram("stage_duration_seconds", "Duration of each pipeline stage by route", ("route", "stage"))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "upstream_duration_seconds", "Provider call latency, excluding admission waits", ("provider", "outcome")
+)
+UPSTREAM_TOKENS = REGISTRY.counter(
+    "upstream_tokens_total", "Estimated tokens sent to and received from providers", ("provider", "direction")
+)
+PAYLOAD_BYTES = REGISTRY.counter("payload_bytes_total", "Bytes of uploads and extracted text", ("kind",))
+
+
+def record_tokens(provider: str, direction: str, text: str) -> None:
+    UPSTREAM_TOKENS.inc(len(text) // CHARS_PER_TOKEN, provider=provider, direction=direction)
+
+
+# Traces
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float = 0.0
+    parent: Optional[str] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class Trace:
+    """Spans of one request or background job"""
+
+    def __init__(self, route: str, trace_id: Optional[str] = None, scope: Optional[Dict[str, Any]] = None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.route = route
+        self.scope = scope
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.duration: Optional[float] = None
+        self.status: Optional[int] = None
+        self.spans: List[Span] = []
+        self.profile: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def route_name(self) -> str:
+        """Route template of an HTTP request once it was routed (keeps metric labels bounded), else the given route"""
+        if self.scope is None:
+            return self.route
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def stage_totals(self) -> Dict[str, float]:
+        """Seconds per stage name; concurrent spans of one stage add up"""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return totals
+
+    def server_timing(self) -> str:
+        stages = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stage_totals().items()]
+        if self.duration is not None:
+            stages.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(stages)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = [
+                {
+                    "name": span.name,
+                    "parent": span.parent,
+                    "offset_ms": round((span.start - self.start) * 1000, 1),
+                    "duration_ms": round(span.duration * 1000, 1),
+                    **({"attributes": span.attributes} if span.attributes else {}),
+                }
+                for span in self.spans
+            ]
+        return {
+            "trace_id": self.id,
+            "route": self.route_name,
+            "path": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 1) if self.duration is not None else None,
+            "spans": spans,
+            "profiled": self.profile is not None,
+        }
+
+
+CURRENT_TRACE: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+CURRENT_SPAN: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("span", default=None)
+
+
+def current_route() -> str:
+    trace = CURRENT_TRACE.get()
+    return trace.route_name if trace is not None else "background"
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the bounded thread pool without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    # Carry the request's context (trace, admission endpoint) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current trace; works in sync and async code on the request's context"""
+    trace = CURRENT_TRACE.get()
+    parent = CURRENT_SPAN.get()
+    token = CURRENT_SPAN.set(name)
+    otel_span = otel_trace.get_tracer(__name__).start_as_current_span(name, attributes=attributes) if otel_trace else None
+    start = time.perf_counter()
+    try:
+        if otel_span is not None:
+            with otel_span:
+                yield
+        else:
+            yield
+    finally:
+        duration = time.perf_counter() - start
+        try:
+            CURRENT_SPAN.reset(token)
+        except ValueError:
+            # An async generator finalized from another context
+            pass
+        STAGE_SECONDS.observe(duration, route=current_route(), stage=name)
+        if trace is not None:
+            trace.add(Span(name, start, duration, parent, attributes))
+
+
+def record_span(name: str, seconds: float, **attributes) -> None:
+    """Add a stage measured elsewhere (e.g. in a worker thread, which does not see the request's context)"""
+    STAGE_SECONDS.observe(seconds, route=current_route(), stage=name)
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(Span(name, time.perf_counter() - seconds, seconds, CURRENT_SPAN.get(), attributes))
+
+
+class TraceBuffer:
+    """The slowest recent traces, for /metrics"""
+
+    def __init__(self, max_traces: int = 50, slow_seconds: float = 1.0):
+        self.slow_seconds = slow_seconds
+        self._traces: deque = deque(maxlen=max_traces)
+        self._profiles: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def finish(self, trace: Trace) -> None:
+        if trace.profile is not None:
+            with self._lock:
+                self._profiles[trace.id] = trace.profile
+                while len(self._profiles) > self._traces.maxlen:
+                    self._profiles.popitem(last=False)
+        if trace.duration is not None and trace.duration >= self.slow_seconds:
+            with self._lock:
+                self._traces.append(trace)
+            logger.info(f"Slow request {trace.route} ({trace.id}): {trace.server_timing()}")
+
+    def recent(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            traces = list(self._traces)
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    def profile(self, trace_id: str) -> Optional[str]:
+        with self._lock:
+            return self._profiles.get(trace_id)
+
+
+@contextmanager
+def start_trace(route: str, buffer: Optional[TraceBuffer] = None):
+    """Collect the spans of a background job (or any unit of work) under a new trace"""
+    trace = Trace(route)
+    token = CURRENT_TRACE.set(trace)
+    try:
+        yield trace
+    finally:
+        CURRENT_TRACE.reset(token)
+        if trace.duration is None:
+            trace.duration = time.perf_counter() - trace.start
+        if buffer is not None:
+            buffer.finish(trace)
+
+
+# Profiling
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of every thread (except its own) at a fixed interval
+    and aggregates them as collapsed stacks ("frame;frame;frame count"), the input
+    format of flamegraph.pl and speedscope. Samples cover the whole process, so
+    concurrent requests show up too.
+    """
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                key = ";".join([names.get(thread_id, str(thread_id))] + stack[::-1])
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self._stacks.items(), key=lambda item: -item[1]))
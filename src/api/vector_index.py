@@ -0,0 +1,461 @@
+"""
+Vector search backends.
+
+`TiDBVectorBackend` runs the search in TiDB, the system of record.
+Searches across several documents take a per-document quota, so that one long
+paper cannot crowd the others out of the result; TiDB answers them with a single
+`IN` query ranked per document.
+`LocalVectorBackend` answers from `LocalVectorIndex`, a per-process read replica
+of the vector table: every document is a float32 matrix of unit vectors in a
+memory-mapped file, searched with an exact batched dot product, or through an
+HNSW graph (hnswlib, optional) once the document has more than
+`exact_max_rows` rows. The replica is rebuilt from TiDB at startup, refreshed
+against the document catalog, and updated in place by the indexing endpoint.
+Documents that are not in the replica yet are searched in TiDB.
+
+Both backends also return the chunks at given ordinals of a document, so the
+neighbours of a search hit are fetched without another vector query.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Collection, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+import indexing
+from chunking import in_section
+from telemetry import run_blocking
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class VectorBackend:
+    """Similarity search over the chunks of one or more documents"""
+
+    async def search(
+        self,
+        source_names: Sequence[str],
+        question: str,
+        k: int,
+        per_source: Optional[int] = None,
+        section: Optional[str] = None,
+        query_vector: Optional[Sequence[float]] = None,
+    ) -> List[Document]:
+        """
+        Top-k chunks of the given documents, at most `per_source` of them from any one document,
+        and only from sections whose heading path contains `section` when given. The question is
+        embedded unless its `query_vector` is passed in.
+        """
+        raise NotImplementedError
+
+    async def neighbors(self, ordinals: Dict[str, Collection[int]]) -> List[Document]:
+        """The chunks at the given ordinals of each document"""
+        raise NotImplementedError
+
+
+class TiDBVectorBackend(VectorBackend):
+    """
+    Server-side search in the TiDB vector table. A single document goes through the LangChain
+    vector store; several documents, a section, or a question embedded beforehand are searched
+    in one query, filtered on the indexed generated columns when `chunk_columns` is set.
+    """
+
+    def __init__(self, store, chunk_columns: bool = False):
+        self.store = store
+        self.chunk_columns = chunk_columns
+
+    async def search(
+        self,
+        source_names: Sequence[str],
+        question: str,
+        k: int,
+        per_source: Optional[int] = None,
+        section: Optional[str] = None,
+        query_vector: Optional[Sequence[float]] = None,
+    ) -> List[Document]:
+        names = list(dict.fromkeys(source_names))
+        if len(names) == 1 and per_source is None and not section and query_vector is None:
+            return await self.store.asimilarity_search(question, k=k, filter={"source": names[0]})
+
+        if query_vector is None:
+            query_vector = await run_blocking(self.store.embeddings.embed_query, question)
+        client = self.store.tidb_vector_client
+
+        def run_query():
+            with client._bind.connect() as conn:
+                return indexing.search_documents(
+                    conn,
+                    client._table_model.__table__,
+                    names,
+                    query_vector,
+                    per_source or k,
+                    k,
+                    use_chunk_columns=self.chunk_columns,
+                    section=section,
+                )
+
+        rows = await run_blocking(run_query)
+        return [Document(page_content=row["document"], metadata=row["meta"]) for row, _ in rows]
+
+    async def neighbors(self, ordinals: Dict[str, Collection[int]]) -> List[Document]:
+        client = self.store.tidb_vector_client
+
+        def run_query():
+            with client._bind.connect() as conn:
+                return indexing.load_neighbors(
+                    conn, client._table_model.__table__, ordinals, use_chunk_columns=self.chunk_columns
+                )
+
+        rows = await run_blocking(run_query)
+        return [Document(page_content=row["document"], metadata=row["meta"]) for row in rows]
+
+
+def version_of(document: Dict[str, Any]) -> str:
+    """Replica version of a catalog row; backfilled rows have no content hash"""
+    if document.get("content_hash"):
+        return document["content_hash"]
+    return f"legacy:{document.get('chunk_count')}:{document.get('indexed_at')}"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _process_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # Alive, owned by another user
+        pass
+    return True
+
+
+@dataclass
+class DocumentVectors:
+    """One document of the replica: unit vectors on disk plus row payloads in memory"""
+    version: str
+    directory: Path
+    ids: List[str]
+    texts: List[str]
+    metas: List[Dict[str, Any]]
+    matrix: np.ndarray
+    deleted: np.ndarray
+    positions: Dict[str, int] = field(default_factory=dict)
+    graph: Any = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Row position of each chunk ordinal, built on first use
+    _ordinals: Optional[Dict[int, int]] = None
+
+    @property
+    def live_rows(self) -> int:
+        return len(self.ids) - int(self.deleted.sum())
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray, List[str], List[Dict[str, Any]]]:
+        """Matrix, tombstones, texts and metadata of one version; changes replace these objects rather than mutate them"""
+        with self.lock:
+            return self.matrix, self.deleted, self.texts, self.metas
+
+    def at_ordinals(self, ordinals: Collection[int]) -> List[Document]:
+        with self.lock:
+            if self._ordinals is None:
+                self._ordinals = {
+                    meta["ordinal"]: position
+                    for position, meta in enumerate(self.metas)
+                    if not self.deleted[position] and meta.get("ordinal") is not None
+                }
+            positions = [self._ordinals[ordinal] for ordinal in ordinals if ordinal in self._ordinals]
+            return [Document(page_content=self.texts[position], metadata=self.metas[position]) for position in positions]
+
+
+class LocalVectorIndex:
+    def __init__(
+        self,
+        root: str,
+        exact_max_rows: int = 20000,
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 200,
+        hnsw_ef_search: int = 64,
+    ):
+        # Every worker process keeps its own replica under `root`. The replica is rebuilt from TiDB
+        # at startup, so files left by processes that are gone are stale
+        self.root = Path(root) / f"pid-{os.getpid()}"
+        shutil.rmtree(self.root, ignore_errors=True)
+        for directory in Path(root).glob("pid-*"):
+            if not _process_alive(directory.name[len("pid-"):]):
+                shutil.rmtree(directory, ignore_errors=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.exact_max_rows = exact_max_rows
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self._lock = threading.Lock()
+        self._documents: Dict[str, DocumentVectors] = {}
+        self.ready = False
+        self.local_searches = 0
+        self.fallback_searches = 0
+        if exact_max_rows and hnswlib is None:
+            logger.info("hnswlib is not installed; local vector search is exact for every document")
+
+    def has_document(self, source_name: str) -> bool:
+        return source_name in self._documents
+
+    def version(self, source_name: str) -> Optional[str]:
+        document = self._documents.get(source_name)
+        return document.version if document is not None else None
+
+    def _write(self, source_name: str, version: str, ids: List[str], texts: List[str], metas: List[Dict[str, Any]], vectors: np.ndarray) -> DocumentVectors:
+        key = hashlib.sha256(source_name.encode("utf-8")).hexdigest()[:32]
+        directory = self.root / f"{key}.{uuid.uuid4().hex[:8]}"
+        directory.mkdir(parents=True)
+        vectors = _normalize(vectors) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+        path = directory / "vectors.f32"
+        vectors.tofile(path)
+        matrix = np.memmap(path, dtype=np.float32, mode="r", shape=vectors.shape) if len(ids) else vectors
+        with open(directory / "rows.json", "w", encoding="utf-8") as rows_file:
+            json.dump({"source": source_name, "version": version, "ids": ids}, rows_file)
+
+        document = DocumentVectors(
+            version=version,
+            directory=directory,
+            ids=list(ids),
+            texts=list(texts),
+            metas=list(metas),
+            matrix=matrix,
+            deleted=np.zeros(len(ids), dtype=bool),
+            positions={row_id: position for position, row_id in enumerate(ids)},
+        )
+        if hnswlib is not None and len(ids) > self.exact_max_rows:
+            graph = hnswlib.Index(space="ip", dim=vectors.shape[1])
+            graph.init_index(
+                max_elements=len(ids) * 2, M=self.hnsw_m, ef_construction=self.hnsw_ef_construction,
+                allow_replace_deleted=False,
+            )
+            graph.add_items(vectors, np.arange(len(ids)))
+            graph.set_ef(self.hnsw_ef_search)
+            document.graph = graph
+        return document
+
+    def _swap(self, source_name: str, document: Optional[DocumentVectors]) -> None:
+        with self._lock:
+            previous = self._documents.pop(source_name, None)
+            if document is not None:
+                self._documents[source_name] = document
+        # Searches holding the previous matrix keep their mapping; unlinked files go away with it
+        if previous is not None:
+            shutil.rmtree(previous.directory, ignore_errors=True)
+
+    def replace_document(self, source_name: str, version: str, rows: List[Dict[str, Any]]) -> None:
+        """Load a document from rows with id, embedding, document and meta"""
+        vectors = np.asarray([np.asarray(row["embedding"], dtype=np.float32) for row in rows], dtype=np.float32)
+        self._swap(source_name, self._write(
+            source_name,
+            version,
+            [row["id"] for row in rows],
+            [row["document"] for row in rows],
+            [row["meta"] or {} for row in rows],
+            vectors,
+        ))
+
+    def drop_document(self, source_name: str) -> None:
+        self._swap(source_name, None)
+
+    def apply_changes(
+        self,
+        source_name: str,
+        version: str,
+        inserted_rows: List[Dict[str, Any]],
+        deleted_ids: Iterable[str],
+        updated_rows: Iterable[Dict[str, Any]] = (),
+    ) -> None:
+        """
+        Apply the rows written, re-labelled and deleted by an indexing run. Deletes are tombstones;
+        rows added to an HNSW document are appended to its graph and file, and the document is
+        rewritten when rows are added to an exact document or a quarter of it is deleted.
+        """
+        document = self._documents.get(source_name)
+        if document is None or document.version == version:
+            # Not replicated yet, or already reloaded at this version by the refresh loop
+            return
+        with document.lock:
+            document._ordinals = None
+            # Searches read a snapshot of these without the lock, so they are replaced, not changed in place
+            metas = list(document.metas)
+            deleted = document.deleted.copy()
+            for row in updated_rows:
+                position = document.positions.get(row["id"])
+                if position is not None:
+                    metas[position] = row["meta"]
+            for row_id in deleted_ids:
+                position = document.positions.pop(row_id, None)
+                if position is not None:
+                    deleted[position] = True
+                    if document.graph is not None:
+                        document.graph.mark_deleted(position)
+            document.metas, document.deleted = metas, deleted
+
+            if document.graph is not None and inserted_rows and document.deleted.mean() < 0.25:
+                vectors = _normalize(np.asarray([row["embedding"] for row in inserted_rows], dtype=np.float32))
+                start = len(document.ids)
+                if start + len(inserted_rows) > document.graph.get_max_elements():
+                    document.graph.resize_index((start + len(inserted_rows)) * 2)
+                document.graph.add_items(vectors, np.arange(start, start + len(inserted_rows)))
+                path = document.directory / "vectors.f32"
+                with open(path, "ab") as vectors_file:
+                    vectors.tofile(vectors_file)
+                document.matrix = np.memmap(
+                    path, dtype=np.float32, mode="r", shape=(start + len(inserted_rows), vectors.shape[1])
+                )
+                document.ids = document.ids + [row["id"] for row in inserted_rows]
+                document.texts = document.texts + [row["document"] for row in inserted_rows]
+                document.metas = document.metas + [row["meta"] or {} for row in inserted_rows]
+                document.deleted = np.concatenate([document.deleted, np.zeros(len(inserted_rows), dtype=bool)])
+                for offset, row in enumerate(inserted_rows):
+                    document.positions[row["id"]] = start + offset
+                document.version = version
+                return
+
+            if not inserted_rows and document.deleted.mean() < 0.25:
+                document.version = version
+                return
+
+            live = ~document.deleted
+            rows = [
+                {"id": row_id, "embedding": vector, "document": text, "meta": meta}
+                for row_id, vector, text, meta, keep in zip(
+                    document.ids, np.asarray(document.matrix), document.texts, document.metas, live
+                )
+                if keep
+            ]
+        self.replace_document(source_name, version, rows + list(inserted_rows))
+
+    def search(
+        self,
+        source_names: Sequence[str],
+        query_vector: Sequence[float],
+        k: int,
+        per_source: Optional[int] = None,
+        section: Optional[str] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Top-k rows of the given documents by cosine similarity, as (document, cosine distance).
+        A `section` filter is searched exactly, over the rows under a matching heading.
+        Safe to call from several threads while indexing runs apply their changes.
+        """
+        per_document = min(k, per_source or k)
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        # (score, texts, metas, position) with the row payloads of the version that was searched
+        candidates: List[Tuple[float, List[str], List[Dict[str, Any]], int]] = []
+        for source_name in source_names:
+            document = self._documents.get(source_name)
+            if document is None or not document.ids:
+                continue
+            if document.graph is not None and not section:
+                with document.lock:
+                    count = min(per_document, document.live_rows)
+                    if count == 0:
+                        continue
+                    labels, distances = document.graph.knn_query(query, k=count)
+                    texts, metas = document.texts, document.metas
+                # Inner-product space: distance is 1 - dot
+                candidates.extend((1.0 - float(d), texts, metas, int(label)) for label, d in zip(labels[0], distances[0]))
+                continue
+
+            matrix, deleted, texts, metas = document.snapshot()
+            excluded = deleted | np.asarray([not in_section(meta, section) for meta in metas]) if section else deleted
+            scores = np.asarray(matrix) @ query
+            scores[excluded] = -np.inf
+            count = min(per_document, len(scores))
+            top = np.argpartition(-scores, count - 1)[:count]
+            candidates.extend((float(scores[p]), texts, metas, int(p)) for p in top if np.isfinite(scores[p]))
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return [
+            (Document(page_content=texts[position], metadata=metas[position]), 1.0 - score)
+            for score, texts, metas, position in candidates[:k]
+        ]
+
+    def at_ordinals(self, source_name: str, ordinals: Collection[int]) -> List[Document]:
+        """Chunks of a replicated document at the given ordinals"""
+        document = self._documents.get(source_name)
+        return document.at_ordinals(ordinals) if document is not None else []
+
+    def sync(self, list_documents: Callable[[], Dict[str, Dict[str, Any]]], load_rows: Callable[[str], List[Dict[str, Any]]]) -> int:
+        """
+        Bring the replica in line with the catalog: load documents that are new or changed and
+        drop the ones that are gone. Returns the number of documents loaded.
+        """
+        catalog_rows = list_documents()
+        loaded = 0
+        for source_name, row in catalog_rows.items():
+            version = version_of(row)
+            if self.version(source_name) == version:
+                continue
+            self.replace_document(source_name, version, load_rows(source_name))
+            loaded += 1
+        for source_name in [name for name in self._documents if name not in catalog_rows]:
+            self.drop_document(source_name)
+        self.ready = True
+        return loaded
+
+    def stats(self) -> Dict[str, Any]:
+        documents = list(self._documents.values())
+        return {
+            "ready": self.ready,
+            "documents": len(documents),
+            "rows": sum(document.live_rows for document in documents),
+            "hnsw_documents": sum(1 for document in documents if document.graph is not None),
+            "bytes": sum(int(document.matrix.nbytes) for document in documents),
+            "local_searches": self.local_searches,
+            "fallback_searches": self.fallback_searches,
+        }
+
+
+class LocalVectorBackend(VectorBackend):
+    """Searches the local replica; documents it does not hold yet go to `fallback`"""
+
+    def __init__(self, index: LocalVectorIndex, embeddings, fallback: VectorBackend):
+        self.index = index
+        self.embeddings = embeddings
+        self.fallback = fallback
+
+    async def search(
+        self,
+        source_names: Sequence[str],
+        question: str,
+        k: int,
+        per_source: Optional[int] = None,
+        section: Optional[str] = None,
+        query_vector: Optional[Sequence[float]] = None,
+    ) -> List[Document]:
+        if not all(self.index.has_document(name) for name in source_names):
+            self.index.fallback_searches += 1
+            return await self.fallback.search(source_names, question, k, per_source, section, query_vector)
+        if query_vector is None:
+            query_vector = await run_blocking(self.embeddings.embed_query, question)
+        self.index.local_searches += 1
+        # Scoring a large document takes milliseconds of numpy or hnswlib work; keep it off the event loop
+        results = await run_blocking(self.index.search, source_names, query_vector, k, per_source, section)
+        return [document for document, _ in results]
+
+    async def neighbors(self, ordinals: Dict[str, Collection[int]]) -> List[Document]:
+        if not all(self.index.has_document(name) for name in ordinals):
+            return await self.fallback.neighbors(ordinals)
+        return [chunk for name, wanted in ordinals.items() for chunk in self.index.at_ordinals(name, wanted)]